@@ -1,14 +1,40 @@
 import abc
-from typing import Optional, List
+from typing import Optional, List, Dict, AsyncIterator
 
 
 class Backend():
+    ROLE_SYSTEM = "system"
+    ROLE_USER = "user"
+    ROLE_ASSISTANT = "assistant"
+
     @abc.abstractmethod
     async def complete(
         self,
-        prompt: str,
+        messages: List[Dict[str, str]],
         max_tokens: int = 16,
         stop: Optional[List[str]] = None,
         temperature: Optional[float] = 1.0
     ) -> str:
         pass
+
+    async def stream(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: int = 16,
+        stop: Optional[List[str]] = None,
+        temperature: Optional[float] = 1.0
+    ) -> AsyncIterator[str]:
+        # Backends without native streaming deliver the whole completion as a
+        # single delta
+        yield await self.complete(
+            messages, max_tokens=max_tokens, stop=stop, temperature=temperature)
+
+    def count_tokens(self, text: str) -> int:
+        # A rough estimate for English text; override with the model's
+        # tokenizer where precision matters
+        return len(text) // 4 + 1
+
+    def is_retryable(self, e: Exception) -> bool:
+        # Whether a failed request is worth retrying, e.g. after hitting a rate
+        # limit or a transient server error
+        return False
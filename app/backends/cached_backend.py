@@ -0,0 +1,166 @@
+import re
+import json
+import asyncio
+import hashlib
+import logging
+import metrics
+from cache import LRUCache
+from backends.backend import Backend
+from typing import Optional, List, Dict, AsyncIterator, Hashable
+
+
+class CompletionCache():
+    # Completions shared by all sessions of the process, for prompts that
+    # always get the same completion: those at or below max_temperature, and
+    # conversation openers from the list, at any temperature. Entries are
+    # keyed on the exact prompt and parameters.
+    def __init__(
+        self,
+        model: Optional[str] = None,
+        max_temperature: float = 0,
+        openers: Optional[List[str]] = None,
+        ttl: float = 3600,
+        max_entries: Optional[int] = 10000,
+        max_bytes: Optional[int] = 16 * 1024 * 1024
+    ):
+        self.model = model
+        self.max_temperature = max_temperature
+        self.openers = {self.normalize(opener) for opener in openers or []}
+        self.ttl = ttl
+        self.completions = LRUCache(max_entries=max_entries, max_bytes=max_bytes)
+        # Completions being fetched, for identical requests to wait for
+        # rather than fetch again
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+
+    def wrap(self, backend: Backend) -> "CachedBackend":
+        return CachedBackend(self, backend)
+
+    def get_key(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: int,
+        stop: Optional[List[str]],
+        temperature: Optional[float]
+    ) -> Optional[str]:
+        # Returns None for requests that aren't to be cached
+        if temperature is not None and temperature > self.max_temperature \
+                and not self.is_opener(messages):
+            return None
+
+        data = json.dumps([self.model, messages, stop, max_tokens, temperature])
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def is_opener(self, messages: List[Dict[str, str]]) -> bool:
+        # A conversation consisting of a single user message from the list,
+        # after any system messages
+        conversation = [message for message in messages if message["role"] != Backend.ROLE_SYSTEM]
+        return len(conversation) == 1 and conversation[0]["role"] == Backend.ROLE_USER \
+            and self.normalize(conversation[0]["content"]) in self.openers
+
+    def lead(self, key: str) -> Optional[asyncio.Future]:
+        # Returns the future of the identical request in flight, if any.
+        # Otherwise the caller is to fetch the completion and finish().
+        future = self._in_flight.get(key)
+        if future is None:
+            self._in_flight[key] = asyncio.get_running_loop().create_future()
+
+        return future
+
+    def finish(self, key: str, completion: Optional[str]):
+        # Passes the completion on to the requests waiting for it, or None if
+        # it couldn't be fetched, and caches it
+        future = self._in_flight.pop(key)
+        future.set_result(completion)
+
+        if completion is not None:
+            self.completions.set(key, completion, self.ttl,
+                                 size=len(key) + len(completion.encode("utf-8")))
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(re.findall(r"\w+", text.lower()))
+
+
+class CachedBackend(Backend):
+    def __init__(self, cache: CompletionCache, backend: Backend):
+        self.cache = cache
+        self.backend = backend
+
+    async def complete(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: int = 16,
+        stop: Optional[List[str]] = None,
+        temperature: Optional[float] = 1.0
+    ) -> str:
+        key = self.cache.get_key(messages, max_tokens, stop, temperature)
+        completion = await self._get_cached(key)
+        if completion is not None:
+            return completion
+
+        completion = None
+        try:
+            completion = await self.backend.complete(
+                messages, max_tokens=max_tokens, stop=stop, temperature=temperature)
+            return completion
+        finally:
+            if key is not None:
+                self.cache.finish(key, completion)
+
+    async def stream(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: int = 16,
+        stop: Optional[List[str]] = None,
+        temperature: Optional[float] = 1.0
+    ) -> AsyncIterator[str]:
+        key = self.cache.get_key(messages, max_tokens, stop, temperature)
+        completion = await self._get_cached(key)
+        if completion is not None:
+            yield completion
+            return
+
+        # The deltas are passed on as they come. A stream that is closed early
+        # or fails isn't cached, and the requests waiting for it fetch their
+        # own.
+        deltas = []
+        complete = False
+        try:
+            async for delta in self.backend.stream(
+                    messages, max_tokens=max_tokens, stop=stop, temperature=temperature):
+                deltas.append(delta)
+                yield delta
+            complete = True
+        finally:
+            if key is not None:
+                self.cache.finish(key, "".join(deltas) if complete else None)
+
+    def count_tokens(self, text: str) -> int:
+        return self.backend.count_tokens(text)
+
+    def is_retryable(self, e: Exception) -> bool:
+        return self.backend.is_retryable(e)
+
+    async def _get_cached(self, key: Optional[str]) -> Optional[str]:
+        # Returns the cached completion, or the one of an identical request in
+        # flight. Otherwise, the caller leads the request for the key.
+        while key is not None:
+            completion = self.cache.completions.get(key)
+            if completion is not None:
+                metrics.backend_cache_requests.inc("hit")
+                logging.debug("Serving cached completion")
+                return completion
+
+            in_flight = self.cache.lead(key)
+            if in_flight is None:
+                metrics.backend_cache_requests.inc("miss")
+                return None
+
+            # A cancelled waiter must not cancel the request for everyone
+            # else. If the request fails, try again.
+            completion = await asyncio.shield(in_flight)
+            if completion is not None:
+                metrics.backend_cache_requests.inc("shared")
+                return completion
+
+        return None
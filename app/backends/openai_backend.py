@@ -1,13 +1,9 @@
 import openai
 from backends.backend import Backend
-from typing import Optional, List
+from typing import Optional, List, Dict, AsyncIterator
 
 
 class OpenAIBackend(Backend):
-    ROLE_SYSTEM = "system"
-    ROLE_USER = "user"
-    ROLE_ASSISTANT = "assistant"
-
     def __init__(
         self,
         api_key: str,
@@ -18,17 +14,45 @@ class OpenAIBackend(Backend):
 
     async def complete(
         self,
-        prompt: str,
+        messages: List[Dict[str, str]],
         max_tokens: int = 16,
         stop: Optional[List[str]] = None,
         temperature: Optional[float] = 1.0
     ) -> str:
         completion = await openai.ChatCompletion.acreate(
             model=self.model,
-            messages=[{"role": self.ROLE_SYSTEM, "content": prompt}],
+            messages=messages,
             max_tokens=max_tokens,
             stop=stop,
             temperature=temperature
         )
 
         return completion['choices'][0]['message']['content']
+
+    async def stream(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: int = 16,
+        stop: Optional[List[str]] = None,
+        temperature: Optional[float] = 1.0
+    ) -> AsyncIterator[str]:
+        chunks = await openai.ChatCompletion.acreate(
+            model=self.model,
+            messages=messages,
+            max_tokens=max_tokens,
+            stop=stop,
+            temperature=temperature,
+            stream=True
+        )
+
+        async for chunk in chunks:
+            content = chunk['choices'][0]['delta'].get('content')
+            if content:
+                yield content
+
+    def is_retryable(self, e: Exception) -> bool:
+        if isinstance(e, (openai.error.RateLimitError, openai.error.ServiceUnavailableError,
+                          openai.error.APIConnectionError, openai.error.Timeout, openai.error.TryAgain)):
+            return True
+
+        return isinstance(e, openai.error.APIError) and (e.http_status or 0) >= 500
@@ -0,0 +1,201 @@
+import time
+import random
+import asyncio
+import logging
+import itertools
+import metrics
+from collections import OrderedDict, deque
+from backends.backend import Backend
+from typing import Optional, List, Dict, AsyncIterator
+
+
+class BackendScheduler():
+    # Shares a backend between all sessions of the process. Limits the number
+    # of requests in flight and the token throughput, serves the sessions'
+    # queues round-robin and retries failed requests with backoff.
+    def __init__(
+        self,
+        backend: Backend,
+        max_in_flight: int = 8,
+        tokens_per_minute: Optional[int] = None,
+        max_retries: int = 5,
+        retry_base_delay: float = 1,
+        retry_max_delay: float = 30
+    ):
+        self.backend = backend
+        self.max_in_flight = max_in_flight
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+
+        self.in_flight = 0
+        self.requests = 0
+        self.retries = 0
+
+        self._queues = OrderedDict()
+        self._session_ids = itertools.count()
+        self._tokens = tokens_per_minute or 0
+        self._tokens_updated = time.monotonic()
+        self._dispatch_handle = None
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def session(self, backend: Optional[Backend] = None) -> "ScheduledBackend":
+        # The session's requests may go to a wrapper of the shared backend,
+        # still subject to the shared limits
+        return ScheduledBackend(self, next(self._session_ids), backend or self.backend)
+
+    async def acquire(self, session_id: int, tokens: int):
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(session_id, deque()).append((waiter, tokens))
+        self._dispatch()
+
+        start = time.perf_counter()
+        try:
+            await waiter
+            metrics.backend_queue_seconds.observe(metrics.elapsed(start))
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Granted just as the caller went away
+                self.release()
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    def is_retryable(self, e: Exception) -> bool:
+        return self.backend.is_retryable(e)
+
+    def get_retry_delay(self, attempt_count: int) -> float:
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt_count))
+
+    def _dispatch(self):
+        while self.in_flight < self.max_in_flight and self._queues:
+            # Serve the session at the head, then move it to the back
+            session_id, queue = next(iter(self._queues.items()))
+            waiter, tokens = queue[0]
+
+            if waiter.cancelled():
+                self._pop(session_id)
+                continue
+
+            if not self._take_tokens(tokens):
+                break
+
+            self._pop(session_id)
+            self.in_flight += 1
+            self.requests += 1
+            waiter.set_result(None)
+
+    def _pop(self, session_id: int):
+        queue = self._queues.pop(session_id)
+        queue.popleft()
+        if queue:
+            self._queues[session_id] = queue
+
+    def _take_tokens(self, tokens: int) -> bool:
+        if not self.tokens_per_minute:
+            return True
+
+        # Token bucket refilled continuously at the per-minute rate. A single
+        # request never needs more than the whole bucket.
+        now = time.monotonic()
+        rate = self.tokens_per_minute / 60
+        self._tokens = min(self.tokens_per_minute, self._tokens +
+                           (now - self._tokens_updated) * rate)
+        self._tokens_updated = now
+        tokens = min(tokens, self.tokens_per_minute)
+
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+
+        if self._dispatch_handle is None or self._dispatch_handle.cancelled():
+            self._dispatch_handle = asyncio.get_running_loop().call_later(
+                (tokens - self._tokens) / rate, self._on_tokens_refilled)
+
+        return False
+
+    def _on_tokens_refilled(self):
+        self._dispatch_handle = None
+        self._dispatch()
+
+
+class ScheduledBackend(Backend):
+    def __init__(self, scheduler: BackendScheduler, session_id: int, backend: Backend):
+        self.scheduler = scheduler
+        self.session_id = session_id
+        self.backend = backend
+
+    async def complete(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: int = 16,
+        stop: Optional[List[str]] = None,
+        temperature: Optional[float] = 1.0
+    ) -> str:
+        tokens = self._estimate_tokens(messages, max_tokens)
+
+        for attempt_count in range(self.scheduler.max_retries + 1):
+            await self.scheduler.acquire(self.session_id, tokens)
+            try:
+                return await self.backend.complete(
+                    messages, max_tokens=max_tokens, stop=stop, temperature=temperature)
+            except Exception as e:
+                if attempt_count == self.scheduler.max_retries or not self.scheduler.is_retryable(e):
+                    raise
+                self._log_retry(e)
+            finally:
+                self.scheduler.release()
+
+            await asyncio.sleep(self.scheduler.get_retry_delay(attempt_count))
+
+    async def stream(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: int = 16,
+        stop: Optional[List[str]] = None,
+        temperature: Optional[float] = 1.0
+    ) -> AsyncIterator[str]:
+        tokens = self._estimate_tokens(messages, max_tokens)
+
+        for attempt_count in range(self.scheduler.max_retries + 1):
+            started = False
+            await self.scheduler.acquire(self.session_id, tokens)
+            try:
+                async for delta in self.backend.stream(
+                        messages, max_tokens=max_tokens, stop=stop, temperature=temperature):
+                    started = True
+                    yield delta
+                return
+            except Exception as e:
+                # Once deltas have been passed on, the request can't be
+                # retried transparently
+                if started or attempt_count == self.scheduler.max_retries \
+                        or not self.scheduler.is_retryable(e):
+                    raise
+                self._log_retry(e)
+            finally:
+                self.scheduler.release()
+
+            await asyncio.sleep(self.scheduler.get_retry_delay(attempt_count))
+
+    def count_tokens(self, text: str) -> int:
+        return self.backend.count_tokens(text)
+
+    def is_retryable(self, e: Exception) -> bool:
+        return self.scheduler.is_retryable(e)
+
+    def _estimate_tokens(self, messages: List[Dict[str, str]], max_tokens: int) -> int:
+        return sum(self.count_tokens(message["content"]) for message in messages) + max_tokens
+
+    def _log_retry(self, e: Exception):
+        self.scheduler.retries += 1
+        metrics.backend_retries.inc()
+        logging.warning(
+            f"Retrying backend request: {type(e).__name__}: {e}")
@@ -0,0 +1,105 @@
+from typing import List, Optional
+
+
+class CallParser():
+    # Scans streamed text for API calls, i.e. the opening tag followed by a
+    # JSON object. Brace balance is tracked as text arrives, so that a call is
+    # known to be complete as soon as its closing brace does. Like the parsing
+    # of the complete utterance, only the first call and the calls right after
+    # it count: anything else after a call, or a call that isn't a JSON
+    # object, ends the scan.
+    def __init__(self, opening_tag: str, closing_tag: str):
+        self.opening_tag = opening_tag
+        self.closing_tag = closing_tag
+        self.text = ""
+        # (start, end) positions of the JSON of completed calls
+        self.calls = []
+        self.done = False
+
+        self._pos = 0
+        self._call_start = None
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, delta: str) -> List[str]:
+        # Returns the JSON of any calls completed by the delta
+        self.text += delta
+        completed = []
+
+        while not self.done and self._pos < len(self.text):
+            if self._call_start is None:
+                tag_pos = self._find_next_call() if self.calls else self._find_first_call()
+                if tag_pos is None:
+                    break
+
+                self._call_start = tag_pos + len(self.opening_tag)
+                self._pos = self._call_start
+
+            call_end = self._scan_json()
+            if call_end is None:
+                break
+
+            self.calls.append((self._call_start, call_end))
+            completed.append(self.text[self._call_start:call_end])
+            self._call_start = None
+
+        return completed
+
+    def _find_first_call(self) -> Optional[int]:
+        tag_pos = self.text.find(self.opening_tag, self._pos)
+        if tag_pos == -1:
+            # Rescan the tail next time in case the tag is split across deltas
+            self._pos = max(self._pos, len(self.text) - len(self.opening_tag) + 1)
+            return None
+
+        return tag_pos
+
+    def _find_next_call(self) -> Optional[int]:
+        # The previous call may be closed, then the next one must follow
+        start = pos = self._skip_space(self._pos)
+        if self.text.startswith(self.closing_tag, pos):
+            pos = self._skip_space(pos + len(self.closing_tag))
+
+        rest = self.text[pos:]
+        if rest.startswith(self.opening_tag):
+            return pos
+        if not self.opening_tag.startswith(rest) and \
+                not (pos == start and self.closing_tag.startswith(rest)):
+            self.done = True
+        # Otherwise, wait for the rest of the tag
+        return None
+
+    def _skip_space(self, pos: int) -> int:
+        while pos < len(self.text) and self.text[pos].isspace():
+            pos += 1
+        return pos
+
+    def _scan_json(self) -> Optional[int]:
+        for i in range(self._pos, len(self.text)):
+            ch = self.text[i]
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+            elif self._depth == 0 and ch != "{":
+                if not ch.isspace():
+                    # Not a JSON object; leave it to the regular parsing
+                    self.done = True
+                    return None
+            elif ch == '"':
+                self._in_string = True
+            elif ch == "{":
+                self._depth += 1
+            elif ch == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._pos = i + 1
+                    return i + 1
+
+        self._pos = len(self.text)
+        return None
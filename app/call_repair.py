@@ -0,0 +1,220 @@
+import re
+import copy
+import json
+from urllib.parse import urlsplit, urlunsplit, urljoin, parse_qsl
+from request_validator import RequestValidator, Operation, RequestValidationError
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# Local fixes for calls that the model got slightly wrong, tried before asking
+# it to correct them. Fixes are only made where the intent is unambiguous
+# given the plugin's spec.
+
+NUMBER_PATTERN = re.compile(r"-?\d+(\.\d+)?([eE][-+]?\d+)?")
+BODYLESS_METHODS = ["get", "head", "delete"]
+
+
+def repair_json(text: str) -> Optional[Dict[str, Any]]:
+    # Parses a call's JSON object that is wrapped in code fences or other
+    # text, has trailing commas, or is missing the brackets that close it.
+    # Text cut off within a string is left alone, as the value would be cut
+    # short too.
+    start = text.find("{")
+    if start == -1:
+        return None
+
+    repaired = ""
+    closers = []
+    in_string = escaped = False
+    for char in text[start:]:
+        if in_string:
+            repaired += char
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+
+        if char in "}]":
+            if char != closers[-1]:
+                break
+            repaired = repaired.rstrip().rstrip(",") + closers.pop()
+            if not closers:
+                break
+            continue
+
+        if char == '"':
+            in_string = True
+        elif char in "{[":
+            closers.append("}" if char == "{" else "]")
+        repaired += char
+
+    if in_string:
+        return None
+
+    try:
+        value = json.loads(repaired.rstrip().rstrip(",") + "".join(reversed(closers)))
+    except ValueError:
+        return None
+
+    return value if isinstance(value, dict) else None
+
+
+def repair_request(
+    validator: RequestValidator,
+    request_params: Dict[str, Any],
+    base_url: str
+) -> Tuple[Dict[str, Any], List[str]]:
+    # Returns the request with any fixes made, and a description of each.
+    # Relative server URLs in the spec are resolved against base_url.
+    request_params = copy.deepcopy(request_params)
+    fixes = []
+
+    method, url = request_params.get("method"), request_params.get("url")
+    if not isinstance(method, str) or not isinstance(url, str):
+        return request_params, fixes
+
+    # Relative URLs pass validation, but can't be sent
+    operation = find_operation(validator, method, url) if urlsplit(url).netloc else None
+    if operation is None:
+        for candidate in get_candidate_urls(validator, url, base_url):
+            operation = find_operation(validator, method, candidate)
+            if operation:
+                fixes.append(f"URL {url} -> {candidate}")
+                url = request_params["url"] = candidate
+                break
+
+    if operation is None:
+        return request_params, fixes
+
+    params = dict(request_params.get("params") or {})
+    url_query = dict(parse_qsl(urlsplit(url).query))
+    query = {**url_query, **params}
+
+    # Query parameters passed as a body, which the operation doesn't take
+    if method.lower() in BODYLESS_METHODS and operation.body_schema is None:
+        query_names = {param.name for param in operation.parameters if param.location == "query"}
+        for key in ["json", "data"]:
+            body = request_params.get(key)
+            if isinstance(body, dict) and body and set(body) <= query_names:
+                query.update(body)
+                request_params[key] = None
+                fixes.append(f"{key} -> query parameters")
+
+    for param in operation.parameters:
+        if param.location != "query":
+            continue
+
+        if param.name in query:
+            value = to_query_value(coerce(param.schema, query[param.name]))
+            if value != query[param.name]:
+                fixes.append(f"query parameter {param.name}: {query[param.name]!r} -> {value!r}")
+                query[param.name] = value
+        elif param.required and "default" in param.schema:
+            query[param.name] = to_query_value(param.schema["default"])
+            fixes.append(f"query parameter {param.name}: default {query[param.name]!r}")
+
+    if query != {**url_query, **params}:
+        # All query parameters move to params, so that none is given twice
+        request_params["params"] = query
+        request_params["url"] = urlunsplit(urlsplit(url)._replace(query=""))
+
+    body = request_params.get("json")
+    if isinstance(body, str) and operation.body_schema is not None:
+        try:
+            request_params["json"] = body = json.loads(body)
+            fixes.append("json decoded from a string")
+        except ValueError:
+            pass
+
+    if isinstance(body, dict) and operation.body_schema is not None:
+        properties = operation.body_schema.get("properties") or {}
+        for name, schema in properties.items():
+            if name in body:
+                value = coerce(schema, body[name])
+                if value != body[name] or type(value) != type(body[name]):
+                    fixes.append(f"body property {name}: {body[name]!r} -> {value!r}")
+                    body[name] = value
+            elif name in (operation.body_schema.get("required") or []) and "default" in schema:
+                body[name] = schema["default"]
+                fixes.append(f"body property {name}: default {body[name]!r}")
+
+    return request_params, fixes
+
+
+def find_operation(validator: RequestValidator, method: str, url: str) -> Optional[Operation]:
+    try:
+        return validator.find_operation(method, url)[0]
+    except RequestValidationError:
+        return None
+
+
+def get_candidate_urls(validator: RequestValidator, url: str, base_url: str) -> Iterator[str]:
+    # The URL's path on each of the spec's servers, for URLs that are
+    # relative, on another host, or missing the server's base path
+    parts = urlsplit(url)
+    path = parts.path if parts.path.startswith("/") else "/" + parts.path
+
+    for server_url in validator.server_urls:
+        server = urlsplit(urljoin(base_url, server_url))
+        base_path = server.path.rstrip("/")
+        server_path = path
+        if path != base_path and not path.startswith(base_path + "/"):
+            server_path = base_path + path
+
+        candidate = urlunsplit((server.scheme, server.netloc, server_path, parts.query, parts.fragment))
+        if candidate != url:
+            yield candidate
+
+
+def coerce(schema: Dict[str, Any], value: Any) -> Any:
+    # Converts the value to the type or enum value in the schema, where
+    # there's only one way to do so
+    schema_type = schema.get("type")
+
+    if schema_type == "array":
+        if isinstance(value, str):
+            # The default serialization of arrays in query parameters
+            value = [item.strip() for item in value.split(",")]
+        elif not isinstance(value, list):
+            value = [value]
+        return [coerce(schema.get("items") or {}, item) for item in value]
+
+    if value is None or isinstance(value, (list, dict)):
+        return value
+
+    enum = schema.get("enum")
+    if enum and value not in enum:
+        for option in enum:
+            if str(option).lower() == str(value).strip().lower():
+                return option
+
+    text = str(value).strip()
+    if schema_type == "boolean" and not isinstance(value, bool):
+        if text.lower() in ("true", "1", "yes"):
+            return True
+        if text.lower() in ("false", "0", "no"):
+            return False
+    elif schema_type == "integer" and (isinstance(value, (str, float))):
+        if NUMBER_PATTERN.fullmatch(text) and float(text).is_integer():
+            return int(float(text))
+    elif schema_type == "number" and isinstance(value, str):
+        if NUMBER_PATTERN.fullmatch(text):
+            number = float(text)
+            return int(number) if number.is_integer() and "." not in text else number
+    elif schema_type == "string" and not isinstance(value, str):
+        return str(value).lower() if isinstance(value, bool) else str(value)
+
+    return value
+
+
+def to_query_value(value: Any) -> Any:
+    # Query parameters are sent as strings, so booleans are spelled out the
+    # way the spec's validator and most servers expect
+    if isinstance(value, list):
+        return [to_query_value(item) for item in value]
+    if isinstance(value, bool):
+        return str(value).lower()
+
+    return value
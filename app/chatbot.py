@@ -1,6 +1,51 @@
+import asyncio
 import logging
+import time
+import contextlib
+import metrics
 from backends.backend import Backend
-from typing import Tuple, Callable, Coroutine, List, Optional
+from transcript import Transcript, Turn
+from typing import Tuple, Callable, Coroutine, List, Dict, Optional
+
+
+class StreamFilter():
+    # Passes streamed text through up to the first occurrence of any of the
+    # markers, holding back anything that might turn out to be the start of one
+    def __init__(self, markers: List[str]):
+        self.markers = [marker for marker in markers if marker]
+        self.text = ""
+        self.visible_len = 0
+        self.stopped = False
+
+    def feed(self, delta: str) -> str:
+        if self.stopped:
+            return ""
+
+        self.text += delta
+        visible_end = len(self.text)
+
+        for marker in self.markers:
+            pos = self.text.find(marker)
+            if pos != -1:
+                visible_end = min(visible_end, pos)
+                self.stopped = True
+
+        if not self.stopped:
+            for marker in self.markers:
+                for prefix_len in range(min(len(marker) - 1, len(self.text)), 0, -1):
+                    if self.text.endswith(marker[:prefix_len]):
+                        visible_end = min(
+                            visible_end, len(self.text) - prefix_len)
+                        break
+
+        visible = self.text[self.visible_len:visible_end]
+        if not self.visible_len:
+            visible = visible.lstrip()
+            if not visible:
+                return ""
+
+        self.visible_len = max(self.visible_len, visible_end)
+        return visible
 
 
 class Chatbot():
@@ -8,28 +53,66 @@ class Chatbot():
     STATE_REPLYING = "replying"
     STATE_ENDED = "ended"
 
+    SUMMARY_SPEAKER = "Summary"
+    SUMMARY_INSTRUCTIONS = (
+        "Summarize the conversation below for the AI to carry on with it from "
+        "the summary alone. Keep every fact that may matter later, such as "
+        "names, numbers, dates, IDs, the user's requests and preferences, and "
+        "what was done about them. Leave out anything else, including data "
+        "returned by APIs that is no longer needed. Be concise.")
+    # Turns are cut down to this many characters when summarized
+    SUMMARY_MAX_TURN_CHARS = 4000
+
     def __init__(
         self,
         backend: Backend,
         initial_prompt: str,
         utterance_coroutine: Callable[[str], Coroutine],
         state_coroutine: Optional[Callable[[str], Coroutine]] = None,
+        utterance_delta_coroutine: Optional[Callable[[str], Coroutine]] = None,
         names: Tuple[str, str] = ("AI", "Human"),
         end_token: Optional[str] = None,
-        temperature: Optional[float] = 0.9
+        temperature: Optional[float] = 0.9,
+        context_token_budget: Optional[int] = None,
+        transcript: Optional[Transcript] = None,
+        turns_coroutine: Optional[Callable[[int, List[Turn]], Coroutine]] = None,
+        summary_threshold: Optional[int] = None,
+        summary_keep_tokens: Optional[int] = None,
+        summary_max_tokens: int = 400,
+        summary_coroutine: Optional[Callable[[int, Turn], Coroutine]] = None
     ):
         self.backend = backend
-        self.prompt = initial_prompt
+        self.initial_prompt = initial_prompt.strip()
+        self.initial_prompt_tokens = backend.count_tokens(self.initial_prompt)
+        self.transcript = transcript or Transcript(backend.count_tokens)
         self.utterance_coroutine = utterance_coroutine
         self.state_coroutine = state_coroutine
+        self.utterance_delta_coroutine = utterance_delta_coroutine
+        # Receives the position and turns of each completed turn
+        self.turns_coroutine = turns_coroutine
         self.names = names
         self.end_token = end_token
         self.temperature = temperature
+        self.context_token_budget = context_token_budget
+        # Once the transcript has more than summary_threshold tokens, the turns
+        # before the last summary_keep_tokens are summarized in the background
+        self.summary_threshold = summary_threshold
+        self.summary_keep_tokens = summary_keep_tokens if summary_keep_tokens is not None \
+            else (summary_threshold or 0) // 2
+        self.summary_max_tokens = summary_max_tokens
+        # Receives the end position and the turn of each new summary
+        self.summary_coroutine = summary_coroutine
 
         self.stop = [f"{name}:" for name in names]
+        # Streamed utterance text is only forwarded up to any of these
+        self.hidden_markers = [end_token] if end_token else []
         self._state = self.STATE_LISTENING
+        self._turn_turns = []
+        self._prompt_tokens = self.initial_prompt_tokens
+        self._summary_task = None
 
-        logging.debug(f"Initialized chatbot with prompt:\n{self.prompt}")
+        logging.debug(
+            f"Initialized chatbot with prompt:\n{self.initial_prompt}")
 
     @property
     def state(self):
@@ -46,33 +129,235 @@ class Chatbot():
             raise RuntimeError(
                 f"Attempting to send responses in wrong state: {self.state}")
 
+        # A turn that doesn't complete leaves no trace in the transcript, so
+        # that its responses can be sent again
+        turn_start = self.transcript.end
+        self._turn_turns = []
         for response in responses:
             self._add_response(self.names[1], response.strip())
 
-        await self._set_state(self.STATE_REPLYING)
-        await self._get_all_utterances()
+        start = time.perf_counter()
+        try:
+            await self._set_state(self.STATE_REPLYING)
+            await self._get_all_utterances()
+
+            if self.turns_coroutine:
+                await self.turns_coroutine(turn_start, self._turn_turns)
+        except asyncio.CancelledError:
+            metrics.turn_seconds.observe(metrics.elapsed(start), "cancelled")
+            self.transcript.truncate(turn_start)
+            self._state = self.STATE_LISTENING
+            raise
+        except Exception:
+            metrics.turn_seconds.observe(metrics.elapsed(start), "error")
+            self.transcript.truncate(turn_start)
+            await self._set_state(self.STATE_LISTENING)
+            raise
+
+        metrics.turn_seconds.observe(metrics.elapsed(start), "completed")
         await self._set_state(self.STATE_LISTENING)
+        self._start_summary()
+
+    async def close(self):
+        if self._summary_task:
+            self._summary_task.cancel()
+            await asyncio.gather(self._summary_task, return_exceptions=True)
+
+    def _start_summary(self):
+        # Summaries are made between turns, while the user is typing, and
+        # don't hold up the next turn: it goes ahead with the transcript as it
+        # is if the summary isn't ready yet
+        if not self.summary_threshold or self.transcript.tokens <= self.summary_threshold:
+            return
+        if self._summary_task and not self._summary_task.done():
+            return
+
+        # Keep the latest turns up to summary_keep_tokens, starting with one
+        # of the user's, so that the transcript never starts halfway through a
+        # turn
+        turns = self.transcript.turns
+        count = len(turns)
+        tokens = 0
+        while count > 0 and tokens + turns[count - 1].tokens <= self.summary_keep_tokens:
+            count -= 1
+            tokens += turns[count].tokens
+        while count < len(turns) and turns[count].role != self.backend.ROLE_USER:
+            count += 1
+        if count == 0 or count == len(turns):
+            return
+
+        self._summary_task = asyncio.create_task(
+            self._summarize(self.transcript.evicted + count, turns[:count]))
+
+    async def _summarize(self, end: int, turns: List[Turn]):
+        lines = []
+        if self.transcript.summary:
+            lines.append(f"{self.transcript.summary.speaker}: {self.transcript.summary.text}")
+        for turn in turns:
+            text = turn.text
+            if len(text) > self.SUMMARY_MAX_TURN_CHARS:
+                text = text[:self.SUMMARY_MAX_TURN_CHARS] + "..."
+            lines.append(f"{turn.speaker}: {text}")
+
+        messages = [
+            {"role": self.backend.ROLE_SYSTEM, "content": self.SUMMARY_INSTRUCTIONS},
+            {"role": self.backend.ROLE_USER, "content": "\n\n".join(lines)}
+        ]
+
+        start = time.perf_counter()
+        try:
+            text = (await self.backend.complete(
+                messages, max_tokens=self.summary_max_tokens, temperature=0)).strip()
+        except Exception as e:
+            metrics.backend_errors.inc(type(e).__name__)
+            logging.warning(f"Error summarizing the conversation: {type(e).__name__}: {e}")
+            return
+        metrics.backend_completion_seconds.observe(metrics.elapsed(start), "summary")
+
+        if not text:
+            return
+
+        # Turns before end are never rewritten, so the summary still holds
+        # whatever happened in the meantime
+        summary = Turn(self.backend.ROLE_SYSTEM, self.SUMMARY_SPEAKER, text,
+                       self.backend.count_tokens(text) + Transcript.TOKENS_PER_TURN)
+        self.transcript.summarize(end, summary)
+        logging.debug(f"Summarized {len(turns)} turns in {summary.tokens} tokens")
+
+        if self.summary_coroutine:
+            try:
+                await self.summary_coroutine(end, summary)
+            except Exception as e:
+                logging.warning(f"Error storing the summary: {type(e).__name__}: {e}")
 
     def _add_response(self, name: str, response: str):
         log_response = f"{name}: {response}"
         logging.debug(f"Adding response: {repr(log_response)}")
-        self.prompt += f"\n{name}: {response}"
+
+        if name == self.names[0]:
+            role = self.backend.ROLE_ASSISTANT
+        elif name == self.names[1]:
+            role = self.backend.ROLE_USER
+        else:
+            role = self.backend.ROLE_SYSTEM
+
+        self._turn_turns.append(self.transcript.append(role, name, response))
+
+    def _get_initial_prompt(self) -> Tuple[str, int]:
+        # Returns the initial prompt for the next completion and its tokens
+        return self.initial_prompt, self.initial_prompt_tokens
+
+    def _get_messages(self) -> List[Dict[str, str]]:
+        initial_prompt, initial_prompt_tokens = self._get_initial_prompt()
+        summary = self.transcript.summary
+        self._prompt_tokens = initial_prompt_tokens + (summary.tokens if summary else 0)
+
+        if self.context_token_budget:
+            evicted = self.transcript.evict(
+                self.context_token_budget - self._prompt_tokens)
+            if evicted:
+                logging.debug(
+                    f"Evicted {len(evicted)} turns to fit the token budget")
+
+        messages = []
+        if initial_prompt:
+            messages.append(
+                {"role": self.backend.ROLE_SYSTEM, "content": initial_prompt})
+
+        if summary:
+            messages.append({
+                "role": summary.role,
+                "content": f"Summary of the earlier conversation: {summary.text}"
+            })
+
+        omitted = self.transcript.evicted - self.transcript.summary_end
+        if omitted:
+            messages.append({
+                "role": self.backend.ROLE_SYSTEM,
+                "content": f"({omitted} earlier messages of the conversation are omitted)"
+            })
+
+        for turn in self.transcript:
+            # User and AI turns are told apart by their roles. Anyone else is
+            # named explicitly, as in the prompt's examples.
+            content = turn.text if turn.role != self.backend.ROLE_SYSTEM \
+                else f"{turn.speaker}: {turn.text}"
+            messages.append({"role": turn.role, "content": content})
+
+        return messages
 
     async def _get_all_utterances(self):
-        utterance = await self._get_next_utterance(self.temperature)
+        utterance = await self._get_next_utterance(self.temperature, stream=True)
 
         if utterance:
             await self.utterance_coroutine(utterance)
 
         self._add_response(self.names[0], utterance)
 
-    async def _get_next_utterance(self, temperature: float) -> str:
-        utterance = await self.backend.complete(
-            self.prompt + f"\n{self.names[0]}:",
-            max_tokens=750,
-            stop=self.stop,
-            temperature=temperature
-        )
+    async def _get_next_utterance(
+        self,
+        temperature: float,
+        stream: bool = False,
+        on_delta: Optional[Callable[[str], bool]] = None,
+        extra_messages: Optional[List[Dict[str, str]]] = None
+    ) -> str:
+        # If stream is set, visible text is forwarded to the client as it is
+        # generated. on_delta sees every delta and can cut the generation short
+        # by returning True. extra_messages follow the transcript in this
+        # prompt only.
+        messages = self._get_messages() + (extra_messages or [])
+        stream = stream and self.utterance_delta_coroutine is not None
+        start = time.perf_counter()
+
+        try:
+            if stream or on_delta:
+                mode = "stream"
+                stream_filter = StreamFilter(self.hidden_markers)
+                deltas = []
+
+                async with contextlib.aclosing(self.backend.stream(
+                    messages,
+                    max_tokens=750,
+                    stop=self.stop,
+                    temperature=temperature
+                )) as backend_stream:
+                    async for delta in backend_stream:
+                        if not deltas:
+                            metrics.backend_first_token_seconds.observe(
+                                metrics.elapsed(start))
+                        deltas.append(delta)
+
+                        if stream:
+                            visible_delta = stream_filter.feed(delta)
+                            if visible_delta:
+                                await self.utterance_delta_coroutine(visible_delta)
+
+                        if on_delta and on_delta(delta):
+                            break
+
+                utterance = "".join(deltas)
+            else:
+                mode = "complete"
+                utterance = await self.backend.complete(
+                    messages,
+                    max_tokens=750,
+                    stop=self.stop,
+                    temperature=temperature
+                )
+        except Exception as e:
+            metrics.backend_errors.inc(type(e).__name__)
+            raise
+
+        metrics.backend_completion_seconds.observe(
+            metrics.elapsed(start), mode)
+        if metrics.registry.enabled:
+            # The prompt's tokens are known from the transcript, while the
+            # completion's have to be counted
+            metrics.backend_prompt_tokens.observe(
+                self._prompt_tokens + self.transcript.tokens)
+            metrics.backend_completion_tokens.observe(
+                self.backend.count_tokens(utterance))
+
         utterance = utterance.strip()
         logging.debug(f"Got utterance: {repr(utterance)}")
 
@@ -0,0 +1,87 @@
+import time
+from collections import deque
+from typing import Optional
+
+
+class CircuitBreaker():
+    # Tracks the outcomes of a plugin's API requests over a rolling window.
+    # Once too many of them fail, the circuit opens and requests are failed
+    # locally instead of waiting for the plugin to time out. After
+    # open_seconds, the circuit is half-open: a probe request decides whether
+    # it closes again or stays open for another open_seconds.
+    STATE_CLOSED = "closed"
+    STATE_OPEN = "open"
+    STATE_HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        window_seconds: float = 60,
+        min_requests: int = 5,
+        error_rate: float = 0.5,
+        open_seconds: float = 30,
+        slow_call_seconds: Optional[float] = None
+    ):
+        self.window_seconds = window_seconds
+        self.min_requests = min_requests
+        self.error_rate_threshold = error_rate
+        self.open_seconds = open_seconds
+        # Requests slower than this count as failed
+        self.slow_call_seconds = slow_call_seconds
+
+        self.state = self.STATE_CLOSED
+        self.opened_at = None
+        # Time, failure and duration of the requests in the window
+        self._outcomes = deque()
+
+    @property
+    def available(self) -> bool:
+        return self.state == self.STATE_CLOSED
+
+    @property
+    def error_rate(self) -> float:
+        self._expire()
+        if not self._outcomes:
+            return 0
+        return sum(failed for _, failed, _ in self._outcomes) / len(self._outcomes)
+
+    @property
+    def latency(self) -> float:
+        # Mean request duration over the window, in seconds
+        self._expire()
+        if not self._outcomes:
+            return 0
+        return sum(seconds for _, _, seconds in self._outcomes) / len(self._outcomes)
+
+    def record(self, failed: bool, seconds: float) -> bool:
+        # Returns whether the request opened the circuit
+        if self.slow_call_seconds is not None and seconds > self.slow_call_seconds:
+            failed = True
+
+        self._outcomes.append((time.monotonic(), failed, seconds))
+        # Requests that have left the window don't count towards min_requests
+        self._expire()
+        if self.state != self.STATE_CLOSED or len(self._outcomes) < self.min_requests:
+            return False
+
+        if self.error_rate >= self.error_rate_threshold:
+            self.open()
+            return True
+
+        return False
+
+    def open(self):
+        self.state = self.STATE_OPEN
+        self.opened_at = time.monotonic()
+
+    def half_open(self):
+        self.state = self.STATE_HALF_OPEN
+
+    def close(self):
+        self.state = self.STATE_CLOSED
+        self.opened_at = None
+        self._outcomes.clear()
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._outcomes and now - self._outcomes[0][0] > self.window_seconds:
+            self._outcomes.popleft()
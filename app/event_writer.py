@@ -0,0 +1,137 @@
+import time
+import orjson
+import asyncio
+import logging
+import metrics
+from collections import deque
+from websockets.exceptions import ConnectionClosed
+from typing import Any, Dict, List, Union
+
+
+def encode(value: Union[Dict[str, Any], List[Dict[str, Any]]]) -> str:
+    return orjson.dumps(value).decode("utf-8")
+
+
+class EventWriter():
+    # Sends a connection's events from a queue of its own, so that a client
+    # that reads slowly holds up the writer rather than the chatbot. Events
+    # queued while a frame is being sent go out together in the next one, as
+    # a JSON array, to clients that asked for batches; deltas queued back to
+    # back are merged either way. A client that falls more than
+    # max_queued_events behind is dealt with per the slow client policy:
+    # "drop_deltas" drops the queued deltas, which the complete utterance
+    # supersedes, and disconnects only if that isn't enough, while
+    # "disconnect" closes the connection right away.
+    POLICY_DROP_DELTAS = "drop_deltas"
+    POLICY_DISCONNECT = "disconnect"
+    DELTA_TYPE = "utterance_delta"
+    # How long close() waits for the queued events to be sent
+    CLOSE_TIMEOUT = 5
+    SLOW_CLIENT_CLOSE_CODE = 1008
+
+    def __init__(
+        self,
+        websocket,
+        batch: bool = False,
+        max_queued_events: int = 1000,
+        slow_client_policy: str = POLICY_DROP_DELTAS
+    ):
+        if slow_client_policy not in [self.POLICY_DROP_DELTAS, self.POLICY_DISCONNECT]:
+            raise ValueError(f"Unknown slow client policy: {slow_client_policy}")
+
+        self.websocket = websocket
+        self.batch = batch
+        self.max_queued_events = max_queued_events
+        self.slow_client_policy = slow_client_policy
+
+        self._events = deque()
+        self._queued = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._closed = False
+        self._close_task = None
+        self._task = asyncio.create_task(self._run())
+
+    def send(self, event: Dict[str, Any]):
+        if self._closed:
+            return
+
+        last = self._events[-1] if self._events else None
+        if event["type"] == self.DELTA_TYPE and last and last["type"] == self.DELTA_TYPE \
+                and last["source"] == event["source"]:
+            self._events[-1] = {**last, "text": last["text"] + event["text"]}
+        else:
+            self._events.append(event)
+
+        if len(self._events) > self.max_queued_events:
+            self._overflow()
+            if self._closed:
+                return
+
+        self._drained.clear()
+        self._queued.set()
+
+    async def close(self):
+        # Sends the queued events, then closes the connection
+        if not self._closed:
+            self._closed = True
+            if not self.websocket.closed:
+                try:
+                    await asyncio.wait_for(self._drained.wait(), self.CLOSE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    logging.warning(f"Closing with {len(self._events)} events unsent")
+
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        await (self._close_task or self.websocket.close())
+
+    async def _run(self):
+        try:
+            while True:
+                await self._queued.wait()
+                self._queued.clear()
+                # Events sent in the same go, such as a state change and an
+                # utterance, join the batch
+                await asyncio.sleep(0)
+
+                while self._events:
+                    metrics.websocket_queued_events.observe(len(self._events))
+                    if self.batch:
+                        events = list(self._events)
+                        self._events.clear()
+                        value = events[0] if len(events) == 1 else events
+                        label = events[0]["type"] if len(events) == 1 else "batch"
+                    else:
+                        value = self._events.popleft()
+                        label = value["type"]
+
+                    start = time.perf_counter()
+                    await self.websocket.send(encode(value))
+                    metrics.websocket_send_seconds.observe(metrics.elapsed(start), label)
+
+                self._drained.set()
+        except ConnectionClosed:
+            self._events.clear()
+            self._drained.set()
+
+    def _overflow(self):
+        if self.slow_client_policy == self.POLICY_DROP_DELTAS:
+            events = deque(event for event in self._events if event["type"] != self.DELTA_TYPE)
+            dropped = len(self._events) - len(events)
+            if dropped:
+                metrics.websocket_dropped_events.inc(amount=dropped)
+                logging.debug(f"Client is falling behind, dropped {dropped} deltas")
+            self._events = events
+            if len(self._events) <= self.max_queued_events:
+                return
+
+        logging.warning(f"Disconnecting a client that fell {len(self._events)} events behind")
+        metrics.websocket_slow_client_disconnects.inc()
+        metrics.websocket_dropped_events.inc(amount=len(self._events))
+        self._closed = True
+        self._events.clear()
+        self._drained.set()
+        # The writer may be stuck sending to the client
+        self._task.cancel()
+        self._close_task = asyncio.create_task(
+            self.websocket.close(self.SLOW_CLIENT_CLOSE_CODE, "Client too slow"))
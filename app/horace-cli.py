@@ -2,9 +2,8 @@ import argparse
 import json
 import asyncio
 import websockets
-from urllib.parse import urlunsplit
-from aioconsole import ainput, aprint
-from colorama import Fore, Style
+from urllib.parse import urlunsplit, urlencode
+from typing import Any, AsyncIterator, Dict
 
 
 STATE_LISTENING = "listening"
@@ -12,24 +11,60 @@ STATE_REPLYING = "replying"
 STATE_ENDED = "ended"
 
 
+async def receive(websocket) -> AsyncIterator[Dict[str, Any]]:
+    # Events sent together arrive as a JSON array
+    async for message in websocket:
+        events = json.loads(message)
+        for event in events if isinstance(events, list) else [events]:
+            yield event
+
+
 async def client(uri):
     async with websockets.connect(uri) as websocket:
+        events = receive(websocket)
+
+        # The console libraries load while the server opens the session
+        from aioconsole import ainput, aprint
+        from colorama import Fore, Style
+
+        event = await anext(events)
+        if event["type"] == "session":
+            status = "Resumed" if event["resumed"] else "Started"
+            await aprint(Fore.CYAN + f'{status} session {event["session_id"]}' + Style.RESET_ALL)
+
         while True:
             utterance = await ainput(Fore.MAGENTA + "Your input -> " + Fore.YELLOW)
             await websocket.send(json.dumps({"type": "utterance", "text": utterance.strip()}))
 
+            streamed_text = ""
             while True:
-                message = await websocket.recv()
-                event = json.loads(message)
+                event = await anext(events)
 
                 if event["type"] == "state":
                     if event["state"] == STATE_LISTENING:
                         break
                     elif event["state"] == STATE_ENDED:
                         return
+                elif event["type"] == "utterance_delta":
+                    streamed_text += event["text"]
+                    await aprint(Fore.BLUE + event["text"] + Style.RESET_ALL, end="", flush=True)
                 elif event["type"] == "utterance":
+                    if streamed_text:
+                        # The complete utterance supersedes the streamed text;
+                        # only print it again if it differs
+                        await aprint()
+                        is_streamed = event["source"] == "ai" and event["text"] == streamed_text.strip()
+                        streamed_text = ""
+                        if is_streamed:
+                            continue
+
                     await aprint((Fore.GREEN if event["source"] == "system" else Fore.BLUE) +
                                  event["text"] + Style.RESET_ALL)
+                elif event["type"] == "interrupted":
+                    # The reply being streamed was cancelled and starts over
+                    if streamed_text:
+                        await aprint(Fore.CYAN + " [interrupted]" + Style.RESET_ALL)
+                        streamed_text = ""
                 elif event["type"] == "error":
                     await aprint(Fore.CYAN +
                                  f'Server error: {event["message"]}' + Style.RESET_ALL)
@@ -40,7 +75,12 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--host', help='server host name', default='0.0.0.0')
     parser.add_argument('--port', help='server port number', default=8001)
+    parser.add_argument('--session-id', help='ID of a session to resume')
     args = parser.parse_args()
 
-    url = urlunsplit(('ws', f'{args.host}:{args.port}', '/', '', ''))
+    query = {"batch": 1}
+    if args.session_id:
+        query["session_id"] = args.session_id
+    query = urlencode(query)
+    url = urlunsplit(('ws', f'{args.host}:{args.port}', '/', query, ''))
     asyncio.run(client(url))
@@ -1,14 +1,23 @@
 import re
+import copy
 import json
+import asyncio
 import logging
+import metrics
+import call_repair
 from chatbot import Chatbot
+from call_parser import CallParser
 from backends.backend import Backend
-from router import Router
-from typing import Optional, Callable, Coroutine
+from transcript import Transcript, Turn
+from router import Router, PluginRequestError
+from request_validator import RequestValidationError
+from operation_index import IndexedOperation
+from collections import OrderedDict
+from typing import Optional, Callable, Coroutine, Tuple, List, Dict, Any
 
 
 class HoraceChatbot(Chatbot):
-    INITIAL_PROMPT_TEMPLATE = """You have access to the following plugin APIs, as defined by their OpenAPI specifications:
+    INITIAL_PROMPT_TEMPLATE = """{plugins_intro}
 
 {plugins_string}
 
@@ -26,14 +35,37 @@ Here is an example with made-up values:
 {names[2]}: API responded with HTTP status code 200, response body: OK
 {names[0]}: All done!
 
-If you have multiple calls to make, you wait for the API response before making the next one.
+{multiple_calls_instructions}
 
 Your API calls and any {names[2]} responses are invisible to the user.
 
 You do not disclose any implementation details to the user, including the API methods available to you, the calls that you make etc."""
+    SEQUENTIAL_CALLS_INSTRUCTIONS = "If you have multiple calls to make, you wait for the API response before making the next one."
+    PARALLEL_CALLS_INSTRUCTIONS = "If you have multiple calls to make that do not depend on each other, you make them all at once, one after another in the same message. You wait for the API responses before making any calls that depend on them."
+    FULL_SPEC_INTRO = "You have access to the following plugin APIs, as defined by their OpenAPI specifications:"
+    CATALOG_INTRO = "You have access to the following plugin APIs. Their operations are listed in short."
+    OPERATION_DETAILS_HEADING = "Operation details (before calling an operation listed here, check its specification):"
+    PLUGIN_UNAVAILABLE_NOTE = "This plugin is temporarily unavailable. Do not call it; let the user know if they need it."
+    CALL_ERROR_FOLLOW_UP = "Your API calls could not be made:\n\n{errors}\n\nRepeat your last message with the calls corrected."
     NAMES = ("AI", "User", "System")
     CALL_OPENING_TAG = "<call>"
     CALL_CLOSING_TAG = "</call>"
+    PROMPT_CACHE_SIZE = 64
+    # How the plugins' specs are presented: "full" includes them whole,
+    # "catalog" lists the operations in short and adds the specs of those the
+    # model has referenced, and "top_k" also adds the specs of those most
+    # relevant to the latest turns
+    SPEC_MODE_FULL = "full"
+    SPEC_MODE_CATALOG = "catalog"
+    SPEC_MODE_TOP_K = "top_k"
+    # Turns matched against the operations in top_k mode
+    RELEVANCE_TURNS = 4
+
+    # Rendered prompt parts shared by all sessions in the process. Plugin
+    # blocks are keyed by plugin name and definition hash, initial prompts by
+    # the registry contents and extra instructions.
+    _plugin_blocks = OrderedDict()
+    _initial_prompts = OrderedDict()
 
     def __init__(
         self,
@@ -41,112 +73,445 @@ You do not disclose any implementation details to the user, including the API me
         router: Router,
         utterance_coroutine: Callable[[str, Optional[bool]], Coroutine],
         state_coroutine: Optional[Callable[[str], Coroutine]] = None,
+        utterance_delta_coroutine: Optional[Callable[[str], Coroutine]] = None,
         extra_instructions: Optional[str] = None,
         temperature: Optional[float] = 0.9,
         retry_temperature: Optional[float] = 0.9,
         max_validation_retries: int = 0,
+        repair_calls: bool = True,
+        parallel_calls: bool = False,
+        spec_mode: str = SPEC_MODE_FULL,
+        spec_top_k: int = 5,
+        context_token_budget: Optional[int] = None,
+        transcript: Optional[Transcript] = None,
+        turns_coroutine: Optional[Callable[[int, List[Turn]], Coroutine]] = None,
+        summary_threshold: Optional[int] = None,
+        summary_keep_tokens: Optional[int] = None,
+        summary_max_tokens: int = 400,
+        summary_coroutine: Optional[Callable[[int, Turn], Coroutine]] = None,
         debug_mode: bool = False
     ):
-        prompt_blocks = []
-        if extra_instructions:
-            prompt_blocks.append(extra_instructions)
-
-        plugin_blocks = []
-        for name, plugin in router.registry.items():
-            plugin_blocks.append(f"""plugin_human_name: {plugin["manifest"]["name_for_human"]}
-plugin_human_description: {plugin["manifest"]["description_for_human"]}
-plugin_system_name: {name}
-{plugin["manifest"]["description_for_model"]}
-{json.dumps(plugin["spec_dict"])}""")
-
-        if plugin_blocks:
-            prompt_blocks.append(self.INITIAL_PROMPT_TEMPLATE.format(
-                names=self.NAMES,
-                call_opening_tag=self.CALL_OPENING_TAG,
-                call_closing_tag=self.CALL_CLOSING_TAG,
-                plugins_string="\n\n".join(plugin_blocks)
-            ))
-
         super().__init__(
             backend=backend,
-            initial_prompt="\n\n".join(prompt_blocks) + "\n",
+            initial_prompt=self.get_initial_prompt(
+                router.registry, extra_instructions, parallel_calls, spec_mode, router.unavailable_plugins),
             utterance_coroutine=utterance_coroutine,
             state_coroutine=state_coroutine,
+            utterance_delta_coroutine=utterance_delta_coroutine,
             names=self.NAMES,
-            temperature=temperature
+            temperature=temperature,
+            context_token_budget=context_token_budget,
+            transcript=transcript,
+            turns_coroutine=turns_coroutine,
+            summary_threshold=summary_threshold,
+            summary_keep_tokens=summary_keep_tokens,
+            summary_max_tokens=summary_max_tokens,
+            summary_coroutine=summary_coroutine
         )
 
         self.router = router
+        self.extra_instructions = extra_instructions
         self.retry_temperature = retry_temperature
         self.max_validation_retries = max_validation_retries
+        self.repair_calls = repair_calls
+        self.parallel_calls = parallel_calls
+        self.spec_mode = spec_mode
+        self.spec_top_k = spec_top_k
         self.debug_mode = debug_mode
-        self.stop.append(self.CALL_CLOSING_TAG)
+        # Operations the model has called or mentioned, most recent last
+        self._referenced_operations = OrderedDict()
+        self._snippet_tokens = {}
+        # The prompt is rendered from the registry the session started with,
+        # and again whenever a plugin becomes unavailable or available
+        self._registry = router.registry
+        self._unavailable_plugins = router.unavailable_plugins
+        self.hidden_markers.append(self.CALL_OPENING_TAG)
+
+        # With parallel calls, the model may make several calls in one
+        # utterance, so it can't be stopped at the end of the first one
+        if not parallel_calls:
+            self.stop.append(self.CALL_CLOSING_TAG)
+
+        if spec_mode not in [self.SPEC_MODE_FULL, self.SPEC_MODE_CATALOG, self.SPEC_MODE_TOP_K]:
+            raise ValueError(f"Unknown spec mode: {spec_mode}")
+
+    @classmethod
+    def get_initial_prompt(
+        cls,
+        registry: Dict[str, Dict[str, Any]],
+        extra_instructions: Optional[str] = None,
+        parallel_calls: bool = False,
+        spec_mode: str = SPEC_MODE_FULL,
+        unavailable_plugins: frozenset = frozenset()
+    ) -> str:
+        # Outside full mode, the plugin blocks are the same catalogs whatever
+        # the mode
+        full_spec = spec_mode == cls.SPEC_MODE_FULL
+        unavailable_plugins = unavailable_plugins & registry.keys()
+        key = (tuple((name, plugin["hash"])
+               for name, plugin in registry.items()), extra_instructions, parallel_calls, full_spec,
+               frozenset(unavailable_plugins))
+        initial_prompt = cls._get_cached(cls._initial_prompts, key)
+
+        if initial_prompt is None:
+            prompt_blocks = []
+            if extra_instructions:
+                prompt_blocks.append(extra_instructions)
+
+            # Plugins that are failing are marked as such, so that the model
+            # stops planning calls to them
+            plugin_blocks = [cls._get_plugin_block(name, plugin, full_spec) +
+                             (f"\n{cls.PLUGIN_UNAVAILABLE_NOTE}" if name in unavailable_plugins else "")
+                             for name, plugin in registry.items()]
+            if plugin_blocks:
+                prompt_blocks.append(cls.INITIAL_PROMPT_TEMPLATE.format(
+                    plugins_intro=cls.FULL_SPEC_INTRO if full_spec else cls.CATALOG_INTRO,
+                    names=cls.NAMES,
+                    call_opening_tag=cls.CALL_OPENING_TAG,
+                    call_closing_tag=cls.CALL_CLOSING_TAG,
+                    multiple_calls_instructions=cls.PARALLEL_CALLS_INSTRUCTIONS
+                    if parallel_calls else cls.SEQUENTIAL_CALLS_INSTRUCTIONS,
+                    plugins_string="\n\n".join(plugin_blocks)
+                ))
+
+            initial_prompt = "\n\n".join(prompt_blocks) + "\n"
+            cls._set_cached(cls._initial_prompts, key, initial_prompt)
+
+        return initial_prompt
+
+    @classmethod
+    def _get_plugin_block(cls, name: str, plugin: Dict[str, Any], full_spec: bool = True) -> str:
+        key = (name, plugin["hash"], full_spec)
+        plugin_block = cls._get_cached(cls._plugin_blocks, key)
+
+        if plugin_block is None:
+            if full_spec:
+                spec_string = json.dumps(plugin["spec_dict"])
+            else:
+                lines = []
+                servers = plugin["spec_dict"].get("servers") or []
+                if servers:
+                    lines.append(f"Base URL: {servers[0]['url']}")
+                lines.append("Operations:")
+                lines += [f"- {operation.operation_id}: {operation.method} {operation.path} - {operation.summary}"
+                          for operation in plugin["operations"]]
+                spec_string = "\n".join(lines)
+
+            plugin_block = f"""plugin_human_name: {plugin["manifest"]["name_for_human"]}
+plugin_human_description: {plugin["manifest"]["description_for_human"]}
+plugin_system_name: {name}
+{plugin["manifest"]["description_for_model"]}
+{spec_string}"""
+            cls._set_cached(cls._plugin_blocks, key, plugin_block)
+
+        return plugin_block
+
+    def _get_initial_prompt(self) -> Tuple[str, int]:
+        unavailable_plugins = self.router.unavailable_plugins
+        if unavailable_plugins != self._unavailable_plugins:
+            self._unavailable_plugins = unavailable_plugins
+            self.initial_prompt = self.get_initial_prompt(
+                self._registry, self.extra_instructions, self.parallel_calls, self.spec_mode,
+                unavailable_plugins).strip()
+            self.initial_prompt_tokens = self.backend.count_tokens(self.initial_prompt)
+
+        if self.spec_mode == self.SPEC_MODE_FULL:
+            return super()._get_initial_prompt()
+
+        operations = self._get_relevant_operations()
+        if not operations:
+            return super()._get_initial_prompt()
+
+        # The details go at the end, so that the prompt up to them stays the
+        # same from one completion to the next
+        snippets = [f"{operation.plugin}: {operation.snippet}" for operation in operations]
+        tokens = self.initial_prompt_tokens + \
+            sum(self._count_snippet_tokens(snippet) for snippet in snippets)
+        initial_prompt = "\n\n".join(
+            [self.initial_prompt, self.OPERATION_DETAILS_HEADING + "\n" + "\n".join(snippets)])
+
+        return initial_prompt, tokens
+
+    def _get_relevant_operations(self) -> List[IndexedOperation]:
+        index = self.router.operation_index
+        operations = {}
+        for key in reversed(self._referenced_operations):
+            operation = index.get(*key)
+            if operation:
+                operations[key] = operation
+
+        if self.spec_mode == self.SPEC_MODE_TOP_K:
+            # API responses are left out of the match, as they tend to be
+            # long and repetitive
+            recent_text = " ".join(turn.text for turn in list(self.transcript)[-self.RELEVANCE_TURNS:]
+                                   if turn.speaker != self.names[2])
+            for operation in index.search(recent_text, self.spec_top_k):
+                operations.setdefault((operation.plugin, operation.operation_id), operation)
+
+        # A stable order keeps the prompt the same while the selection is
+        return sorted((o for o in operations.values() if o.plugin not in self._unavailable_plugins),
+                      key=lambda o: (o.plugin, o.path, o.method))
+
+    def _reference_operations(self, text: str, calls: List[Dict[str, Any]]):
+        # Notes the operations called, or mentioned by ID in the text outside
+        # the calls, so that their specs are included from now on
+        if self.spec_mode == self.SPEC_MODE_FULL:
+            return
+
+        keys = [(operation.plugin, operation.operation_id)
+                for operation in self.router.operation_index.operations.values()
+                if self._mentions(text, operation.operation_id)]
+
+        for call in calls:
+            call_dict = call.get("dict")
+            if not isinstance(call_dict, dict):
+                continue
+
+            plugin_name = call_dict.get("plugin_system_name")
+            request_params = call_dict.get("request_object_params")
+            validator = (self.router.registry.get(plugin_name) or {}).get("validator")
+            if not validator or not isinstance(request_params, dict):
+                continue
+
+            try:
+                operation, _ = validator.find_operation(
+                    str(request_params.get("method", "")), str(request_params.get("url", "")))
+            except RequestValidationError:
+                continue
+
+            keys.append((plugin_name, operation.operation_dict.get(
+                "operationId") or f"{operation.method.upper()} {operation.path}"))
+
+        for key in keys:
+            self._referenced_operations[key] = True
+            self._referenced_operations.move_to_end(key)
+        while len(self._referenced_operations) > self.spec_top_k:
+            self._referenced_operations.popitem(last=False)
+
+    @staticmethod
+    def _mentions(text: str, operation_id: str) -> bool:
+        # IDs that are plain words, such as "list", can't be told apart from
+        # the rest of the text, so those operations are only referenced once
+        # called
+        if re.fullmatch(r"[a-z]+", operation_id):
+            return False
+
+        return re.search(r"(?<![\w/-])" + re.escape(operation_id) + r"(?![\w/-])", text) is not None
+
+    def _count_snippet_tokens(self, snippet: str) -> int:
+        tokens = self._snippet_tokens.get(snippet)
+        if tokens is None:
+            tokens = self._snippet_tokens[snippet] = self.backend.count_tokens(snippet)
+
+        return tokens
+
+    @classmethod
+    def _get_cached(cls, cache: OrderedDict, key) -> Optional[str]:
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+
+        return value
+
+    @classmethod
+    def _set_cached(cls, cache: OrderedDict, key, value: str):
+        cache[key] = value
+        if len(cache) > cls.PROMPT_CACHE_SIZE:
+            cache.popitem(last=False)
 
     async def _get_all_utterances(self):
-        prepared_request_params = None
+        send_tasks = {}
+        follow_up = None
+
+        try:
+            for attempt_count in range(self.max_validation_retries + 1):
+                if attempt_count > 0:
+                    metrics.validation_retries.inc()
+                temperature = self.retry_temperature if attempt_count > 0 else self.temperature
+                call_parser = CallParser(self.CALL_OPENING_TAG, self.CALL_CLOSING_TAG)
+
+                def on_delta(delta: str) -> bool:
+                    completed = call_parser.feed(delta)
+                    if not self.parallel_calls:
+                        # Stop generating as soon as the call is complete
+                        return bool(completed)
+
+                    # Dispatch each call as soon as it is complete, while the
+                    # model carries on generating the next one
+                    for call_json in completed:
+                        call = self._prepare_call(call_json.strip())
+                        if "request" in call:
+                            send_tasks[call["json"]] = self._dispatch(call)
+
+                    return False
+
+                # Only the first attempt is streamed to the user. The complete
+                # utterance sent at the end supersedes any streamed text.
+                utterance = await self._get_next_utterance(
+                    temperature, stream=attempt_count == 0, on_delta=on_delta, extra_messages=follow_up)
+                stripped_utterance, utterance, calls = self._parse_calls(
+                    utterance)
+                self._reference_operations(stripped_utterance, calls)
 
-        for attempt_count in range(self.max_validation_retries + 1):
-            temperature = self.retry_temperature if attempt_count > 0 else self.temperature
-            utterance = await self._get_next_utterance(temperature)
+                if self.debug_mode:
+                    await self.utterance_coroutine(utterance)
+
+                for call in calls:
+                    if "error" not in call:
+                        call_json = call["json"]
+                        call.update(self._prepare_call(
+                            call["json"], call["dict"]))
+                        if call["json"] != call_json:
+                            # The model sees the call that was made, rather
+                            # than repeat the mistake
+                            utterance = utterance.replace(
+                                self.CALL_OPENING_TAG + call_json + self.CALL_CLOSING_TAG,
+                                self.CALL_OPENING_TAG + call["json"] + self.CALL_CLOSING_TAG, 1)
+
+                    if "error" in call:
+                        logging.error(call["error"])
+                        if self.debug_mode:
+                            await self.utterance_coroutine(call["error"], is_system=True)
+                    elif call["json"] not in send_tasks:
+                        # Dispatch the request right away, so that it is in
+                        # flight while the utterance is being delivered
+                        send_tasks[call["json"]] = self._dispatch(call)
+
+                if not calls or any("request" in call for call in calls):
+                    break
 
-            m = re.match(
-                r"(.*?)($|" + re.escape(self.CALL_OPENING_TAG) + r"(.*))", utterance, re.DOTALL)
-            stripped_utterance = m[1].strip()
-            call_json = m[3]
+                # None of the calls could be repaired locally, so the retry
+                # shows the model its calls and what was wrong with them,
+                # without adding either to the transcript
+                errors = "\n".join(call["error"] for call in calls)
+                follow_up = [
+                    {"role": self.backend.ROLE_ASSISTANT, "content": utterance},
+                    {"role": self.backend.ROLE_SYSTEM, "content": f"{self.names[2]}: " +
+                     self.CALL_ERROR_FOLLOW_UP.format(errors=errors)}
+                ]
 
-            if self.debug_mode:
-                await self.utterance_coroutine(utterance)
+            if calls:
+                metrics.calls_per_utterance.observe(len(calls))
 
-            if call_json:
-                logging.debug(f"Processing API call: {repr(call_json)}")
+            if stripped_utterance and not self.debug_mode:
+                await self.utterance_coroutine(stripped_utterance)
 
-                try:
-                    try:
-                        call_dict, ind = json.JSONDecoder().raw_decode(call_json)
-                    except json.decoder.JSONDecodeError:
-                        raise ValueError(f"Malformed JSON: {repr(call_json)}")
-
-                    truncate_len = len(call_json) - ind
-                    if truncate_len:
-                        # Truncate the utterance so that it correctly ends with
-                        # the JSON
-                        utterance = utterance[:-truncate_len]
-
-                    prepared_request_params = self.router.prepare(
-                        call_dict["plugin_system_name"], call_dict["request_object_params"])
-                except Exception as e:
-                    result = str(e)
-                    logging.error(e)
+            self._add_response(self.names[0], utterance)
 
+            results = []
+            for call in calls:
+                if "request" in call:
+                    result = await send_tasks[call["json"]]
                     if self.debug_mode:
                         await self.utterance_coroutine(result, is_system=True)
-                finally:
-                    # Add back the closing call tag to the utterance - it's not
-                    # generated due to self.stop
-                    utterance += self.CALL_CLOSING_TAG
+                else:
+                    result = call["error"]
 
-                if prepared_request_params:
-                    break
+                results.append(result)
+        finally:
+            for send_task in send_tasks.values():
+                send_task.cancel()
+
+        if results:
+            if len(results) == 1:
+                result = results[0]
             else:
-                break
+                result = "\n\n".join(f"Call {i + 1}: {result}"
+                                      for i, result in enumerate(results))
 
-        if stripped_utterance and not self.debug_mode:
-            await self.utterance_coroutine(stripped_utterance)
+            self._add_response(self.names[2], result)
+            await self._get_all_utterances()
 
-        self._add_response(self.names[0], utterance)
+    def _parse_calls(self, utterance: str) -> Tuple[str, str, List[Dict[str, Any]]]:
+        # Splits the utterance into the text visible to the user and the calls
+        # that follow it. Also returns the utterance as it should go into the
+        # transcript: the visible text followed by the calls, each correctly
+        # closed, with anything else dropped.
+        m = re.match(
+            r"(.*?)($|" + re.escape(self.CALL_OPENING_TAG) + r"(.*))", utterance, re.DOTALL)
+        stripped_utterance = m[1].strip()
+        if m[3] is None:
+            return stripped_utterance, utterance, []
+
+        calls = []
+        transcript_utterance = m[1]
+        rest = m[3]
+        while True:
+            rest = rest.lstrip()
+            logging.debug(f"Processing API call: {repr(rest)}")
+
+            try:
+                call_dict, ind = json.JSONDecoder().raw_decode(rest)
+                call_json = rest[:ind]
+            except json.decoder.JSONDecodeError:
+                # The call ends at its closing tag, if it has one
+                ind = len(rest.split(self.CALL_CLOSING_TAG, 1)[0])
+                call_dict = call_repair.repair_json(rest[:ind]) if self.repair_calls else None
+                if call_dict is None:
+                    if self.repair_calls:
+                        metrics.call_json_repairs.inc("failed")
+                    calls.append({"json": rest, "error": f"Malformed JSON: {repr(rest)}"})
+                    transcript_utterance += self.CALL_OPENING_TAG + rest + self.CALL_CLOSING_TAG
+                    break
 
-        if call_json:
-            if prepared_request_params:
-                status_code, text = await self.router.send(prepared_request_params)
-                logging.debug(
-                    f"Got router response: {repr((status_code, text))}")
+                metrics.call_json_repairs.inc("repaired")
+                call_json = json.dumps(call_dict)
+                logging.info(f"Repaired malformed call JSON: {repr(rest[:ind])}")
 
-                result = f"API responded with HTTP status code {status_code}"
-                if status_code >= 200 and status_code < 300:
-                    result += f", response body: {text}"
+            calls.append({"json": call_json, "dict": call_dict})
+            transcript_utterance += self.CALL_OPENING_TAG + \
+                call_json + self.CALL_CLOSING_TAG
 
-                if self.debug_mode:
-                    await self.utterance_coroutine(result, is_system=True)
+            rest = rest[ind:].strip()
+            if rest.startswith(self.CALL_CLOSING_TAG):
+                rest = rest[len(self.CALL_CLOSING_TAG):].strip()
 
-            self._add_response(self.names[2], result)
-            await self._get_all_utterances()
+            if not self.parallel_calls or not rest.startswith(self.CALL_OPENING_TAG):
+                break
+
+            rest = rest[len(self.CALL_OPENING_TAG):]
+
+        return stripped_utterance, transcript_utterance, calls
+
+    def _prepare_call(self, call_json: str, call_dict: Optional[Dict] = None) -> Dict[str, Any]:
+        call = {"json": call_json}
+
+        try:
+            if call_dict is None:
+                try:
+                    call_dict = json.loads(call_json)
+                except json.decoder.JSONDecodeError:
+                    raise ValueError(f"Malformed JSON: {repr(call_json)}")
+
+            call["plugin_name"] = call_dict["plugin_system_name"]
+            request_params = call_dict["request_object_params"]
+            original_params = copy.deepcopy(request_params)
+            call["request"] = self.router.prepare(
+                call["plugin_name"], request_params, repair=self.repair_calls)
+            if request_params != original_params:
+                # The call as repaired, for the transcript
+                call["json"] = json.dumps(call_dict)
+        except Exception as e:
+            call["error"] = str(e)
+
+        return call
+
+    def _dispatch(self, call: Dict[str, Any]) -> asyncio.Future:
+        return asyncio.ensure_future(
+            self._send_request(call["plugin_name"], call["request"]))
+
+    async def _send_request(self, plugin_name: str, prepared_request_params: Dict) -> str:
+        try:
+            status_code, text = await self.router.send(
+                plugin_name, prepared_request_params)
+            logging.debug(
+                f"Got router response: {repr((status_code, text))}")
+
+            result = f"API responded with HTTP status code {status_code}"
+            if status_code >= 200 and status_code < 300:
+                result += f", response body: {text}"
+        except PluginRequestError as e:
+            result = str(e)
+            logging.error(e)
+
+        return result
@@ -1,62 +1,276 @@
+import os
+import time
+import signal
 import argparse
+import importlib
 import json
 import asyncio
 import websockets
-from pyaml_env import parse_config
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+from urllib.parse import urlsplit, parse_qs
 import logging
-from backends.openai_backend import OpenAIBackend
+import metrics
+from backends.scheduler import BackendScheduler
+from backends.cached_backend import CompletionCache
 from router import Router
 from horace_chatbot import HoraceChatbot
-from typing import Dict, Any
+from turn_runner import TurnRunner
+from recorder import Recorder, RecordingBackend, RecordingRouter
+from session_store import SessionManager
+from reloader import Reloader
+from event_writer import EventWriter
+from transcript import Turn
+from typing import Dict, Any, List, Optional, Set
 
 
+# Backend modules and classes by name. Only the configured backend's module,
+# and the client library it uses, gets imported.
 BACKENDS = {
-    "openai": OpenAIBackend
+    "openai": ("backends.openai_backend", "OpenAIBackend")
 }
 
 
 def get_handler(
-    backend_config: Dict[str, Any],
+    scheduler: BackendScheduler,
     horace_config: Dict[str, Any],
     router: Router,
+    busy_policy: str = TurnRunner.POLICY_QUEUE,
+    turn_runners: Optional[Set[TurnRunner]] = None,
+    recorder: Optional[Recorder] = None,
+    sessions: Optional[SessionManager] = None,
+    completion_cache: Optional[CompletionCache] = None,
+    reloader: Optional[Reloader] = None,
+    max_queued_events: int = 1000,
+    slow_client_policy: str = EventWriter.POLICY_DROP_DELTAS,
     debug_mode: bool = False
 ):
+    sessions = sessions or SessionManager()
+
     async def handler(websocket):
+        # Sessions keep the router and config they started with, across
+        # reloads
+        session_router, session_config = router, horace_config
+        if reloader:
+            session_router, session_config = reloader.acquire()
+            asyncio.current_task().add_done_callback(
+                lambda _, router=session_router: reloader.release(router))
+
+        # Events go out through a queue, so that a slow client doesn't hold
+        # up the chatbot. Clients that connect with batch=1 get the events
+        # queued together in a single frame, as a JSON array.
+        query = parse_qs(urlsplit(websocket.path).query)
+        writer = EventWriter(
+            websocket,
+            batch=query.get("batch", ["0"])[0] == "1",
+            max_queued_events=max_queued_events,
+            slow_client_policy=slow_client_policy
+        )
+
+        async def send_event(event: Dict[str, Any]):
+            writer.send(event)
+
         async def send_state(state: str):
-            await websocket.send(json.dumps({"type": "state", "state": state}))
+            await send_event({"type": "state", "state": state})
 
         async def send_utterance(utterance: str, is_system: bool = False):
             source = "system" if is_system else "ai"
-            await websocket.send(json.dumps({"type": "utterance", "source": source, "text": utterance}))
+            await send_event({"type": "utterance", "source": source, "text": utterance})
+
+        async def send_utterance_delta(delta: str):
+            await send_event({"type": "utterance_delta", "source": "ai", "text": delta})
+
+        backend = scheduler.session()
+        recording = None
+        if recorder:
+            recorder.record_plugins(session_router)
+            recording = recorder.session()
+            recording.record("session_start")
+            backend = scheduler.session(
+                backend=RecordingBackend(scheduler.backend, recording))
+            session_router = RecordingRouter(session_router, recording)
+
+        # Cache hits skip the scheduler's queue
+        if completion_cache:
+            backend = completion_cache.wrap(backend)
+
+        # Clients resume a session by presenting its ID on connect, as in
+        # ws://host:port/?session_id=...
+        session_id = query.get("session_id", [None])[0]
+        session_id, transcript, resumed = await sessions.open(
+            session_id, backend.count_tokens, writer.close)
+
+        async def store_turns(start: int, turns: List[Turn]):
+            await sessions.append(session_id, start, turns)
+
+        async def store_summary(end: int, summary: Turn):
+            await sessions.save_summary(session_id, end, summary)
 
         chatbot = HoraceChatbot(
-            backend=BACKENDS[backend_config["name"]](**backend_config["params"]),
-            router=router,
+            backend=backend,
+            router=session_router,
             utterance_coroutine=send_utterance,
             state_coroutine=send_state,
+            utterance_delta_coroutine=send_utterance_delta,
+            transcript=transcript,
+            turns_coroutine=store_turns,
+            summary_coroutine=store_summary,
             debug_mode=debug_mode,
-            **horace_config
+            **session_config
         )
 
-        async for message in websocket:
-            try:
-                event = json.loads(message)
+        async def send_error(e: Exception):
+            message = f'{type(e).__name__}: {e}'
+            await send_event({"type": "error", "message": message})
+
+        # Turns run in the background, so that messages keep being received
+        # while the bot is replying
+        async def send_interrupted():
+            await send_event({"type": "interrupted"})
+
+        turn_runner = TurnRunner(
+            chatbot, send_error, busy_policy=busy_policy, ended_coroutine=writer.close,
+            interrupted_coroutine=send_interrupted)
+        if turn_runners is not None:
+            turn_runners.add(turn_runner)
 
-                if event["type"] == "utterance":
-                    await chatbot.send_responses([event["text"]])
-            except Exception as e:
-                message = f'{type(e).__name__}: {e}'
-                await websocket.send(json.dumps({"type": "error", "message": message}))
+        metrics.sessions_active.inc()
+        try:
+            await send_event({"type": "session", "session_id": session_id, "resumed": resumed})
 
-            if chatbot.state == chatbot.STATE_ENDED:
-                break
+            async for message in websocket:
+                try:
+                    event = json.loads(message)
+
+                    if event["type"] == "utterance":
+                        if recording:
+                            recording.record("utterance", text=event["text"])
+                        turn_runner.submit(event["text"])
+                except Exception as e:
+                    await send_error(e)
+
+                if chatbot.state == chatbot.STATE_ENDED:
+                    break
+        finally:
+            # Don't spend any more tokens or plugin calls on a client that is
+            # gone
+            await turn_runner.close()
+            await chatbot.close()
+            await writer.close()
+            if turn_runners is not None:
+                turn_runners.discard(turn_runner)
+            sessions.release(session_id, chatbot.transcript)
+            metrics.sessions_active.dec()
+            if recording:
+                recording.record("session_end")
+                recorder.flush()
 
     return handler
 
 
-async def main(handler, host, port):
-    async with websockets.serve(handler, host, port):
-        await asyncio.Future()  # run forever
+async def main(
+    handler,
+    router: Router,
+    host: str,
+    port: int,
+    turn_runners: Set[TurnRunner],
+    drain_timeout: float = 30,
+    reuse_port: bool = False,
+    metrics_host: str = "127.0.0.1",
+    metrics_port: Optional[int] = None,
+    sessions: Optional[SessionManager] = None,
+    reloader: Optional[Reloader] = None,
+    compression: Optional[Dict[str, int]] = None
+):
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    for signum in [signal.SIGTERM, signal.SIGINT]:
+        loop.add_signal_handler(
+            signum, lambda: stop.done() or stop.set_result(None))
+
+    metrics_runner = None
+    if metrics_port:
+        metrics_runner = await metrics.registry.serve(metrics_host, metrics_port)
+
+    # The router's plugin connection pools are bound to this event loop and
+    # closed on shutdown, along with those of any routers reloaded since
+    async with reloader or router:
+        # permessage-deflate, for clients that support it, with a smaller
+        # window and memory level than zlib's defaults to bound the memory
+        # each connection takes
+        extensions = None
+        if compression is not None:
+            extensions = [ServerPerMessageDeflateFactory(
+                server_max_window_bits=compression.get("window_bits", 12),
+                client_max_window_bits=compression.get("window_bits", 12),
+                compress_settings={"memLevel": compression.get("mem_level", 5)}
+            )]
+        server = await websockets.serve(
+            handler, host, port, reuse_port=reuse_port, compression=None, extensions=extensions)
+        await stop
+
+        # Stop accepting connections and give the turns in progress a chance
+        # to finish before closing the remaining connections
+        logging.info("Shutting down...")
+        server.server.close()
+        await drain(turn_runners, drain_timeout)
+
+        server.close()
+        await server.wait_closed()
+
+    if sessions:
+        await sessions.close()
+
+    if metrics_runner:
+        await metrics_runner.cleanup()
+
+
+async def drain(turn_runners: Set[TurnRunner], timeout: float):
+    deadline = time.monotonic() + timeout
+    while True:
+        busy = [runner for runner in turn_runners if runner.busy]
+        remaining = deadline - time.monotonic()
+        if not busy or remaining <= 0:
+            break
+
+        logging.info(f"Waiting for {len(busy)} turns to finish...")
+        joins = [asyncio.ensure_future(runner.join()) for runner in busy]
+        await asyncio.wait(joins, timeout=remaining)
+        for join in joins:
+            join.cancel()
+
+
+def run_workers(workers: int, run_worker):
+    # The workers share the listening port through SO_REUSEPORT and inherit
+    # the plugin registry loaded before forking
+    pids = []
+    for worker_index in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            # Until the worker handles it as a reload
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            try:
+                run_worker(worker_index)
+            finally:
+                os._exit(0)
+
+        pids.append(pid)
+
+    def forward_signal(signum, frame):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, forward_signal)
+    signal.signal(signal.SIGINT, forward_signal)
+    signal.signal(signal.SIGHUP, forward_signal)
+
+    logging.info(f"Started {workers} workers")
+    for pid in pids:
+        os.waitpid(pid, 0)
 
 
 if __name__ == "__main__":
@@ -72,18 +286,110 @@ if __name__ == "__main__":
     parser.add_argument('--port', help='bind port number', default=8001)
     parser.add_argument('--debug', action='store_true',
                         help='enable debug mode')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes')
+    parser.add_argument('--metrics-host', help='metrics bind host name',
+                        default='127.0.0.1')
+    parser.add_argument('--metrics-port', type=int,
+                        help='metrics port number, metrics are disabled if not set')
+    parser.add_argument('--record', metavar='PATH',
+                        help='record all sessions to a JSONL file for replay')
+    parser.add_argument('--watch-config', action='store_true',
+                        help='reload the plugins and horace settings when config.yaml changes, as on SIGHUP')
     args = parser.parse_args()
 
-    config = parse_config("config.yaml")
+    config_path = "config.yaml"
+    from pyaml_env import parse_config
+    config = parse_config(config_path)
 
     router_config = config.get("router") or {}
     router = Router(**router_config)
+    asyncio.run(router.load())
 
-    handler = get_handler(
-        backend_config=config.get("backend") or {},
-        horace_config=config.get("horace") or {},
-        router=router,
-        debug_mode=args.debug
+    # Render the shared prompt prefix once, ahead of the first connection
+    horace_config = config.get("horace") or {}
+    HoraceChatbot.get_initial_prompt(
+        router.registry,
+        horace_config.get("extra_instructions"),
+        horace_config.get("parallel_calls", False),
+        horace_config.get("spec_mode", HoraceChatbot.SPEC_MODE_FULL)
     )
 
-    asyncio.run(main(handler, args.host, args.port))
+    # All sessions share one backend through the scheduler
+    backend_config = config.get("backend") or {}
+    module_name, class_name = BACKENDS[backend_config["name"]]
+    backend_class = getattr(importlib.import_module(module_name), class_name)
+    backend = backend_class(**backend_config["params"])
+    scheduler = BackendScheduler(
+        backend, **(backend_config.get("scheduler") or {}))
+
+    completion_cache = None
+    if backend_config.get("cache"):
+        completion_cache = CompletionCache(
+            model=backend_config["params"].get("model"), **backend_config["cache"])
+
+    metrics.registry.gauge(
+        "horace_backend_queue_depth", "Backend requests waiting in the scheduler's queue",
+        function=lambda: scheduler.queue_depth)
+    metrics.registry.gauge(
+        "horace_backend_in_flight", "Backend requests in flight",
+        function=lambda: scheduler.in_flight)
+
+    server_config = config.get("server") or {}
+    turn_runners = set()
+
+    def run_worker(worker_index: int = 0):
+        # Each worker records to a file of its own and serves its own
+        # metrics, on consecutive ports
+        recorder = None
+        if args.record:
+            record_path = args.record
+            if args.workers > 1:
+                root, ext = os.path.splitext(record_path)
+                record_path = f"{root}.{worker_index}{ext}"
+            recorder = Recorder(record_path, router)
+
+        sessions = SessionManager.from_config(
+            **(config.get("sessions") or {}))
+        reloader = Reloader(config_path, router, horace_config, watch=args.watch_config)
+
+        handler = get_handler(
+            scheduler=scheduler,
+            horace_config=horace_config,
+            router=router,
+            busy_policy=server_config.get(
+                "busy_policy", TurnRunner.POLICY_QUEUE),
+            turn_runners=turn_runners,
+            recorder=recorder,
+            sessions=sessions,
+            completion_cache=completion_cache,
+            reloader=reloader,
+            max_queued_events=server_config.get("max_queued_events", 1000),
+            slow_client_policy=server_config.get(
+                "slow_client_policy", EventWriter.POLICY_DROP_DELTAS),
+            debug_mode=args.debug
+        )
+
+        try:
+            asyncio.run(main(
+                handler,
+                router,
+                args.host,
+                args.port,
+                turn_runners,
+                drain_timeout=server_config.get("drain_timeout", 30),
+                reuse_port=args.workers > 1,
+                metrics_host=args.metrics_host,
+                metrics_port=args.metrics_port and args.metrics_port + worker_index,
+                sessions=sessions,
+                reloader=reloader,
+                compression=server_config.get("compression", {})
+            ))
+        finally:
+            if recorder:
+                recorder.close()
+
+    if args.workers > 1:
+        run_workers(args.workers, run_worker)
+    else:
+        run_worker()
@@ -0,0 +1,239 @@
+import time
+import bisect
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class Metric():
+    TYPE = "untyped"
+
+    def __init__(self, registry: "MetricsRegistry", name: str, help: str, label_names: Tuple[str, ...] = ()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        # Values by label values, in the order of label_names
+        self.values = {}
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"]
+        values = self.values or ({(): 0} if not self.label_names else {})
+        for label_values, value in sorted(values.items()):
+            lines.append(
+                f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}")
+
+        return lines
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, *label_values: str, amount: float = 1):
+        if not self.registry.enabled:
+            return
+
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def __init__(self, *args, function: Optional[Callable[[], float]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Sampled at scrape time instead of being kept up to date
+        self.function = function
+
+    def inc(self, *label_values: str, amount: float = 1):
+        if not self.registry.enabled:
+            return
+
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, *label_values: str, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+    def render(self) -> List[str]:
+        if self.function is not None:
+            self.values[()] = self.function()
+
+        return super().render()
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, *args, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = buckets
+
+    def observe(self, value: float, *label_values: str):
+        if not self.registry.enabled:
+            return
+
+        # Per-bucket counts, then sum and count
+        state = self.values.get(label_values)
+        if state is None:
+            state = self.values[label_values] = [0] * len(self.buckets) + [0, 0]
+
+        bucket = bisect.bisect_left(self.buckets, value)
+        if bucket < len(self.buckets):
+            state[bucket] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"]
+        bucket_label_names = self.label_names + ("le",)
+        for label_values, state in sorted(self.values.items()):
+            count = 0
+            for bound, bucket_count in zip(self.buckets, state):
+                count += bucket_count
+                labels = format_labels(
+                    bucket_label_names, label_values + (format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {count}")
+
+            labels = format_labels(bucket_label_names, label_values + ("+Inf",))
+            lines.append(f"{self.name}_bucket{labels} {state[-1]}")
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {format_value(state[-2])}")
+            lines.append(f"{self.name}_count{labels} {state[-1]}")
+
+        return lines
+
+
+class MetricsRegistry():
+    # Collects metrics in the Prometheus text format. Nothing is recorded until
+    # the registry is enabled, which happens when the metrics endpoint is
+    # served.
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self.enabled = False
+        self.metrics: Dict[str, Metric] = {}
+
+    def counter(self, name: str, help: str, label_names: Tuple[str, ...] = ()) -> Counter:
+        return self._add(Counter(self, name, help, label_names))
+
+    def gauge(self, name: str, help: str, label_names: Tuple[str, ...] = (), **kwargs) -> Gauge:
+        return self._add(Gauge(self, name, help, label_names, **kwargs))
+
+    def histogram(self, name: str, help: str, label_names: Tuple[str, ...] = (), **kwargs) -> Histogram:
+        return self._add(Histogram(self, name, help, label_names, **kwargs))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines += metric.render()
+
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host: str, port: int) -> "web.AppRunner":
+        # The web server is only loaded if metrics are served
+        from aiohttp import web
+
+        async def handle_metrics(request):
+            return web.Response(
+                body=self.render().encode("utf-8"), headers={"Content-Type": self.CONTENT_TYPE})
+
+        self.enabled = True
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle_metrics)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+        return runner
+
+    def _add(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+
+def format_labels(label_names: Tuple[str, ...], label_values: Tuple[str, ...]) -> str:
+    if not label_names:
+        return ""
+
+    labels = ",".join(
+        f'{name}="{escape_label_value(str(value))}"' for name, value in zip(label_names, label_values))
+    return "{" + labels + "}"
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+
+    return str(value)
+
+
+def elapsed(start: float) -> float:
+    return time.perf_counter() - start
+
+
+registry = MetricsRegistry()
+
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192)
+
+sessions_active = registry.gauge(
+    "horace_sessions_active", "WebSocket sessions currently connected")
+turn_seconds = registry.histogram(
+    "horace_turn_seconds", "Duration of turns, from the user's message to the bot's last reply", ("outcome",))
+websocket_send_seconds = registry.histogram(
+    "horace_websocket_send_seconds", "Time spent sending events to the client", ("type",))
+websocket_queued_events = registry.histogram(
+    "horace_websocket_queued_events", "Events waiting to be sent to the client when a frame is sent",
+    buckets=(1, 2, 4, 8, 16, 64, 256, 1024))
+websocket_dropped_events = registry.counter(
+    "horace_websocket_dropped_events_total", "Events dropped for clients that fell behind")
+websocket_slow_client_disconnects = registry.counter(
+    "horace_websocket_slow_client_disconnects_total", "Clients disconnected for falling behind")
+
+backend_queue_seconds = registry.histogram(
+    "horace_backend_queue_seconds", "Time backend requests wait in the scheduler's queue")
+backend_first_token_seconds = registry.histogram(
+    "horace_backend_first_token_seconds", "Time to the first streamed token of a completion, including queueing")
+backend_completion_seconds = registry.histogram(
+    "horace_backend_completion_seconds", "Duration of completions, including queueing", ("mode",))
+backend_prompt_tokens = registry.histogram(
+    "horace_backend_prompt_tokens", "Prompt tokens per completion", buckets=TOKEN_BUCKETS)
+backend_completion_tokens = registry.histogram(
+    "horace_backend_completion_tokens", "Completion tokens per completion", buckets=TOKEN_BUCKETS)
+backend_errors = registry.counter(
+    "horace_backend_errors_total", "Failed completions", ("error",))
+backend_retries = registry.counter(
+    "horace_backend_retries_total", "Backend requests retried after a transient error")
+backend_cache_requests = registry.counter(
+    "horace_backend_cache_requests_total",
+    "Cacheable completions by result: hit, miss, or shared with an identical request in flight", ("result",))
+
+validation_retries = registry.counter(
+    "horace_validation_retries_total", "Follow-up completions asking the model to correct its invalid API calls")
+call_json_repairs = registry.counter(
+    "horace_call_json_repairs_total", "Calls with malformed JSON, by whether it could be repaired", ("outcome",))
+calls_per_utterance = registry.histogram(
+    "horace_calls_per_utterance", "API calls in a bot utterance that makes any", buckets=(1, 2, 3, 5, 10))
+
+plugin_prepare_seconds = registry.histogram(
+    "horace_plugin_prepare_seconds", "Time to check a request against the plugin's OpenAPI spec",
+    ("plugin",), buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05))
+plugin_invalid_requests = registry.counter(
+    "horace_plugin_invalid_requests_total", "Requests rejected before being sent", ("plugin",))
+plugin_call_repairs = registry.counter(
+    "horace_plugin_call_repairs_total", "Invalid requests fixed up against the plugin's spec, or not", ("plugin", "outcome"))
+plugin_requests = registry.counter(
+    "horace_plugin_requests_total", "Plugin API requests by HTTP status, or error", ("plugin", "status"))
+plugin_request_seconds = registry.histogram(
+    "horace_plugin_request_seconds", "Plugin API request latency, including cached responses", ("plugin",))
+plugin_cache_hits = registry.counter(
+    "horace_plugin_cache_hits_total", "Plugin API responses served from the response cache", ("plugin",))
+plugin_rejected_requests = registry.counter(
+    "horace_plugin_rejected_requests_total", "Plugin API requests failed locally while the plugin's circuit is open",
+    ("plugin",))
+plugin_circuit_open = registry.gauge(
+    "horace_plugin_circuit_open", "Whether the plugin's circuit is open, with requests to it paused", ("plugin",))
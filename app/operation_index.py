@@ -0,0 +1,143 @@
+import re
+import json
+import math
+from collections import Counter
+from request_validator import dereference
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional
+
+
+class IndexedOperation(NamedTuple):
+    plugin: str
+    operation_id: str
+    method: str
+    path: str
+    summary: str
+    # Compact standalone JSON of the operation, with its schemas inlined
+    snippet: str
+    terms: Counter
+
+
+class OperationIndex():
+    # Scores the operations of all plugins against text with BM25, so that the
+    # ones relevant to a conversation can be picked without an embedding model
+    METHODS = ["get", "put", "post", "delete", "patch"]
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, operations: Iterable[IndexedOperation]):
+        self.operations = {(operation.plugin, operation.operation_id): operation
+                           for operation in operations}
+
+        self._document_frequencies = Counter()
+        for operation in self.operations.values():
+            self._document_frequencies.update(operation.terms.keys())
+
+        lengths = [sum(operation.terms.values()) for operation in self.operations.values()]
+        self._average_length = sum(lengths) / len(lengths) if lengths else 0
+
+    def search(self, text: str, k: int) -> List[IndexedOperation]:
+        query_terms = set(tokenize(text))
+        count = len(self.operations)
+
+        scored = []
+        for operation in self.operations.values():
+            length = sum(operation.terms.values())
+            score = 0
+            for term in query_terms & operation.terms.keys():
+                idf = math.log(1 + (count - self._document_frequencies[term] + 0.5) /
+                               (self._document_frequencies[term] + 0.5))
+                frequency = operation.terms[term]
+                score += idf * frequency * (self.K1 + 1) / (
+                    frequency + self.K1 * (1 - self.B + self.B * length / self._average_length))
+
+            if score > 0:
+                scored.append((score, operation))
+
+        scored.sort(key=lambda s: -s[0])
+        return [operation for _, operation in scored[:k]]
+
+    def get(self, plugin: str, operation_id: str) -> Optional[IndexedOperation]:
+        return self.operations.get((plugin, operation_id))
+
+    @classmethod
+    def get_operations(cls, plugin: str, spec_dict: Dict[str, Any]) -> List[IndexedOperation]:
+        spec_dict = dereference(spec_dict)
+        servers = spec_dict.get("servers") or [{"url": ""}]
+        base_url = servers[0]["url"].rstrip("/")
+
+        operations = []
+        for path, path_dict in (spec_dict.get("paths") or {}).items():
+            for method in cls.METHODS:
+                operation_dict = path_dict.get(method)
+                if operation_dict is None:
+                    continue
+
+                operation_id = operation_dict.get("operationId") or f"{method.upper()} {path}"
+                summary = operation_dict.get("summary") or operation_dict.get("description") or ""
+
+                snippet = {
+                    "operationId": operation_id,
+                    "method": method.upper(),
+                    "url": base_url + path,
+                    "summary": summary
+                }
+                if operation_dict.get("description") and operation_dict["description"] != summary:
+                    snippet["description"] = operation_dict["description"]
+
+                parameters = {(p["name"], p["in"]): p for p in path_dict.get("parameters", [])}
+                parameters.update({(p["name"], p["in"]): p for p in operation_dict.get("parameters", [])})
+                if parameters:
+                    snippet["parameters"] = list(parameters.values())
+
+                request_body = operation_dict.get("requestBody")
+                if request_body:
+                    snippet["requestBody"] = request_body
+
+                words = [operation_id, path, summary, operation_dict.get("description") or ""]
+                for parameter in parameters.values():
+                    words += [parameter["name"], parameter.get("description") or ""]
+                    words += get_schema_words(parameter.get("schema"))
+                for media_type in ((request_body or {}).get("content") or {}).values():
+                    words += get_schema_words(media_type.get("schema"))
+
+                operations.append(IndexedOperation(
+                    plugin,
+                    operation_id,
+                    method.upper(),
+                    path,
+                    summary,
+                    json.dumps(snippet, separators=(",", ":")),
+                    Counter(tokenize(" ".join(words)))
+                ))
+
+        return operations
+
+
+def get_schema_words(schema: Any, depth: int = 3) -> List[str]:
+    # Property names and descriptions, down to a few levels
+    if not isinstance(schema, dict) or depth == 0:
+        return []
+
+    words = [schema.get("description") or ""]
+    for name, property_schema in (schema.get("properties") or {}).items():
+        words.append(name)
+        words += get_schema_words(property_schema, depth - 1)
+    words += get_schema_words(schema.get("items"), depth - 1)
+
+    return words
+
+
+def tokenize(text: str) -> List[str]:
+    # Splits camelCase and snake_case identifiers and strips plural endings,
+    # so that "searchItems" matches "search items" and "item"
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", text)
+    return [stem(word) for word in re.findall(r"[a-z0-9]+", text.lower()) if len(word) > 1]
+
+
+def stem(word: str) -> str:
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+
+    return word
@@ -0,0 +1,190 @@
+import time
+import json
+import uuid
+import logging
+from backends.backend import Backend
+from router import Router, PluginRequestError
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+
+class Recorder():
+    # Writes the event stream of every session to a JSONL file: the user's
+    # utterances, backend prompts and completions with their timings, and
+    # plugin requests and responses. Each file starts with the plugins that
+    # were loaded, so that a capture can be replayed without them.
+    # Authorization headers and tokens are never written.
+    def __init__(self, path: str, router: Router):
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+        self._recorded_router = None
+        self.record_plugins(router)
+        logging.info(f"Recording sessions to {path}")
+
+    def record_plugins(self, router: Router):
+        # Again after a reload, for the sessions that use the new plugins
+        if router is self._recorded_router:
+            return
+
+        self._recorded_router = router
+        self.write({
+            "type": "plugins",
+            "plugins": {
+                name: {
+                    "netloc": plugin["netloc"],
+                    "manifest": plugin["manifest"],
+                    "spec_dict": plugin["spec_dict"],
+                    "hash": plugin["hash"]
+                }
+                for name, plugin in router.registry.items()
+            }
+        })
+
+    def session(self) -> "SessionRecording":
+        return SessionRecording(self, uuid.uuid4().hex)
+
+    def write(self, event: Dict[str, Any]):
+        self._file.write(json.dumps({"time": time.time(), **event}) + "\n")
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class SessionRecording():
+    def __init__(self, recorder: Recorder, session_id: str):
+        self.recorder = recorder
+        self.session_id = session_id
+
+    def record(self, event_type: str, **fields):
+        self.recorder.write(
+            {"type": event_type, "session": self.session_id, **fields})
+
+
+class RecordingBackend(Backend):
+    def __init__(self, backend: Backend, recording: SessionRecording):
+        self.backend = backend
+        self.recording = recording
+
+    async def complete(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: int = 16,
+        stop: Optional[List[str]] = None,
+        temperature: Optional[float] = 1.0
+    ) -> str:
+        start = time.perf_counter()
+        completion = None
+        error = None
+        try:
+            completion = await self.backend.complete(
+                messages, max_tokens=max_tokens, stop=stop, temperature=temperature)
+            return completion
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            self._record(messages, max_tokens, stop, temperature, False,
+                         completion, error, duration, duration)
+
+    async def stream(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: int = 16,
+        stop: Optional[List[str]] = None,
+        temperature: Optional[float] = 1.0
+    ) -> AsyncIterator[str]:
+        start = time.perf_counter()
+        first_token_seconds = None
+        deltas = []
+        error = None
+        try:
+            async for delta in self.backend.stream(
+                    messages, max_tokens=max_tokens, stop=stop, temperature=temperature):
+                if first_token_seconds is None:
+                    first_token_seconds = time.perf_counter() - start
+                deltas.append(delta)
+                yield delta
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            # A stream closed early by the consumer is recorded as far as it
+            # got
+            self._record(messages, max_tokens, stop, temperature, True, "".join(deltas),
+                         error, first_token_seconds, time.perf_counter() - start)
+
+    def count_tokens(self, text: str) -> int:
+        return self.backend.count_tokens(text)
+
+    def is_retryable(self, e: Exception) -> bool:
+        return self.backend.is_retryable(e)
+
+    def _record(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: int,
+        stop: Optional[List[str]],
+        temperature: Optional[float],
+        stream: bool,
+        completion: Optional[str],
+        error: Optional[str],
+        first_token_seconds: Optional[float],
+        duration_seconds: float
+    ):
+        self.recording.record(
+            "completion",
+            messages=messages,
+            max_tokens=max_tokens,
+            stop=stop,
+            temperature=temperature,
+            stream=stream,
+            completion=completion,
+            error=error,
+            first_token_seconds=first_token_seconds,
+            duration_seconds=duration_seconds
+        )
+
+
+class RecordingRouter():
+    # Stands in for the router in a single session, recording its plugin
+    # requests. Anything else is passed through to the shared router.
+    def __init__(self, router: Router, recording: SessionRecording):
+        self.router = router
+        self.recording = recording
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.router, name)
+
+    async def send(self, plugin_name: str, prepared_request_params: Dict) -> Tuple[int, str]:
+        request = {key: value for key, value in prepared_request_params.items()
+                   if key != "headers"}
+        request["headers"] = {
+            key: value for key, value in (prepared_request_params.get("headers") or {}).items()
+            if key.lower() != "authorization"
+        }
+
+        start = time.perf_counter()
+        try:
+            status, text = await self.router.send(plugin_name, prepared_request_params)
+        except PluginRequestError as e:
+            self.recording.record(
+                "plugin_request",
+                plugin=plugin_name,
+                request=request,
+                error=str(e),
+                duration_seconds=time.perf_counter() - start
+            )
+            raise
+
+        self.recording.record(
+            "plugin_request",
+            plugin=plugin_name,
+            request=request,
+            status=status,
+            text=text,
+            duration_seconds=time.perf_counter() - start
+        )
+        return status, text
@@ -0,0 +1,139 @@
+import os
+import signal
+import asyncio
+import logging
+from collections import Counter
+from router import Router
+from horace_chatbot import HoraceChatbot
+from typing import Any, Dict, Optional, Tuple
+
+
+class Reloader():
+    # Reloads the router and horace sections of the config file on SIGHUP,
+    # and on changes to the file if watch is set. A new router is loaded in
+    # the background and swapped in for new sessions, while existing sessions
+    # keep the router they started with; an old router is closed once its
+    # last session has ended.
+    WATCH_INTERVAL = 2
+
+    def __init__(
+        self,
+        config_path: str,
+        router: Router,
+        horace_config: Dict[str, Any],
+        watch: bool = False
+    ):
+        self.config_path = config_path
+        self.router = router
+        self.horace_config = horace_config
+        self.watch = watch
+
+        self._users = Counter()
+        self._retired = set()
+        self._closing = set()
+        self._reload_task = None
+        self._reload_pending = False
+        self._watch_task = None
+
+    def acquire(self) -> Tuple[Router, Dict[str, Any]]:
+        # Returns the router and horace config for a new session, to be
+        # released when the session ends
+        self._users[self.router] += 1
+        return self.router, self.horace_config
+
+    def release(self, router: Router):
+        self._users[router] -= 1
+        if not self._users[router]:
+            del self._users[router]
+            if router in self._retired:
+                self._retire(router)
+
+    def request_reload(self):
+        # Reloads run one at a time; requests made during one are served by
+        # another one afterwards
+        if self._reload_task and not self._reload_task.done():
+            self._reload_pending = True
+            return
+
+        self._reload_task = asyncio.create_task(self._reload())
+
+    async def _reload(self):
+        while True:
+            self._reload_pending = False
+            try:
+                await self.reload()
+            except Exception as e:
+                logging.error(f"Error reloading {self.config_path}, keeping the current config: {e}")
+
+            if not self._reload_pending:
+                break
+
+    async def reload(self):
+        from pyaml_env import parse_config
+
+        logging.info(f"Reloading {self.config_path}...")
+        config = parse_config(self.config_path)
+        horace_config = config.get("horace") or {}
+
+        # Cached plugin definitions are revalidated right away, and whatever
+        # was compiled for unchanged plugins is reused
+        router = Router(**(config.get("router") or {}))
+        await router.load(interactive=False, previous=self.router, revalidate=True)
+
+        # Plugin blocks are cached by spec hash, so only those of changed
+        # plugins are rendered again
+        HoraceChatbot.get_initial_prompt(
+            router.registry,
+            horace_config.get("extra_instructions"),
+            horace_config.get("parallel_calls", False),
+            horace_config.get("spec_mode", HoraceChatbot.SPEC_MODE_FULL)
+        )
+
+        await router.open()
+        old_router, self.router, self.horace_config = self.router, router, horace_config
+        self._retired.add(old_router)
+        if not self._users[old_router]:
+            self._retire(old_router)
+
+        logging.info("Reloaded config, plugins: " +
+                     (", ".join(p["netloc"] for p in router.registry.values()) or "none"))
+
+    async def _watch(self):
+        mtime = self._get_mtime()
+        while True:
+            await asyncio.sleep(self.WATCH_INTERVAL)
+            new_mtime = self._get_mtime()
+            if new_mtime != mtime:
+                mtime = new_mtime
+                self.request_reload()
+
+    def _get_mtime(self) -> Optional[float]:
+        try:
+            return os.stat(self.config_path).st_mtime
+        except OSError:
+            return None
+
+    def _retire(self, router: Router):
+        self._retired.discard(router)
+        task = asyncio.create_task(router.close())
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def __aenter__(self):
+        await self.router.open()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.request_reload)
+        if self.watch:
+            self._watch_task = asyncio.create_task(self._watch())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+        for task in [self._watch_task, self._reload_task]:
+            if task:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+
+        for router in [self.router, *self._retired]:
+            await router.close()
+        if self._closing:
+            await asyncio.wait(list(self._closing))
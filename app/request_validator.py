@@ -0,0 +1,307 @@
+import re
+import json
+from urllib.parse import urlsplit, parse_qsl
+from typing import Dict, List, Optional, Tuple, Callable, Any
+
+
+class RequestValidationError(ValueError):
+    pass
+
+
+class Parameter():
+    def __init__(self, param_dict: Dict[str, Any], make_validator: Callable):
+        self.name = param_dict["name"]
+        self.location = param_dict["in"]
+        self.required = param_dict.get("required", self.location == "path")
+        self.schema = param_dict.get("schema") or {}
+        self.make_validator = make_validator
+        self._validator = None
+
+    @property
+    def validator(self):
+        # Compiled on first use, as most parameters of a large spec are never
+        # used
+        if self._validator is None:
+            self._validator = self.make_validator(self.schema)
+        return self._validator
+
+    def validate(self, value: Any):
+        value = self.cast(self.schema, value)
+
+        errors = list(self.validator.iter_errors(value))
+        if errors:
+            raise RequestValidationError(
+                f"Invalid {self.location} parameter {self.name}: {errors[0].message}")
+
+    @classmethod
+    def cast(cls, schema: Dict[str, Any], value: Any) -> Any:
+        # Parameters travel as strings, so cast them the way the server would
+        # before checking them against the schema
+        schema_type = schema.get("type")
+
+        if schema_type == "array":
+            values = value if isinstance(value, list) else [value]
+            return [cls.cast(schema.get("items") or {}, v) for v in values]
+
+        if isinstance(value, list):
+            return value
+
+        if isinstance(value, bool):
+            value = str(value).lower()
+        else:
+            value = str(value)
+
+        try:
+            if schema_type == "integer":
+                return int(value)
+            if schema_type == "number":
+                return float(value)
+        except ValueError:
+            return value
+
+        if schema_type == "boolean" and value in ("true", "false"):
+            return value == "true"
+
+        return value
+
+
+class Operation():
+    def __init__(
+        self,
+        method: str,
+        path: str,
+        operation_dict: Dict[str, Any],
+        path_params: List[Dict[str, Any]],
+        make_validator: Callable
+    ):
+        self.method = method
+        self.path = path
+        self.operation_dict = operation_dict
+
+        # Operation-level parameters override path-level ones with the same
+        # name and location
+        params = {(p["name"], p["in"]): p for p in path_params}
+        params.update({(p["name"], p["in"]): p
+                       for p in operation_dict.get("parameters", [])})
+        self.parameters = [Parameter(p, make_validator)
+                           for p in params.values() if p["in"] != "cookie"]
+
+        self.make_validator = make_validator
+        self.body_required = False
+        self.body_schema = None
+        self._body_validator = None
+        request_body = operation_dict.get("requestBody")
+        if request_body:
+            self.body_required = request_body.get("required", False)
+            content = request_body.get("content") or {}
+            media_type = next((content[m] for m in content
+                               if m.split(";")[0].strip() in ("application/json", "application/x-www-form-urlencoded")), None)
+            if media_type and "schema" in media_type:
+                self.body_schema = media_type["schema"]
+
+    @property
+    def body_validator(self):
+        if self._body_validator is None and self.body_schema is not None:
+            self._body_validator = self.make_validator(self.body_schema)
+        return self._body_validator
+
+    def get_response_schema(self, status: int) -> Optional[Dict[str, Any]]:
+        responses = self.operation_dict.get("responses") or {}
+        response = responses.get(str(status)) or responses.get(
+            f"{str(status)[0]}XX") or responses.get("default") or {}
+
+        for media_type, content in (response.get("content") or {}).items():
+            if media_type.split(";")[0].strip() == "application/json":
+                return content.get("schema")
+
+        return None
+
+    def validate(
+        self,
+        path_params: Dict[str, str],
+        params: Dict[str, Any],
+        headers: Dict[str, str],
+        body: Any
+    ):
+        headers = {name.lower(): value for name, value in headers.items()}
+
+        for param in self.parameters:
+            if param.location == "path":
+                value = path_params.get(param.name)
+            elif param.location == "query":
+                value = params.get(param.name)
+            else:
+                value = headers.get(param.name.lower())
+
+            if value is None:
+                if param.required:
+                    raise RequestValidationError(
+                        f"Missing required {param.location} parameter: {param.name}")
+                continue
+
+            param.validate(value)
+
+        if body is None:
+            if self.body_required:
+                raise RequestValidationError("Missing required request body")
+        elif self.body_validator:
+            errors = list(self.body_validator.iter_errors(body))
+            if errors:
+                raise RequestValidationError(
+                    f"Invalid request body: {errors[0].message}")
+
+
+class RequestValidator():
+    METHODS = ["get", "put", "post", "delete",
+               "options", "head", "patch", "trace"]
+
+    def __init__(self, spec_dict: Dict[str, Any]):
+        root = spec_dict
+        resolver = None
+
+        def make_validator(schema):
+            # The schema validation stack is only imported once a request is
+            # validated, as it takes a while to load
+            nonlocal resolver
+            from jsonschema import RefResolver
+            from openapi_schema_validator import OAS30WriteValidator, OAS31Validator, \
+                oas30_format_checker, oas31_format_checker
+
+            if str(root.get("openapi", "")).startswith("3.1"):
+                validator_class, format_checker = OAS31Validator, oas31_format_checker
+            else:
+                validator_class, format_checker = OAS30WriteValidator, oas30_format_checker
+
+            if resolver is None:
+                resolver = RefResolver.from_schema(root)
+            return validator_class(schema, resolver=resolver, format_checker=format_checker)
+
+        spec_dict = dereference(spec_dict)
+
+        self.servers = []
+        self.server_urls = []
+        for server in spec_dict.get("servers") or [{"url": "/"}]:
+            url = server["url"]
+            for name, variable in (server.get("variables") or {}).items():
+                url = url.replace(f"{{{name}}}", str(variable.get("default", "")))
+
+            self.server_urls.append(url)
+            parts = urlsplit(url)
+            self.servers.append(
+                (parts.netloc.lower(), parts.path.rstrip("/")))
+
+        # Operations keyed by (method, path template). Templates are matched
+        # in order, so that literal paths take precedence over parametrized
+        # ones.
+        self.operations = {}
+        self.paths = []
+        for path, path_dict in (spec_dict.get("paths") or {}).items():
+            path_params = path_dict.get("parameters", [])
+            for method in self.METHODS:
+                if method in path_dict:
+                    self.operations[(method, path)] = Operation(
+                        method, path, path_dict[method], path_params, make_validator)
+
+            self.paths.append((self._compile_path(path), path))
+
+        self.paths.sort(key=lambda p: p[1].count("{"))
+
+    def find_operation(self, method: str, url: str) -> Tuple[Operation, Dict[str, str]]:
+        parts = urlsplit(url)
+        path = None
+        for netloc, base_path in self.servers:
+            if netloc and parts.netloc and netloc != parts.netloc.lower():
+                continue
+            if parts.path == base_path or parts.path.startswith(base_path + "/"):
+                path = parts.path[len(base_path):] or "/"
+                break
+
+        if path is None:
+            raise RequestValidationError(f"Server not found for {url}")
+
+        # A path matched by a template without the method may still match a
+        # later one that has it
+        matched_template = None
+        for (pattern, names), path_template in self.paths:
+            m = pattern.fullmatch(path)
+            if m:
+                operation = self.operations.get((method.lower(), path_template))
+                if operation is not None:
+                    return operation, dict(zip(names, m.groups()))
+                matched_template = matched_template or path_template
+
+        if matched_template is not None:
+            raise RequestValidationError(
+                f"Operation {method.upper()} not found for {matched_template}")
+
+        raise RequestValidationError(f"Path not found for {url}")
+
+    def validate(
+        self,
+        method: str,
+        url: str,
+        params: Optional[Dict[str, Any]] = None,
+        headers: Optional[Dict[str, str]] = None,
+        data: Any = None,
+        json: Any = None
+    ) -> Operation:
+        operation, path_params = self.find_operation(method, url)
+
+        query = {}
+        for name, value in parse_qsl(urlsplit(url).query):
+            query.setdefault(name, []).append(value)
+        query = {name: values[0] if len(values) == 1 else values
+                 for name, values in query.items()}
+        query.update(params or {})
+
+        body = json
+        if body is None and data is not None:
+            body = _parse_body(data)
+
+        operation.validate(path_params, query, headers or {}, body)
+
+        return operation
+
+    @staticmethod
+    def _compile_path(path: str) -> Tuple[re.Pattern, List[str]]:
+        pattern = ""
+        names = []
+        for literal, name in re.findall(r"([^{]*)(?:\{([^}]+)\})?", path):
+            pattern += re.escape(literal)
+            if name:
+                pattern += "([^/]+)"
+                names.append(name)
+
+        return re.compile(pattern), names
+
+
+def dereference(node: Any, root: Optional[Dict] = None, stack: Tuple[str, ...] = ()) -> Any:
+    # Inlines local $refs. Recursive refs are left in place and resolved by
+    # the validators on demand.
+    if root is None:
+        root = node
+
+    if isinstance(node, dict):
+        ref = node.get("$ref")
+        if isinstance(ref, str) and ref.startswith("#/") and ref not in stack:
+            target = root
+            for part in ref[2:].split("/"):
+                target = target[part.replace("~1", "/").replace("~0", "~")]
+            return dereference(target, root, stack + (ref,))
+
+        return {key: dereference(value, root, stack) for key, value in node.items()}
+
+    if isinstance(node, list):
+        return [dereference(value, root, stack) for value in node]
+
+    return node
+
+
+def _parse_body(data: Any) -> Any:
+    if isinstance(data, (bytes, str)):
+        try:
+            return json.loads(data)
+        except ValueError:
+            return data
+
+    return data
@@ -0,0 +1,54 @@
+from typing import Any, Dict, List, Optional
+
+
+def compact(
+    value: Any,
+    schema: Optional[Dict[str, Any]] = None,
+    include: Optional[List[str]] = None,
+    exclude: Optional[List[str]] = None,
+    max_array_items: Optional[int] = None,
+    prune_to_schema: bool = False
+) -> Any:
+    # Shrinks a decoded JSON response before it goes into the prompt. The
+    # allow list applies to the keys of the top-level object, or of the objects
+    # in a top-level array, and keeps the values under them whole. The deny
+    # list applies to object keys at any depth. With prune_to_schema, object
+    # keys not declared in the response schema are dropped.
+    schema = schema or {}
+
+    if isinstance(value, dict):
+        properties = schema.get("properties")
+        result = {}
+        for key, item in value.items():
+            if include is not None and key not in include:
+                continue
+            if exclude is not None and key in exclude:
+                continue
+            if prune_to_schema and properties is not None and key not in properties:
+                continue
+
+            result[key] = compact(
+                item,
+                (properties or {}).get(key),
+                None,
+                exclude,
+                max_array_items,
+                prune_to_schema
+            )
+
+        return result
+
+    if isinstance(value, list):
+        items = value
+        if max_array_items is not None and len(value) > max_array_items:
+            items = value[:max_array_items]
+
+        result = [compact(item, schema.get("items"), include, exclude, max_array_items, prune_to_schema)
+                  for item in items]
+
+        if len(items) < len(value):
+            result.append(f"({len(value) - len(items)} more items omitted)")
+
+        return result
+
+    return value
@@ -1,18 +1,28 @@
 import os
-import yaml
 import json
+import time
+import hashlib
+import asyncio
 import aiohttp
-import requests
-from urllib.parse import urlunsplit
-import openapi_core
-from openapi_core.contrib.requests import RequestsOpenAPIRequest
-from openapi_core.validation.request.exceptions import RequestValidationError
+from urllib.parse import urlsplit, urlunsplit, parse_qsl
+from request_validator import RequestValidator, RequestValidationError
+from operation_index import OperationIndex
+import response_filter
+import call_repair
+import metrics
+from cache import LRUCache, SingleFlight
+from circuit_breaker import CircuitBreaker
 import logging
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple, Any
+
+
+class PluginRequestError(Exception):
+    pass
 
 
 class Router():
     PLUGIN_AUTH_FILENAME = '.plugin_auth.json'
+    PLUGIN_CACHE_FILENAME = '.plugin_cache.json'
 
     AUTH_TYPE_NONE = "none"
     AUTH_TYPE_SERVICE_HTTP = "service_http"
@@ -22,129 +32,775 @@ class Router():
     MIME_TYPES_YAML = ["application/yaml",
                        "application/x-yaml", "text/yaml", "text/x-yaml"]
 
-    def __init__(self, plugins: Optional[List[str]] = None):
-        if os.path.isfile(self.PLUGIN_AUTH_FILENAME):
-            with open(self.PLUGIN_AUTH_FILENAME, 'r') as f:
-                plugin_auth = json.load(f)
-        else:
-            plugin_auth = {}
+    REQUEST_PARAMS = ['method', 'url', 'headers', 'params', 'data', 'json']
+
+    # Connection pool and timeout settings for plugin API calls. Timeouts are
+    # in seconds.
+    DEFAULT_PLUGIN_SETTINGS = {
+        "connection_limit": 10,
+        "dns_cache_ttl": 300,
+        "keepalive_timeout": 30,
+        "connect_timeout": 5,
+        "read_timeout": 30,
+        "total_timeout": 60,
+        # Response size limit and JSON response compaction. JSON responses
+        # are read up to max_json_read_bytes and compacted before the size
+        # limit applies.
+        "max_response_bytes": 65536,
+        "max_json_read_bytes": 1048576,
+        "max_array_items": None,
+        "response_fields_include": None,
+        "response_fields_exclude": None,
+        "prune_to_schema": False,
+        # Overrides the TTL in seconds from the response's Cache-Control
+        "response_cache_ttl": None,
+        # Circuit breaker: once at least circuit_error_rate of the requests
+        # in the last circuit_window seconds have failed, out of at least
+        # circuit_min_requests, requests fail right away for
+        # circuit_open_seconds before the plugin is probed again
+        "circuit_window": 60,
+        "circuit_min_requests": 5,
+        "circuit_error_rate": 0.5,
+        "circuit_open_seconds": 30,
+        "circuit_slow_call_seconds": None
+    }
+    RESPONSE_CHUNK_SIZE = 16384
+    CACHEABLE_METHODS = ["GET", "HEAD"]
+    # Statuses that count as failures for the circuit breaker, besides 5xx
+    CIRCUIT_FAILURE_STATUSES = [429]
+
+    def __init__(
+        self,
+        plugins: Optional[List[str]] = None,
+        plugin_defaults: Optional[Dict[str, Any]] = None,
+        plugin_settings: Optional[Dict[str, Dict[str, Any]]] = None,
+        discovery_timeout: float = 10,
+        cache_ttl: float = 3600,
+        response_cache_size: int = 1000
+    ):
+        self.plugins = list(dict.fromkeys(plugins or []))
+        self.plugin_defaults = {
+            **self.DEFAULT_PLUGIN_SETTINGS, **(plugin_defaults or {})}
+        self.plugin_settings = plugin_settings or {}
+        self.discovery_timeout = discovery_timeout
+        self.cache_ttl = cache_ttl
+
+        self.registry = {}
+        self.operation_index = OperationIndex([])
+        self.sessions = {}
+        self.response_cache = LRUCache(max_entries=response_cache_size)
+        self._requests_in_flight = SingleFlight()
+        self.circuits: Dict[str, CircuitBreaker] = {}
+        self._probe_tasks: Dict[str, asyncio.Task] = {}
+        self._plugin_auth = {}
+        self._plugin_cache = {}
+        self._refresh_task = None
+        self._previous_registry = {}
+
+    async def load(
+        self,
+        interactive: bool = True,
+        previous: Optional["Router"] = None,
+        revalidate: bool = False
+    ):
+        # Plugins unchanged since they were loaded by the previous router, if
+        # any, reuse its compiled validators and operation indexes. With
+        # revalidate, cached plugins are fetched again too, in the same pass.
+        self._previous_registry = {
+            plugin["netloc"]: plugin for plugin in previous.registry.values()} if previous else {}
+
+        plugin_auth = self._read_json(self.PLUGIN_AUTH_FILENAME)
+        self._plugin_cache = self._read_json(self.PLUGIN_CACHE_FILENAME)
 
         logging.info("Loading plugins...")
 
+        # Unless revalidating, cached plugins are registered right away, even
+        # if stale: they get revalidated in the background once the router is
+        # open. Everything else is discovered concurrently.
+        fetched = self.plugins if revalidate else \
+            [netloc for netloc in self.plugins if netloc not in self._plugin_cache]
+        if fetched:
+            async with self._get_discovery_session() as session:
+                entries = await asyncio.gather(
+                    *[self._fetch_plugin(session, netloc, self._plugin_cache.get(netloc))
+                      for netloc in fetched])
+
+            for netloc, entry in zip(fetched, entries):
+                self._update_cache(netloc, entry)
+
         self.registry = {}
-        plugin_auth_update = {}
-        for netloc in list(dict.fromkeys(plugins or [])):
-            try:
-                manifest_url = urlunsplit(
-                    ('http', netloc, '/.well-known/ai-plugin.json', '', ''))
-                response = requests.get(manifest_url)
-                response.raise_for_status()
-                manifest = json.loads(response.text)
-            except Exception as e:
-                logging.info(
-                    f'Unable to load manifest for {netloc}, skipping: {e}')
-                continue
+        self._plugin_auth = {}
+        for netloc in self.plugins:
+            if netloc in self._plugin_cache:
+                self._register(netloc, self._plugin_cache[netloc],
+                               plugin_auth, interactive)
 
-            if manifest["auth"]["type"] not in [self.AUTH_TYPE_NONE, self.AUTH_TYPE_SERVICE_HTTP, self.AUTH_TYPE_USER_HTTP]:
-                logging.info(
-                    f'Plugin {netloc} declares an unsupported auth type, skipping: {manifest["auth"]["type"]}')
-                continue
+        self._write_json(self.PLUGIN_AUTH_FILENAME, self._plugin_auth)
+        self._write_json(self.PLUGIN_CACHE_FILENAME, self._plugin_cache)
 
-            if netloc not in plugin_auth or manifest["auth"]["type"] != plugin_auth[netloc]["type"]:
-                plugin_auth_update[netloc] = {
-                    "type": manifest["auth"]["type"]
-                }
+        if self.registry:
+            logging.info("Plugins loaded: " +
+                         ", ".join([p["netloc"] for p in self.registry.values()]))
+        else:
+            logging.info("No plugins loaded.")
 
-                if manifest["auth"]["type"] in [self.AUTH_TYPE_SERVICE_HTTP, self.AUTH_TYPE_USER_HTTP]:
-                    plugin_auth_update[netloc]["token"] = input(
-                        f'Enter access token for {manifest["name_for_human"]}: ')
-            else:
-                plugin_auth_update[netloc] = plugin_auth[netloc].copy()
+    async def refresh(self, netlocs: List[str]):
+        async with self._get_discovery_session() as session:
+            entries = await asyncio.gather(
+                *[self._fetch_plugin(session, netloc, self._plugin_cache.get(netloc))
+                  for netloc in netlocs])
 
-            try:
-                response = requests.get(manifest["api"]["url"])
-                response.raise_for_status()
-            except Exception as e:
-                logging.info(
-                    f'Unable to fetch OpenAPI specification for {netloc}, skipping: {e}')
-                continue
+        for netloc, entry in zip(netlocs, entries):
+            if self._update_cache(netloc, entry) \
+                    or entry and not any(p["netloc"] == netloc for p in self.registry.values()):
+                logging.info(f"Updating plugin {netloc}")
+                self._register(netloc, entry, self._plugin_auth,
+                               interactive=False)
+
+        self._write_json(self.PLUGIN_CACHE_FILENAME, self._plugin_cache)
+
+    def _update_cache(self, netloc: str, entry: Optional[Dict[str, Any]]) -> bool:
+        # Stores a freshly fetched entry and returns whether the plugin has
+        # changed. A plugin that couldn't be fetched keeps its cached entry,
+        # to be tried again later.
+        cached_entry = self._plugin_cache.get(netloc)
+        if entry is None:
+            if cached_entry:
+                cached_entry["fetched_at"] = time.time()
+            return False
+
+        changed = not cached_entry or cached_entry["hash"] != entry["hash"]
+        if not changed and "spec_valid" in cached_entry:
+            # The spec hasn't changed, so it needn't be checked again
+            entry["spec_valid"] = cached_entry["spec_valid"]
+
+        self._plugin_cache[netloc] = entry
+        return changed
+
+    async def _refresh_stale(self):
+        while True:
+            now = time.time()
+            stale = [netloc for netloc in self.plugins
+                     if netloc not in self._plugin_cache
+                     or now - self._plugin_cache[netloc]["fetched_at"] >= self.cache_ttl]
+
+            if stale:
+                try:
+                    await self.refresh(stale)
+                except Exception as e:
+                    logging.error(f"Error refreshing plugins: {e}")
+
+            expires = [entry["fetched_at"] + self.cache_ttl
+                       for netloc, entry in self._plugin_cache.items()
+                       if netloc in self.plugins]
+            delay = min(expires) - time.time() if expires else self.cache_ttl
+            await asyncio.sleep(max(delay, 1))
 
-            content_type = response.headers.get('Content-Type')
+    def _register(
+        self,
+        netloc: str,
+        entry: Dict[str, Any],
+        plugin_auth: Dict[str, Dict],
+        interactive: bool
+    ):
+        manifest = entry["manifest"]
+
+        if manifest["auth"]["type"] not in [self.AUTH_TYPE_NONE, self.AUTH_TYPE_SERVICE_HTTP, self.AUTH_TYPE_USER_HTTP]:
+            logging.info(
+                f'Plugin {netloc} declares an unsupported auth type, skipping: {manifest["auth"]["type"]}')
+            return
+
+        if netloc not in plugin_auth or manifest["auth"]["type"] != plugin_auth[netloc]["type"]:
+            auth = {
+                "type": manifest["auth"]["type"]
+            }
+
+            if manifest["auth"]["type"] in [self.AUTH_TYPE_SERVICE_HTTP, self.AUTH_TYPE_USER_HTTP]:
+                if not interactive:
+                    logging.info(
+                        f'Plugin {netloc} requires an access token, skipping: Unable to ask for one')
+                    return
+
+                auth["token"] = input(
+                    f'Enter access token for {manifest["name_for_human"]}: ')
+        else:
+            auth = plugin_auth[netloc].copy()
+
+        self._plugin_auth[netloc] = auth
+
+        plugin = {
+            "netloc": netloc,
+            "manifest": manifest,
+            "spec_dict": entry["spec_dict"],
+            "auth": auth,
+            "settings": self.get_plugin_settings(netloc),
+            "hash": entry["hash"]
+        }
+
+        previous = self._previous_registry.get(netloc)
+        if previous and previous["hash"] == entry["hash"]:
+            if "validator" in previous:
+                plugin["validator"] = previous["validator"]
+            plugin["operations"] = previous["operations"]
+        else:
+            self._compile(netloc, plugin, entry)
+
+        # Swap in a new registry rather than mutating the current one, so that
+        # anyone holding on to it sees a consistent snapshot
+        registry = {name: p for name, p in self.registry.items()
+                    if p["netloc"] != netloc}
+        registry[manifest["name_for_model"]] = plugin
+        self.registry = registry
+        self.operation_index = OperationIndex(
+            operation for p in registry.values() for operation in p["operations"])
+
+    def _compile(self, netloc: str, plugin: Dict[str, Any], entry: Dict[str, Any]):
+        try:
+            # Validate the spec, then compile its request validators once. The
+            # outcome is cached with the spec, so that openapi-core, which
+            # takes a while to import, is only loaded for new specs.
+            if "spec_valid" not in entry:
+                entry["spec_valid"] = False
+                import openapi_core
+                openapi_core.Spec.create(data=plugin["spec_dict"])
+                entry["spec_valid"] = True
+            if not entry["spec_valid"]:
+                raise ValueError("Invalid OpenAPI specification")
+            plugin["validator"] = RequestValidator(plugin["spec_dict"])
+        except Exception as e:
+            logging.warn(
+                f"Warning: Invalid OpenAPI specification for {netloc}. Horace will be unable to validate LLM requests to this plugin against the spec. Invalid spec presented to LLM may also cause it to form incorrect requests.")
+
+        # Standalone descriptions of the operations, for prompts that only
+        # include the relevant ones
+        try:
+            plugin["operations"] = OperationIndex.get_operations(
+                plugin["manifest"]["name_for_model"], plugin["spec_dict"])
+        except Exception as e:
+            logging.warn(
+                f"Warning: Unable to index the operations of {netloc}: {e}")
+            plugin["operations"] = []
+
+    async def _fetch_plugin(
+        self,
+        session: aiohttp.ClientSession,
+        netloc: str,
+        cached_entry: Optional[Dict[str, Any]] = None
+    ) -> Optional[Dict[str, Any]]:
+        cached_entry = cached_entry or {}
+
+        try:
+            manifest_url = urlunsplit(
+                ('http', netloc, '/.well-known/ai-plugin.json', '', ''))
+            text, _, manifest_validators = await self._fetch(
+                session, manifest_url, cached_entry.get("manifest_validators"))
+            manifest = cached_entry["manifest"] if text is None else json.loads(
+                text)
+            spec_url = manifest["api"]["url"]
+        except Exception as e:
+            logging.info(
+                f'Unable to load manifest for {netloc}, skipping: {e}')
+            return None
+
+        try:
+            text, content_type, spec_validators = await self._fetch(
+                session, spec_url, cached_entry.get("spec_validators")
+                if cached_entry.get("spec_url") == spec_url else None)
+        except Exception as e:
+            logging.info(
+                f'Unable to fetch OpenAPI specification for {netloc}, skipping: {e}')
+            return None
+
+        if text is None:
+            spec_dict = cached_entry["spec_dict"]
+        else:
             if not content_type:
                 logging.info(
                     f'Unable to parse OpenAPI specification for {netloc}, skipping: No Content-Type header set')
-                continue
+                return None
 
             mime_type = content_type.split(';')[0].strip()
             if mime_type not in self.MIME_TYPES_JSON + self.MIME_TYPES_YAML:
                 logging.info(
                     f'Unable to parse OpenAPI specification for {netloc}, skipping: Unsupported MIME type: {mime_type}')
-                continue
+                return None
 
             try:
-                spec_dict = json.loads(
-                    response.text) if mime_type in self.MIME_TYPES_JSON else yaml.safe_load(response.text)
+                if mime_type in self.MIME_TYPES_JSON:
+                    spec_dict = json.loads(text)
+                else:
+                    import yaml
+                    spec_dict = yaml.safe_load(text)
             except Exception as e:
                 logging.info(
                     f'Unable to parse OpenAPI specification for {netloc}, skipping: {e}')
-                continue
+                return None
 
-            self.registry[manifest["name_for_model"]] = {
-                "netloc": netloc,
-                "manifest": manifest,
-                "spec_dict": spec_dict,
-                "auth": plugin_auth_update[netloc]
-            }
+        return {
+            "manifest": manifest,
+            "manifest_validators": manifest_validators,
+            "spec_url": spec_url,
+            "spec_dict": spec_dict,
+            "spec_validators": spec_validators,
+            "hash": self.get_plugin_hash(manifest, spec_dict),
+            "fetched_at": time.time()
+        }
+
+    async def _fetch(
+        self,
+        session: aiohttp.ClientSession,
+        url: str,
+        validators: Optional[Dict[str, str]] = None
+    ) -> Tuple[Optional[str], Optional[str], Dict[str, str]]:
+        # Returns None in place of the body if the cached copy is still valid
+        validators = validators or {}
+
+        headers = {}
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+        try:
+            async with session.get(url, headers=headers) as response:
+                if response.status == 304:
+                    return None, None, validators
+
+                response.raise_for_status()
+                text = await response.text()
+        except asyncio.TimeoutError:
+            raise ValueError(f"Request to {url} timed out")
+
+        return text, response.headers.get("Content-Type"), {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified")
+        }
+
+    def _get_discovery_session(self) -> aiohttp.ClientSession:
+        return aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=self.discovery_timeout))
+
+    def _read_json(self, filename: str) -> Dict:
+        if os.path.isfile(filename):
+            with open(filename, 'r') as f:
+                return json.load(f)
 
+        return {}
+
+    def _write_json(self, filename: str, data: Dict):
+        # Write atomically, as several worker processes may share the file
+        tmp_filename = f"{filename}.{os.getpid()}.tmp"
+        with open(tmp_filename, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_filename, filename)
+
+    def prepare(self, plugin_name: str, request_params: Dict, repair: bool = False) -> Dict:
+        # With repair, a request that fails validation is fixed up against
+        # the plugin's spec where possible, and request_params are updated in
+        # place with the fixes, so that the caller can tell what was sent. If
+        # it still fails, the error is that of the request as given.
+        start = time.perf_counter()
+        try:
             try:
-                self.registry[manifest["name_for_model"]]["spec"] = openapi_core.Spec.create(
-                    data=spec_dict)
-            except Exception as e:
-                logging.warn(
-                    f"Warning: Invalid OpenAPI specification for {netloc}. Horace will be unable to validate LLM requests to this plugin against the spec. Invalid spec presented to LLM may also cause it to form incorrect requests.")
+                return self._prepare(plugin_name, request_params)
+            except ValueError as e:
+                repaired_params = self._repair(plugin_name, request_params) if repair else None
+                if repaired_params is None:
+                    raise
 
-        with open(self.PLUGIN_AUTH_FILENAME, 'w') as f:
-            json.dump(plugin_auth_update, f)
+                try:
+                    prepared_params = self._prepare(plugin_name, repaired_params)
+                except ValueError:
+                    metrics.plugin_call_repairs.inc(plugin_name, "failed")
+                    raise e
 
-        if self.registry:
-            logging.info("Plugins loaded: " +
-                         ", ".join([p["netloc"] for p in self.registry.values()]))
-        else:
-            logging.info("No plugins loaded.")
+                metrics.plugin_call_repairs.inc(plugin_name, "repaired")
+                request_params.clear()
+                request_params.update(repaired_params)
+                return prepared_params
+        except ValueError:
+            metrics.plugin_invalid_requests.inc(plugin_name)
+            raise
+        finally:
+            metrics.plugin_prepare_seconds.observe(
+                metrics.elapsed(start), plugin_name)
 
-    def prepare(self, plugin_name: str, request_params: Dict) -> Dict:
+    def _repair(self, plugin_name: str, request_params: Dict) -> Optional[Dict]:
+        plugin = self.registry.get(plugin_name)
+        if not plugin or "validator" not in plugin or not isinstance(request_params, dict):
+            return None
+
+        repaired_params, fixes = call_repair.repair_request(
+            plugin["validator"], request_params, plugin["manifest"]["api"]["url"])
+        if not fixes:
+            return None
+
+        logging.info(f"Repaired the request to {plugin_name}: {'; '.join(fixes)}")
+        return repaired_params
+
+    def _prepare(self, plugin_name: str, request_params: Dict) -> Dict:
         if plugin_name not in self.registry:
             raise ValueError(f"Unknown plugin: {plugin_name}")
 
+        for key in ["params", "headers"]:
+            if request_params.get(key) is not None and not isinstance(request_params[key], dict):
+                raise ValueError(f"Request {key} must be an object")
+
         # Add authorization headers, if any
         if self.registry[plugin_name]["auth"]["type"] == self.AUTH_TYPE_USER_HTTP:
             extra_headers = {
                 'Authorization': f'Bearer {self.registry[plugin_name]["auth"]["token"]}'
             }
-            if "headers" in request_params:
-                request_params["headers"].update(extra_headers)
-            else:
-                request_params["headers"] = extra_headers
+            # The caller's params are left as they are, without the token
+            request_params = {**request_params,
+                              "headers": {**(request_params.get("headers") or {}), **extra_headers}}
 
-        request = requests.Request(**request_params)
+        unsupported_params = set(request_params) - set(self.REQUEST_PARAMS)
+        if unsupported_params:
+            raise ValueError(
+                f"Unsupported request parameters: {', '.join(sorted(unsupported_params))}")
+        if not request_params.get("method") or not request_params.get("url"):
+            raise ValueError("Request method and URL are required")
+        if not urlsplit(request_params["url"]).netloc:
+            raise ValueError(f"Request URL must be absolute: {request_params['url']}")
 
         # Validate the request against the plugin's OpenAPI spec
-        if "spec" in self.registry[plugin_name]:
-            openapi_request = RequestsOpenAPIRequest(request)
+        if "validator" in self.registry[plugin_name]:
             try:
-                openapi_core.validate_request(
-                    openapi_request, spec=self.registry[plugin_name]["spec"])
+                self.registry[plugin_name]["validator"].validate(
+                    **request_params)
             except RequestValidationError as e:
                 raise ValueError(
                     f"Error validating the request against the plugin's OpenAPI spec: {e}")
 
-        # Prepare aiohttp request params
-        return {key: request_params.get(key)
-                for key in ['method', 'url', 'headers', 'params', 'data', 'json']}
+        # Prepare aiohttp request params, which take no booleans or None in
+        # the query. Parameters set to None are left out, as if not given.
+        prepared_params = {key: request_params.get(key) for key in self.REQUEST_PARAMS}
+        if prepared_params["params"] is not None:
+            prepared_params["params"] = {name: call_repair.to_query_value(value)
+                                         for name, value in prepared_params["params"].items()
+                                         if value is not None}
+        return prepared_params
+
+    @staticmethod
+    def get_plugin_hash(manifest: Dict, spec_dict: Dict) -> str:
+        # Identifies the plugin definition presented to the LLM, so that
+        # anything rendered from it can be cached until it changes
+        data = json.dumps([manifest, spec_dict], sort_keys=True)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def get_plugin_settings(self, netloc: str) -> Dict[str, Any]:
+        return {**self.plugin_defaults, **(self.plugin_settings.get(netloc) or {})}
+
+    async def open(self):
+        for plugin_name in self.registry:
+            self._get_session(plugin_name)
+
+        if self.plugins and self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh_stale())
+
+    async def close(self):
+        probe_tasks = list(self._probe_tasks.values())
+        self._probe_tasks = {}
+        for task in probe_tasks:
+            task.cancel()
+        if probe_tasks:
+            await asyncio.wait(probe_tasks)
+
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+            self._refresh_task = None
+
+        sessions = list(self.sessions.values())
+        self.sessions = {}
+        for session in sessions:
+            await session.close()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _get_session(self, plugin_name: str) -> aiohttp.ClientSession:
+        # One long-lived session per plugin, so that calls to the same plugin
+        # reuse warm keep-alive connections within its own connection limit
+        session = self.sessions.get(plugin_name)
+        if session is None or session.closed:
+            settings = self.registry[plugin_name]["settings"]
+            connector = aiohttp.TCPConnector(
+                limit=settings["connection_limit"],
+                ttl_dns_cache=settings["dns_cache_ttl"],
+                keepalive_timeout=settings["keepalive_timeout"]
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=settings["total_timeout"],
+                sock_connect=settings["connect_timeout"],
+                sock_read=settings["read_timeout"]
+            )
+            session = aiohttp.ClientSession(
+                connector=connector, timeout=timeout)
+            self.sessions[plugin_name] = session
+
+        return session
+
+    async def send(self, plugin_name: str, prepared_request_params: Dict) -> Tuple[int, str]:
+        if plugin_name not in self.registry:
+            raise ValueError(f"Unknown plugin: {plugin_name}")
+
+        start = time.perf_counter()
+        try:
+            status, text = await self._get_response(plugin_name, prepared_request_params)
+        except PluginRequestError:
+            metrics.plugin_requests.inc(plugin_name, "error")
+            raise
+        finally:
+            metrics.plugin_request_seconds.observe(
+                metrics.elapsed(start), plugin_name)
+
+        metrics.plugin_requests.inc(plugin_name, str(status))
+        return status, text
+
+    async def _get_response(self, plugin_name: str, prepared_request_params: Dict) -> Tuple[int, str]:
+        cache_key = self._get_cache_key(plugin_name, prepared_request_params)
+        if cache_key is None:
+            status, text, _ = await self._send(plugin_name, prepared_request_params)
+            return status, text
+
+        cached_response = self.response_cache.get(cache_key)
+        if cached_response:
+            logging.debug(f"Serving cached response for {cache_key}")
+            metrics.plugin_cache_hits.inc(plugin_name)
+            return cached_response
+
+        # Identical requests in flight at the same time share one fetch
+        return await self._requests_in_flight.run(
+            cache_key, lambda: self._send_cached(plugin_name, prepared_request_params, cache_key))
+
+    async def _send_cached(self, plugin_name: str, prepared_request_params: Dict, cache_key: Tuple) -> Tuple[int, str]:
+        status, text, cache_control = await self._send(
+            plugin_name, prepared_request_params)
+
+        if status == 200:
+            ttl = self._get_cache_ttl(
+                self.registry[plugin_name]["settings"], cache_control)
+            if ttl:
+                self.response_cache.set(cache_key, (status, text), ttl)
+
+        return status, text
+
+    @property
+    def unavailable_plugins(self) -> frozenset:
+        # Plugins whose circuit isn't closed
+        return frozenset(name for name, circuit in self.circuits.items()
+                         if not circuit.available and name in self.registry)
 
-    async def send(self, prepared_request_params: Dict) -> str:
-        async with aiohttp.ClientSession() as session:
+    def _get_circuit(self, plugin_name: str) -> CircuitBreaker:
+        circuit = self.circuits.get(plugin_name)
+        if circuit is None:
+            settings = self.registry[plugin_name]["settings"]
+            circuit = CircuitBreaker(
+                window_seconds=settings["circuit_window"],
+                min_requests=settings["circuit_min_requests"],
+                error_rate=settings["circuit_error_rate"],
+                open_seconds=settings["circuit_open_seconds"],
+                slow_call_seconds=settings["circuit_slow_call_seconds"]
+            )
+            self.circuits[plugin_name] = circuit
+
+        return circuit
+
+    async def _send(self, plugin_name: str, prepared_request_params: Dict) -> Tuple[int, str, str]:
+        circuit = self._get_circuit(plugin_name)
+        if not circuit.available:
+            metrics.plugin_rejected_requests.inc(plugin_name)
+            raise PluginRequestError(
+                "Plugin is temporarily unavailable, please try again later")
+
+        start = time.perf_counter()
+        try:
+            status, text, cache_control = await self._send_request(
+                plugin_name, prepared_request_params)
+        except PluginRequestError:
+            self._record_outcome(plugin_name, True, time.perf_counter() - start)
+            raise
+
+        self._record_outcome(
+            plugin_name, status >= 500 or status in self.CIRCUIT_FAILURE_STATUSES,
+            time.perf_counter() - start)
+        return status, text, cache_control
+
+    def _record_outcome(self, plugin_name: str, failed: bool, seconds: float):
+        circuit = self._get_circuit(plugin_name)
+        if circuit.record(failed, seconds):
+            logging.warning(
+                f"Plugin {plugin_name} is failing ({circuit.error_rate:.0%} errors, "
+                f"{circuit.latency:.1f}s mean latency), pausing requests for {circuit.open_seconds}s")
+            metrics.plugin_circuit_open.inc(plugin_name)
+            self._probe_tasks[plugin_name] = asyncio.create_task(
+                self._probe(plugin_name, circuit))
+
+    async def _probe(self, plugin_name: str, circuit: CircuitBreaker):
+        # Checks on the plugin in the background until it responds again, by
+        # fetching its manifest
+        try:
+            while True:
+                await asyncio.sleep(circuit.open_seconds)
+                circuit.half_open()
+
+                plugin = self.registry.get(plugin_name)
+                if plugin is None:
+                    break
+
+                url = urlunsplit(
+                    ('http', plugin["netloc"], '/.well-known/ai-plugin.json', '', ''))
+                try:
+                    async with self._get_session(plugin_name).get(url) as response:
+                        await response.read()
+                        healthy = response.status < 500 and \
+                            response.status not in self.CIRCUIT_FAILURE_STATUSES
+                except (asyncio.TimeoutError, aiohttp.ClientError):
+                    healthy = False
+
+                if healthy:
+                    break
+
+                logging.info(f"Plugin {plugin_name} is still failing")
+                circuit.open()
+
+            logging.info(f"Plugin {plugin_name} is available again")
+            circuit.close()
+            metrics.plugin_circuit_open.dec(plugin_name)
+        finally:
+            if self._probe_tasks.get(plugin_name) is asyncio.current_task():
+                del self._probe_tasks[plugin_name]
+
+    async def _send_request(self, plugin_name: str, prepared_request_params: Dict) -> Tuple[int, str, str]:
+        settings = self.registry[plugin_name]["settings"]
+        max_bytes = settings["max_response_bytes"]
+
+        session = self._get_session(plugin_name)
+        try:
             async with session.request(**prepared_request_params) as response:
-                text = await response.text()
+                mime_type = response.content_type
+                # JSON is compacted before it is cut down to size, so more of
+                # it is read
+                read_bytes = max_bytes
+                if mime_type in self.MIME_TYPES_JSON and max_bytes is not None:
+                    read_bytes = max(max_bytes, settings["max_json_read_bytes"] or 0)
+
+                # Read no more than the limit, however large the body
+                body = bytearray()
+                truncated = False
+                async for chunk in response.content.iter_chunked(self.RESPONSE_CHUNK_SIZE):
+                    body += chunk
+                    if read_bytes is not None and len(body) > read_bytes:
+                        del body[read_bytes:]
+                        truncated = True
+                        break
+
+                text = body.decode(response.charset or "utf-8", errors="replace")
+                cache_control = response.headers.get("Cache-Control", "")
+        except asyncio.TimeoutError:
+            raise PluginRequestError("API request timed out")
+        except aiohttp.ClientError as e:
+            raise PluginRequestError(f"API request failed: {e}")
+
+        if mime_type in self.MIME_TYPES_JSON and not truncated:
+            text = self._compact_json(
+                plugin_name, prepared_request_params, response.status, text)
+
+        if max_bytes is not None:
+            encoded = text.encode("utf-8")
+            if truncated or len(encoded) > max_bytes:
+                # Cut on a character boundary
+                text = encoded[:max_bytes].decode("utf-8", errors="ignore") + " ... (response truncated)"
+
+        return response.status, text, cache_control
+
+    def _get_cache_key(self, plugin_name: str, prepared_request_params: Dict) -> Optional[Tuple]:
+        method = prepared_request_params["method"].upper()
+        if method not in self.CACHEABLE_METHODS or prepared_request_params.get("data") is not None \
+                or prepared_request_params.get("json") is not None:
+            return None
+
+        # Normalize the URL and merge its query string with the params, so
+        # that equivalent requests share an entry
+        parts = urlsplit(prepared_request_params["url"])
+        params = parse_qsl(parts.query, keep_blank_values=True)
+        for name, value in (prepared_request_params.get("params") or {}).items():
+            values = value if isinstance(value, list) else [value]
+            params.extend((name, str(v)) for v in values)
+
+        # Responses are never shared between different credentials
+        headers = {name.lower(): value for name, value in (
+            prepared_request_params.get("headers") or {}).items()}
+        headers_hash = hashlib.sha256(json.dumps(
+            headers, sort_keys=True).encode("utf-8")).hexdigest()
+
+        return (
+            plugin_name,
+            method,
+            urlunsplit((parts.scheme.lower(), parts.netloc.lower(),
+                       parts.path or "/", "", "")),
+            tuple(sorted(params)),
+            headers_hash
+        )
+
+    @staticmethod
+    def _get_cache_ttl(settings: Dict[str, Any], cache_control: str) -> float:
+        directives = {}
+        for directive in cache_control.lower().split(","):
+            name, _, value = directive.strip().partition("=")
+            directives[name] = value.strip('"')
+
+        if {"no-store", "no-cache", "private"} & directives.keys():
+            return 0
+
+        if settings["response_cache_ttl"] is not None:
+            return settings["response_cache_ttl"]
+
+        try:
+            return float(directives.get("s-maxage") or directives.get("max-age") or 0)
+        except ValueError:
+            return 0
+
+    def _compact_json(
+        self,
+        plugin_name: str,
+        prepared_request_params: Dict,
+        status: int,
+        text: str
+    ) -> str:
+        try:
+            value = json.loads(text)
+        except ValueError:
+            return text
+
+        plugin = self.registry[plugin_name]
+        settings = plugin["settings"]
+
+        schema = None
+        if settings["prune_to_schema"] and "validator" in plugin:
+            try:
+                operation, _ = plugin["validator"].find_operation(
+                    prepared_request_params["method"], prepared_request_params["url"])
+                schema = operation.get_response_schema(status)
+            except RequestValidationError:
+                pass
+
+        value = response_filter.compact(
+            value,
+            schema=schema,
+            include=settings["response_fields_include"],
+            exclude=settings["response_fields_exclude"],
+            max_array_items=settings["max_array_items"],
+            prune_to_schema=settings["prune_to_schema"]
+        )
 
-        return response.status, text
+        return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
@@ -0,0 +1,269 @@
+import os
+import re
+import abc
+import json
+import uuid
+import sqlite3
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from cache import LRUCache
+from transcript import Transcript, Turn
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+class SessionStore(abc.ABC):
+    # Keeps the transcripts of sessions, so that they can be resumed on
+    # reconnect, by any worker. Turns are appended as turns complete and never
+    # rewritten; a summary of the turns before a position replaces them on
+    # load. Blocking I/O runs on a thread of the store's own.
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def load(self, session_id: str, start: int = 0) -> List[Turn]:
+        # Returns the session's turns from position start onwards
+        return await self._run(self._load, session_id, start)
+
+    async def append(self, session_id: str, start: int, turns: List[Turn]):
+        # Stores the turns at positions from start onwards
+        await self._run(self._append, session_id, start, turns)
+
+    async def load_summary(self, session_id: str) -> Tuple[int, Optional[Turn]]:
+        # Returns the end position and the turn of the session's summary
+        return await self._run(self._load_summary, session_id)
+
+    async def save_summary(self, session_id: str, end: int, summary: Turn):
+        await self._run(self._save_summary, session_id, end, summary)
+
+    async def close(self):
+        await self._run(self._close)
+        self._executor.shutdown()
+
+    @abc.abstractmethod
+    def _load(self, session_id: str, start: int) -> List[Turn]:
+        pass
+
+    @abc.abstractmethod
+    def _append(self, session_id: str, start: int, turns: List[Turn]):
+        pass
+
+    @abc.abstractmethod
+    def _load_summary(self, session_id: str) -> Tuple[int, Optional[Turn]]:
+        pass
+
+    @abc.abstractmethod
+    def _save_summary(self, session_id: str, end: int, summary: Turn):
+        pass
+
+    def _close(self):
+        pass
+
+    async def _run(self, fn: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+
+class SQLiteSessionStore(SessionStore):
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._connection = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            # WAL lets workers read while another one writes
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS turns (
+                session_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                speaker TEXT NOT NULL,
+                text TEXT NOT NULL,
+                tokens INTEGER NOT NULL,
+                PRIMARY KEY (session_id, position)
+            ) WITHOUT ROWID""")
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS summaries (
+                session_id TEXT NOT NULL PRIMARY KEY,
+                end_position INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                speaker TEXT NOT NULL,
+                text TEXT NOT NULL,
+                tokens INTEGER NOT NULL
+            ) WITHOUT ROWID""")
+
+        return self._connection
+
+    def _load(self, session_id: str, start: int) -> List[Turn]:
+        rows = self._connect().execute(
+            "SELECT role, speaker, text, tokens FROM turns WHERE session_id = ? AND position >= ? ORDER BY position",
+            (session_id, start)
+        )
+        return [Turn(*row) for row in rows]
+
+    def _append(self, session_id: str, start: int, turns: List[Turn]):
+        with self._connect() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO turns VALUES (?, ?, ?, ?, ?, ?)",
+                [(session_id, start + i, *turn) for i, turn in enumerate(turns)]
+            )
+
+    def _load_summary(self, session_id: str) -> Tuple[int, Optional[Turn]]:
+        row = self._connect().execute(
+            "SELECT end_position, role, speaker, text, tokens FROM summaries WHERE session_id = ?",
+            (session_id,)
+        ).fetchone()
+        return (row[0], Turn(*row[1:])) if row else (0, None)
+
+    def _save_summary(self, session_id: str, end: int, summary: Turn):
+        # The summarized turns are kept, so that the full transcript of a
+        # session stays on record
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?, ?, ?)",
+                (session_id, end, *summary)
+            )
+
+    def _close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class FileSessionStore(SessionStore):
+    # One JSONL file per session, with a line per turn, and a JSON file with
+    # its summary
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _load(self, session_id: str, start: int) -> List[Turn]:
+        turns = []
+        try:
+            with open(self._get_filename(session_id), encoding="utf-8") as f:
+                for line in f:
+                    position, *turn = json.loads(line)
+                    if position >= start:
+                        turns.append(Turn(*turn))
+        except FileNotFoundError:
+            pass
+
+        return turns
+
+    def _append(self, session_id: str, start: int, turns: List[Turn]):
+        with open(self._get_filename(session_id), "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps([start + i, *turn]) + "\n"
+                            for i, turn in enumerate(turns)))
+
+    def _load_summary(self, session_id: str) -> Tuple[int, Optional[Turn]]:
+        try:
+            with open(self._get_filename(session_id, ".summary.json"), encoding="utf-8") as f:
+                end, *summary = json.load(f)
+        except FileNotFoundError:
+            return 0, None
+
+        return end, Turn(*summary)
+
+    def _save_summary(self, session_id: str, end: int, summary: Turn):
+        # Written to a temporary file first, so that a reader never sees half
+        # of it
+        filename = self._get_filename(session_id, ".summary.json")
+        with open(filename + ".tmp", "w", encoding="utf-8") as f:
+            json.dump([end, *summary], f)
+        os.replace(filename + ".tmp", filename)
+
+    def _get_filename(self, session_id: str, extension: str = ".jsonl") -> str:
+        return os.path.join(self.path, session_id + extension)
+
+
+class SessionManager():
+    # Hands out transcripts to connections by session ID. Transcripts of
+    # sessions that are no longer connected stay in memory until they are
+    # evicted least recently used first, or expire; they are then loaded from
+    # the store on reconnect. A session that is still connected elsewhere in
+    # the process is taken over from the old connection.
+    SESSION_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+    STORES = {
+        "sqlite": SQLiteSessionStore,
+        "file": FileSessionStore
+    }
+
+    def __init__(
+        self,
+        store: Optional[SessionStore] = None,
+        max_idle_sessions: int = 1000,
+        idle_ttl: float = 3600
+    ):
+        self.store = store
+        self.idle_ttl = idle_ttl
+        self.idle_sessions = LRUCache(max_entries=max_idle_sessions)
+        # Close coroutines and release futures of connected sessions
+        self._active: Dict[str, Tuple[Callable[[], Awaitable], asyncio.Future]] = {}
+
+    async def open(
+        self,
+        session_id: Optional[str],
+        count_tokens: Callable[[str], int],
+        close_coroutine: Callable[[], Awaitable]
+    ) -> Tuple[str, Transcript, bool]:
+        # Returns the session ID, the transcript and whether the session was
+        # resumed. Unknown session IDs get a new session under a new ID, so
+        # that clients can't pick the IDs.
+        if session_id and not self.SESSION_ID_PATTERN.fullmatch(session_id):
+            session_id = None
+
+        if session_id in self._active:
+            close, released = self._active[session_id]
+            logging.info(f"Session {session_id} reconnected, closing the old connection")
+            await close()
+            await released
+
+        transcript = None
+        if session_id:
+            transcript = self.idle_sessions.pop(session_id)
+
+            if transcript is None:
+                transcript = Transcript(count_tokens)
+                if self.store:
+                    # The summarized turns aren't needed
+                    end, summary = await self.store.load_summary(session_id)
+                    if summary:
+                        transcript.summarize(end, summary)
+                    transcript.extend(await self.store.load(session_id, end))
+                if not transcript.end:
+                    transcript = None
+                    session_id = None
+            elif self.store:
+                # Catch up with turns appended by other workers
+                transcript.extend(await self.store.load(session_id, transcript.end))
+
+        resumed = transcript is not None
+        if not resumed:
+            session_id = uuid.uuid4().hex
+            transcript = Transcript(count_tokens)
+
+        self._active[session_id] = (
+            close_coroutine, asyncio.get_running_loop().create_future())
+        return session_id, transcript, resumed
+
+    async def append(self, session_id: str, start: int, turns: List[Turn]):
+        if self.store and turns:
+            await self.store.append(session_id, start, turns)
+
+    async def save_summary(self, session_id: str, end: int, summary: Turn):
+        if self.store:
+            await self.store.save_summary(session_id, end, summary)
+
+    def release(self, session_id: str, transcript: Transcript):
+        _, released = self._active.pop(session_id)
+        released.set_result(None)
+        if transcript.end:
+            self.idle_sessions.set(session_id, transcript, self.idle_ttl)
+
+    async def close(self):
+        if self.store:
+            await self.store.close()
+
+    @classmethod
+    def from_config(cls, store: Optional[str] = None, path: Optional[str] = None, **kwargs) -> "SessionManager":
+        return cls(cls.STORES[store](path) if store else None, **kwargs)
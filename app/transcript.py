@@ -0,0 +1,78 @@
+from typing import NamedTuple, Callable, Iterator, List
+
+
+class Turn(NamedTuple):
+    role: str
+    speaker: str
+    text: str
+    tokens: int
+
+
+class Transcript():
+    # Per-message overhead of the chat format, in tokens
+    TOKENS_PER_TURN = 4
+
+    def __init__(self, count_tokens: Callable[[str], int]):
+        self.count_tokens = count_tokens
+        self.turns = []
+        self.tokens = 0
+        # Number of turns evicted from the start of the transcript
+        self.evicted = 0
+        # Summary of the turns before position summary_end, if any
+        self.summary = None
+        self.summary_end = 0
+
+    def __len__(self) -> int:
+        return len(self.turns)
+
+    def __iter__(self) -> Iterator[Turn]:
+        return iter(self.turns)
+
+    @property
+    def end(self) -> int:
+        # Position past the last turn, counting evicted turns
+        return self.evicted + len(self.turns)
+
+    def append(self, role: str, speaker: str, text: str) -> Turn:
+        turn = Turn(role, speaker, text,
+                    self.count_tokens(text) + self.TOKENS_PER_TURN)
+        self.turns.append(turn)
+        self.tokens += turn.tokens
+
+        return turn
+
+    def extend(self, turns: List[Turn]):
+        # Adds turns whose tokens are already counted, e.g. from a store
+        self.turns.extend(turns)
+        self.tokens += sum(turn.tokens for turn in turns)
+
+    def evict(self, max_tokens: int) -> List[Turn]:
+        # Drops the oldest turns until the rest fit into max_tokens. The
+        # latest turn is always kept.
+        count = 0
+        tokens = self.tokens
+        while count < len(self.turns) - 1 and tokens > max_tokens:
+            tokens -= self.turns[count].tokens
+            count += 1
+
+        evicted = self.turns[:count]
+        if evicted:
+            del self.turns[:count]
+            self.tokens = tokens
+            self.evicted += count
+
+        return evicted
+
+    def summarize(self, end: int, summary: Turn):
+        # Replaces the turns before position end with their summary, which
+        # also covers the previous summary
+        del self.turns[:max(end - self.evicted, 0)]
+        self.tokens = sum(turn.tokens for turn in self.turns)
+        self.evicted = max(self.evicted, end)
+        self.summary = summary
+        self.summary_end = end
+
+    def truncate(self, end: int):
+        # Drops the turns from position end onwards
+        del self.turns[max(end - self.evicted, 0):]
+        self.tokens = sum(turn.tokens for turn in self.turns)
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+from chatbot import Chatbot
+from typing import Callable, Coroutine, List, Optional, Set
+
+
+class TurnRunner():
+    # Runs the chatbot's turns as tasks, so that they can be cancelled when the
+    # client goes away. The busy policy determines what happens to messages
+    # arriving while a turn is in progress:
+    #
+    # - queue: each message gets a turn of its own once the current one is done
+    # - coalesce: all waiting messages go into the next turn together
+    # - interrupt: the current turn is cancelled and restarted with its
+    #   messages and the new one. The interrupted coroutine is awaited before
+    #   the restart, so that clients can discard the cancelled turn's
+    #   streamed text.
+    POLICY_QUEUE = "queue"
+    POLICY_COALESCE = "coalesce"
+    POLICY_INTERRUPT = "interrupt"
+
+    def __init__(
+        self,
+        chatbot: Chatbot,
+        error_coroutine: Callable[[Exception], Coroutine],
+        busy_policy: str = POLICY_QUEUE,
+        ended_coroutine: Optional[Callable[[], Coroutine]] = None,
+        interrupted_coroutine: Optional[Callable[[], Coroutine]] = None
+    ):
+        if busy_policy not in [self.POLICY_QUEUE, self.POLICY_COALESCE, self.POLICY_INTERRUPT]:
+            raise ValueError(f"Unknown busy policy: {busy_policy}")
+
+        self.chatbot = chatbot
+        self.error_coroutine = error_coroutine
+        self.busy_policy = busy_policy
+        self.ended_coroutine = ended_coroutine
+        self.interrupted_coroutine = interrupted_coroutine
+
+        self._task = None
+        self._responses = []
+        self._pending = []
+        self._unwinding: Set[asyncio.Task] = set()
+
+    @property
+    def busy(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def submit(self, response: str):
+        if self.chatbot.state == self.chatbot.STATE_ENDED:
+            return
+
+        if not self.busy:
+            self._start([response])
+        elif self.busy_policy == self.POLICY_INTERRUPT:
+            logging.debug("Interrupting the current turn")
+            responses = self._responses + [response]
+            self._cancel()
+            self._start(responses, interrupted=True)
+        else:
+            self._pending.append(response)
+
+    async def join(self):
+        while self.busy:
+            await asyncio.wait([self._task])
+
+    async def close(self):
+        self._pending = []
+        self._cancel()
+
+        if self._unwinding:
+            await asyncio.wait(list(self._unwinding))
+
+    def _start(self, responses: List[str], interrupted: bool = False):
+        self._responses = responses
+        self._task = asyncio.create_task(self._run(responses, interrupted))
+
+    def _cancel(self):
+        if self.busy:
+            self._task.cancel()
+            self._unwinding.add(self._task)
+            self._task.add_done_callback(self._unwinding.discard)
+
+    async def _run(self, responses: List[str], interrupted: bool = False):
+        # Let cancelled turns roll back before starting a new one
+        while self._unwinding:
+            await asyncio.wait(list(self._unwinding))
+
+        try:
+            if interrupted and self.interrupted_coroutine:
+                await self.interrupted_coroutine()
+            await self.chatbot.send_responses(responses)
+        except Exception as e:
+            logging.error(f"Error processing turn: {type(e).__name__}: {e}")
+            try:
+                await self.error_coroutine(e)
+            except Exception:
+                pass
+
+        if self.chatbot.state == self.chatbot.STATE_ENDED:
+            self._pending = []
+            if self.ended_coroutine:
+                await self.ended_coroutine()
+        elif self._pending:
+            if self.busy_policy == self.POLICY_COALESCE:
+                responses, self._pending = self._pending, []
+            else:
+                responses = [self._pending.pop(0)]
+
+            self._start(responses)
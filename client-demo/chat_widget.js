@@ -1,4 +1,5 @@
-const socket = new WebSocket("ws://localhost:8001");
+const serverUrl = "ws://localhost:8001";
+const reconnectDelay = 2000;
 
 const chatMessages = document.getElementById("chat-messages");
 const chatForm = document.getElementById("chat-form");
@@ -6,24 +7,47 @@ const chatInput = document.getElementById("chat-input");
 const chatSend = document.getElementById("chat-send");
 
 let typingBubble = null;
+let streamingBubble = null;
+let streamingText = "";
+let socket = null;
+let sessionEnded = false;
+
+function connect() {
+  // Resume the session of this tab, if any, so that a dropped connection
+  // doesn't restart the conversation. Events sent together arrive batched
+  // in a single message.
+  const sessionId = sessionStorage.getItem("horaceSessionId");
+  const query = sessionId
+    ? `?batch=1&session_id=${encodeURIComponent(sessionId)}`
+    : "?batch=1";
+  socket = new WebSocket(`${serverUrl}/${query}`);
+
+  socket.addEventListener("open", (event) => {
+    console.log("WebSocket connection opened:", event);
+  });
+
+  socket.addEventListener("message", (event) => {
+    const data = JSON.parse(event.data);
+    for (const message of Array.isArray(data) ? data : [data]) {
+      handleMessage(message);
+    }
+  });
 
-socket.addEventListener("open", (event) => {
-  console.log("WebSocket connection opened:", event);
-});
+  socket.addEventListener("error", (event) => {
+    console.error("WebSocket error:", event);
+    displayError("Error connecting to chat server");
+  });
 
-socket.addEventListener("message", (event) => {
-  const data = JSON.parse(event.data);
-  handleMessage(data);
-});
-
-socket.addEventListener("error", (event) => {
-  console.error("WebSocket error:", event);
-  displayError("Error connecting to chat server");
-});
+  socket.addEventListener("close", (event) => {
+    console.log("WebSocket connection closed:", event);
+    if (!sessionEnded) {
+      hideTypingAnimation();
+      setTimeout(connect, reconnectDelay);
+    }
+  });
+}
 
-socket.addEventListener("close", (event) => {
-  console.log("WebSocket connection closed:", event);
-});
+connect();
 
 chatForm.addEventListener("submit", (event) => {
   event.preventDefault();
@@ -33,12 +57,32 @@ chatForm.addEventListener("submit", (event) => {
 
 function handleMessage(data) {
   switch (data.type) {
+    case "utterance_delta":
+      displayDelta(data.text);
+      break;
     case "utterance":
-      displayMessage(data.source, data.text);
+      if (streamingBubble && data.source === "ai") {
+        // The complete utterance supersedes the streamed text
+        streamingBubble.innerHTML = data.text.replace(/\n/g, "<br>");
+        streamingBubble = null;
+      } else {
+        displayMessage(data.source, data.text);
+      }
+      break;
+    case "session":
+      sessionStorage.setItem("horaceSessionId", data.session_id);
+      chatSend.disabled = false;
       break;
     case "state":
       handleState(data.state);
       break;
+    case "interrupted":
+      // The reply being streamed was cancelled and starts over
+      if (streamingBubble) {
+        streamingBubble.remove();
+        streamingBubble = null;
+      }
+      break;
     case "error":
       displayError(data.message);
       break;
@@ -54,11 +98,14 @@ function handleState(state) {
       showTypingAnimation();
       break;
     case "listening":
+      streamingBubble = null;
       chatSend.disabled = false;
       hideTypingAnimation();
       break;
     case "ended":
       chatSend.disabled = true;
+      sessionEnded = true;
+      sessionStorage.removeItem("horaceSessionId");
       socket.close();
       break;
     default:
@@ -75,6 +122,17 @@ function sendMessage(text) {
   displayMessage("user", text);
 }
 
+function displayDelta(text) {
+  if (!streamingBubble) {
+    streamingText = "";
+    streamingBubble = displayMessage("ai", "");
+  }
+
+  streamingText += text;
+  streamingBubble.innerHTML = streamingText.replace(/\n/g, "<br>");
+  chatMessages.scrollTop = chatMessages.scrollHeight;
+}
+
 function displayMessage(source, text) {
   const chatBubble = document.createElement("div");
   chatBubble.classList.add("chat-bubble");
@@ -94,6 +152,7 @@ function displayMessage(source, text) {
   }
 
   chatMessages.scrollTop = chatMessages.scrollHeight;
+  return chatBubble;
 }
 
 function displayError(message) {
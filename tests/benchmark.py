@@ -0,0 +1,181 @@
+import os
+import sys
+import gc
+import time
+import json
+import asyncio
+import argparse
+import logging
+import tempfile
+import statistics
+import websockets
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from router import Router
+from main import get_handler
+from backends.scheduler import BackendScheduler
+from mocks.scripted_backend import ScriptedBackend
+from mocks.plugin_server import MockPluginServer
+from typing import Any, Dict, List, Optional
+
+
+# Runs fully offline: a scripted backend stands in for the LLM and a local mock
+# plugin for the plugin APIs, while the WebSocket handler, chatbot, router and
+# scheduler take their real code paths. Every turn makes one plugin call and
+# takes two completions. Clients and server share the process, so the memory
+# per session includes the client side of the connection.
+
+
+def get_completion(messages: List[Dict[str, str]], plugin_url: str) -> str:
+    last_message = messages[-1]["content"]
+    if last_message.startswith("System: "):
+        return "Here is what I found on your list."
+
+    request = {"method": "GET", "url": f"{plugin_url}/items", "params": {"q": last_message}}
+    return "Let me check your list. <call>" + json.dumps(
+        {"plugin_system_name": MockPluginServer.NAME, "request_object_params": request}) + "</call>"
+
+
+def get_rss() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+async def run_client(uri: str, client_id: int, turns: int, latencies: List[float], done: asyncio.Event):
+    async with websockets.connect(uri, open_timeout=60, max_queue=None) as websocket:
+        for turn in range(turns):
+            start = time.perf_counter()
+            await websocket.send(json.dumps({"type": "utterance", "text": f"item {client_id}-{turn}"}))
+
+            replying = False
+            while True:
+                event = json.loads(await websocket.recv())
+                if event["type"] == "error":
+                    raise RuntimeError(event["message"])
+                if event["type"] == "state":
+                    if event["state"] == "replying":
+                        replying = True
+                    elif replying:
+                        break
+
+            latencies.append(time.perf_counter() - start)
+
+        # Stay connected until all clients are done, so that the memory of
+        # every session is counted
+        await done.wait()
+
+
+async def run_level(handler, clients: int, turns: int) -> Dict[str, Any]:
+    async with websockets.serve(handler, "127.0.0.1", 0, max_queue=None) as server:
+        port = server.sockets[0].getsockname()[1]
+        uri = f"ws://127.0.0.1:{port}"
+
+        gc.collect()
+        rss_before = get_rss()
+
+        latencies = []
+        done = asyncio.Event()
+        start = time.perf_counter()
+        tasks = [asyncio.create_task(run_client(uri, i, turns, latencies, done))
+                 for i in range(clients)]
+
+        while len(latencies) < clients * turns:
+            finished = [task for task in tasks if task.done()]
+            for task in finished:
+                # Surface client errors right away
+                task.result()
+            await asyncio.sleep(0.01)
+
+        duration = time.perf_counter() - start
+        gc.collect()
+        rss_after = get_rss()
+
+        done.set()
+        await asyncio.gather(*tasks)
+
+    latencies.sort()
+    return {
+        "clients": clients,
+        "turns": len(latencies),
+        "turns_per_sec": len(latencies) / duration,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        "memory_per_session_kb": (rss_after - rss_before) / clients / 1024
+        if rss_before is not None else None
+    }
+
+
+async def run(args) -> List[Dict[str, Any]]:
+    async with MockPluginServer(latency=args.plugin_latency) as plugin_server:
+        router = Router(plugins=[plugin_server.netloc],
+                        plugin_defaults={"response_cache_ttl": 0})
+        await router.load(interactive=False)
+
+        backend = ScriptedBackend(
+            lambda messages: get_completion(messages, plugin_server.url),
+            token_latency=args.token_latency,
+            first_token_latency=args.first_token_latency
+        )
+
+        results = []
+        async with router:
+            for clients in args.clients:
+                scheduler = BackendScheduler(
+                    backend, max_in_flight=args.max_in_flight or clients)
+                handler = get_handler(
+                    scheduler=scheduler,
+                    horace_config={"parallel_calls": args.parallel_calls},
+                    router=router
+                )
+
+                result = await run_level(handler, clients, args.turns)
+                results.append(result)
+                print_result(result)
+
+        return results
+
+
+def print_result(result: Dict[str, Any]):
+    memory = result["memory_per_session_kb"]
+    memory = f"{memory:.1f} KiB" if memory is not None else "n/a"
+    print(f"{result['clients']:>6} clients: {result['turns_per_sec']:>9.1f} turns/s, "
+          f"p50 {result['p50_ms']:>8.1f} ms, p99 {result['p99_ms']:>8.1f} ms, "
+          f"memory per session {memory}", flush=True)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='[%(asctime)s] %(levelname)s: %(message)s',
+                        encoding='utf-8', level=logging.WARNING)
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the server offline against a scripted backend and a mock plugin")
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 100, 1000],
+                        help='numbers of concurrent clients to run with, in turn')
+    parser.add_argument('--turns', type=int, default=5,
+                        help='turns per client')
+    parser.add_argument('--token-latency', type=float, default=0,
+                        help='backend latency per streamed token, in seconds')
+    parser.add_argument('--first-token-latency', type=float, default=0,
+                        help='backend latency to the first token, in seconds')
+    parser.add_argument('--plugin-latency', type=float, default=0,
+                        help='plugin API latency, in seconds')
+    parser.add_argument('--max-in-flight', type=int, default=0,
+                        help='backend requests in flight, unlimited if 0')
+    parser.add_argument('--parallel-calls', action='store_true',
+                        help='enable parallel calls')
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    args = parser.parse_args()
+    output = args.output and os.path.abspath(args.output)
+
+    # The router keeps its plugin files in the working directory
+    with tempfile.TemporaryDirectory() as plugin_files_dir:
+        os.chdir(plugin_files_dir)
+        results = asyncio.run(run(args))
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
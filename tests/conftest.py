@@ -0,0 +1,12 @@
+import os
+import sys
+import pytest
+
+# The app's modules import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+
+@pytest.fixture(autouse=True)
+def plugin_files_dir(tmp_path, monkeypatch):
+    # The router keeps its plugin auth and cache files in the working directory
+    monkeypatch.chdir(tmp_path)
@@ -0,0 +1,159 @@
+import asyncio
+from aiohttp import web
+from typing import Any, Dict
+
+
+class MockPluginServer():
+    # A local plugin with a manifest, an OpenAPI spec and a small item store,
+    # so that plugin discovery, request validation and API calls take their
+    # real code paths without network access
+    NAME = "items"
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.items = {}
+        self.requests = 0
+        self.spec_requests = 0
+        # Makes the API and the manifest respond with 503 Service Unavailable
+        self.failing = False
+        # Cache-Control header of the API's responses, if any
+        self.cache_control = None
+        self._runner = None
+
+    @property
+    def netloc(self) -> str:
+        return f"{self.host}:{self.port}"
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.netloc}"
+
+    def get_manifest(self) -> Dict[str, Any]:
+        return {
+            "schema_version": "v1",
+            "name_for_model": self.NAME,
+            "name_for_human": "Items",
+            "description_for_model": "Search, add and look up items.",
+            "description_for_human": "Search, add and look up items.",
+            "auth": {"type": "none"},
+            "api": {"type": "openapi", "url": f"{self.url}/openapi.json"}
+        }
+
+    def get_spec(self) -> Dict[str, Any]:
+        return {
+            "openapi": "3.0.1",
+            "info": {"title": "Items", "version": "1.0"},
+            "servers": [{"url": self.url}],
+            "paths": {
+                "/items": {
+                    "get": {
+                        "operationId": "searchItems",
+                        "summary": "Search items by name",
+                        "parameters": [
+                            {"name": "q", "in": "query", "required": True, "schema": {"type": "string"}},
+                            {"name": "limit", "in": "query", "schema": {"type": "integer", "default": 5}}
+                        ],
+                        "responses": {
+                            "200": {
+                                "description": "Matching items",
+                                "content": {"application/json": {"schema": {
+                                    "type": "array", "items": {"$ref": "#/components/schemas/Item"}}}}
+                            }
+                        }
+                    },
+                    "post": {
+                        "operationId": "addItem",
+                        "summary": "Add an item",
+                        "requestBody": {
+                            "required": True,
+                            "content": {"application/json": {"schema": {"$ref": "#/components/schemas/Item"}}}
+                        },
+                        "responses": {"200": {"description": "The added item"}}
+                    }
+                },
+                "/items/{id}": {
+                    "get": {
+                        "operationId": "getItem",
+                        "summary": "Get an item by its ID",
+                        "parameters": [
+                            {"name": "id", "in": "path", "required": True, "schema": {"type": "integer"}}
+                        ],
+                        "responses": {"200": {"description": "The item"}, "404": {"description": "Not found"}}
+                    }
+                }
+            },
+            "components": {
+                "schemas": {
+                    "Item": {
+                        "type": "object",
+                        "required": ["name"],
+                        "properties": {"id": {"type": "integer"}, "name": {"type": "string"}}
+                    }
+                }
+            }
+        }
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/.well-known/ai-plugin.json", self._handle_manifest)
+        app.router.add_get("/openapi.json", self._handle_spec)
+        app.router.add_get("/items", self._handle_search)
+        app.router.add_post("/items", self._handle_add)
+        app.router.add_get("/items/{id}", self._handle_get)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        # Pick up the port chosen by the OS, if any
+        self.port = self._runner.addresses[0][1]
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def _handle_manifest(self, request):
+        if self.failing:
+            raise web.HTTPServiceUnavailable()
+        return web.json_response(self.get_manifest())
+
+    async def _handle_spec(self, request):
+        self.spec_requests += 1
+        return web.json_response(self.get_spec())
+
+    async def _handle_search(self, request):
+        await self._simulate_latency()
+        query = request.query["q"].lower()
+        limit = int(request.query.get("limit", 5))
+        items = [item for item in self.items.values() if query in item["name"].lower()]
+        headers = {"Cache-Control": self.cache_control} if self.cache_control else None
+        return web.json_response(items[:limit], headers=headers)
+
+    async def _handle_add(self, request):
+        await self._simulate_latency()
+        item = {"id": len(self.items) + 1, "name": (await request.json())["name"]}
+        self.items[item["id"]] = item
+        return web.json_response(item)
+
+    async def _handle_get(self, request):
+        await self._simulate_latency()
+        item = self.items.get(int(request.match_info["id"]))
+        if item is None:
+            return web.json_response({"error": "Not found"}, status=404)
+        return web.json_response(item)
+
+    async def _simulate_latency(self):
+        self.requests += 1
+        if self.failing:
+            raise web.HTTPServiceUnavailable()
+        if self.latency:
+            await asyncio.sleep(self.latency)
@@ -0,0 +1,72 @@
+import re
+import asyncio
+from backends.backend import Backend
+from typing import AsyncIterator, Callable, Dict, List, Optional, Union
+
+
+class ScriptedBackend(Backend):
+    # Plays back canned completions, streamed token by token with a fixed
+    # latency. The script is either a list of completions, played in a loop,
+    # or a function returning the completion for the messages. Like a real
+    # backend, the completion is cut short at the first stop sequence. The
+    # prompts are only kept with record_requests, as they add up over a
+    # benchmark.
+    TOKEN_PATTERN = re.compile(r"\s*\S+")
+
+    def __init__(
+        self,
+        script: Union[List[str], Callable[[List[Dict[str, str]]], str]],
+        token_latency: float = 0,
+        first_token_latency: float = 0,
+        record_requests: bool = False
+    ):
+        self.script = script
+        self.token_latency = token_latency
+        self.first_token_latency = first_token_latency
+        self.record_requests = record_requests
+        self.requests = []
+        self.request_count = 0
+        self._script_pos = 0
+
+    async def complete(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: int = 16,
+        stop: Optional[List[str]] = None,
+        temperature: Optional[float] = 1.0
+    ) -> str:
+        tokens = [token async for token in self.stream(
+            messages, max_tokens=max_tokens, stop=stop, temperature=temperature)]
+        return "".join(tokens)
+
+    async def stream(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: int = 16,
+        stop: Optional[List[str]] = None,
+        temperature: Optional[float] = 1.0
+    ) -> AsyncIterator[str]:
+        self.request_count += 1
+        if self.record_requests:
+            self.requests.append(messages)
+        completion = self._get_completion(messages, stop)
+
+        await asyncio.sleep(self.first_token_latency)
+        for i, token in enumerate(self.TOKEN_PATTERN.findall(completion)[:max_tokens]):
+            if i and self.token_latency:
+                await asyncio.sleep(self.token_latency)
+            yield token
+
+    def _get_completion(self, messages: List[Dict[str, str]], stop: Optional[List[str]]) -> str:
+        if callable(self.script):
+            completion = self.script(messages)
+        else:
+            completion = self.script[self._script_pos % len(self.script)]
+            self._script_pos += 1
+
+        for stop_sequence in stop or []:
+            stop_pos = completion.find(stop_sequence)
+            if stop_pos != -1:
+                completion = completion[:stop_pos]
+
+        return completion
@@ -0,0 +1,285 @@
+import os
+import sys
+import time
+import json
+import asyncio
+import argparse
+import logging
+import tempfile
+import statistics
+import websockets
+from collections import OrderedDict, defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from pyaml_env import parse_config
+from router import Router, PluginRequestError
+from main import get_handler
+from backends.backend import Backend
+from backends.scheduler import BackendScheduler
+from turn_runner import TurnRunner
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+
+# Replays sessions recorded with main.py --record against the server's handler.
+# The clients send the recorded utterances with the recorded timing, sped up by
+# the given factor, while the recorded completions and plugin responses are
+# served locally with their recorded latencies. No tokens are spent and no
+# plugins are called.
+
+
+class Capture():
+    def __init__(self, paths: List[str]):
+        self.plugins = {}
+        self.sessions = OrderedDict()
+        self.completions = []
+        self.plugin_requests = []
+
+        for path in paths:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        self._add(json.loads(line))
+
+        self.start = min((session["start"] for session in self.sessions.values()), default=0)
+
+    def _add(self, event: Dict[str, Any]):
+        if event["type"] == "plugins":
+            self.plugins.update(event["plugins"])
+        elif event["type"] == "session_start":
+            self.sessions[event["session"]] = {"start": event["time"], "utterances": []}
+        elif event["type"] == "utterance" and event["session"] in self.sessions:
+            self.sessions[event["session"]]["utterances"].append(
+                (event["time"], event["text"]))
+        elif event["type"] == "completion" and not event["error"]:
+            self.completions.append(event)
+        elif event["type"] == "plugin_request":
+            self.plugin_requests.append(event)
+
+
+class ReplayBackend(Backend):
+    # Serves recorded completions for the conversations they were recorded
+    # for. The initial prompt is left out of the match, so that a capture can
+    # be replayed against a version of the server with a different prompt.
+    # Failing that, a completion recorded after the same last message is used.
+    def __init__(self, completions: List[Dict[str, Any]], speed: float = 1):
+        self.speed = speed
+        self.misses = 0
+        self._by_conversation = defaultdict(list)
+        self._by_last_message = defaultdict(list)
+        self._served = defaultdict(int)
+
+        for completion in completions:
+            self._by_conversation[self._get_conversation_key(completion["messages"])].append(completion)
+            self._by_last_message[completion["messages"][-1]["content"]].append(completion)
+
+    async def complete(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: int = 16,
+        stop: Optional[List[str]] = None,
+        temperature: Optional[float] = 1.0
+    ) -> str:
+        deltas = [delta async for delta in self.stream(
+            messages, max_tokens=max_tokens, stop=stop, temperature=temperature)]
+        return "".join(deltas)
+
+    async def stream(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: int = 16,
+        stop: Optional[List[str]] = None,
+        temperature: Optional[float] = 1.0
+    ) -> AsyncIterator[str]:
+        completion = self._find(messages)
+        text = completion["completion"]
+        first_token_seconds = completion["first_token_seconds"] or 0
+        duration_seconds = completion["duration_seconds"]
+
+        # Spread the deltas evenly over the recorded generation time
+        words = text.split(" ")
+        deltas = [word + " " for word in words[:-1]] + [words[-1]]
+        delta_seconds = max(duration_seconds - first_token_seconds, 0) / max(len(deltas) - 1, 1)
+
+        await asyncio.sleep(first_token_seconds / self.speed)
+        for i, delta in enumerate(deltas):
+            if i:
+                await asyncio.sleep(delta_seconds / self.speed)
+            yield delta
+
+    def _find(self, messages: List[Dict[str, str]]) -> Dict[str, Any]:
+        for key, completions in [
+            (("conversation", self._get_conversation_key(messages)), self._by_conversation),
+            (("last_message", messages[-1]["content"]), self._by_last_message)
+        ]:
+            candidates = completions.get(key[1])
+            if candidates:
+                # Take turns between completions recorded for the same key
+                served = self._served[key]
+                self._served[key] += 1
+                return candidates[served % len(candidates)]
+
+        self.misses += 1
+        raise RuntimeError("No recorded completion for the conversation")
+
+    @staticmethod
+    def _get_conversation_key(messages: List[Dict[str, str]]) -> str:
+        return json.dumps(messages[1:])
+
+
+class ReplayRouter(Router):
+    # Serves recorded plugin responses to identical requests, in turn
+    def __init__(self, plugin_requests: List[Dict[str, Any]], speed: float = 1, **kwargs):
+        super().__init__(**kwargs)
+        self.speed = speed
+        self.misses = 0
+        self._responses = defaultdict(list)
+        self._served = defaultdict(int)
+
+        for plugin_request in plugin_requests:
+            key = self._get_request_key(plugin_request["plugin"], plugin_request["request"])
+            self._responses[key].append(plugin_request)
+
+    def load_captured(self, plugins: Dict[str, Dict[str, Any]]):
+        for plugin in plugins.values():
+            auth = {plugin["netloc"]: {"type": plugin["manifest"]["auth"]["type"], "token": ""}}
+            self._register(plugin["netloc"], plugin, auth, interactive=False)
+
+    async def send(self, plugin_name: str, prepared_request_params: Dict) -> Tuple[int, str]:
+        key = self._get_request_key(plugin_name, prepared_request_params)
+        responses = self._responses.get(key)
+        if not responses:
+            self.misses += 1
+            raise PluginRequestError("No recorded response for the request")
+
+        response = responses[self._served[key] % len(responses)]
+        self._served[key] += 1
+
+        await asyncio.sleep(response["duration_seconds"] / self.speed)
+        if "error" in response:
+            raise PluginRequestError(response["error"])
+
+        return response["status"], response["text"]
+
+    @staticmethod
+    def _get_request_key(plugin_name: str, request: Dict[str, Any]) -> str:
+        return json.dumps([
+            plugin_name,
+            (request.get("method") or "").upper(),
+            request.get("url"),
+            request.get("params"),
+            request.get("json"),
+            request.get("data")
+        ], sort_keys=True)
+
+
+async def replay_session(uri: str, session: Dict[str, Any], capture_start: float, replay_start: float, speed: float, latencies: List[float]) -> int:
+    # Returns the number of errors reported by the server
+    await asyncio.sleep(max(0, replay_start + (session["start"] - capture_start) / speed - time.monotonic()))
+
+    errors = 0
+    async with websockets.connect(uri, open_timeout=60, max_queue=None) as websocket:
+        pending = []
+        replying = False
+
+        async def receive():
+            nonlocal errors, replying
+            while True:
+                event = json.loads(await websocket.recv())
+                if event["type"] == "error":
+                    errors += 1
+                elif event["type"] == "state":
+                    if event["state"] == "replying":
+                        replying = True
+                    elif replying and pending:
+                        replying = False
+                        latencies.append(time.monotonic() - pending.pop(0))
+
+        receive_task = asyncio.create_task(receive())
+        try:
+            for utterance_time, text in session["utterances"]:
+                await asyncio.sleep(max(0, replay_start + (utterance_time - capture_start) / speed - time.monotonic()))
+                pending.append(time.monotonic())
+                await websocket.send(json.dumps({"type": "utterance", "text": text}))
+
+            while pending and not receive_task.done():
+                await asyncio.sleep(0.01)
+        finally:
+            receive_task.cancel()
+
+    return errors
+
+
+async def run(args, capture: Capture, config: Dict[str, Any]) -> Dict[str, Any]:
+    router = ReplayRouter(
+        capture.plugin_requests, speed=args.speed, **(config.get("router") or {}))
+    router.load_captured(capture.plugins)
+
+    backend = ReplayBackend(capture.completions, speed=args.speed)
+    scheduler = BackendScheduler(
+        backend, **((config.get("backend") or {}).get("scheduler") or {}))
+    server_config = config.get("server") or {}
+    handler = get_handler(
+        scheduler=scheduler,
+        horace_config=config.get("horace") or {},
+        router=router,
+        busy_policy=server_config.get("busy_policy", TurnRunner.POLICY_QUEUE)
+    )
+
+    latencies = []
+    async with router:
+        async with websockets.serve(handler, "127.0.0.1", 0, max_queue=None) as server:
+            uri = f"ws://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+            start = time.monotonic()
+            errors = await asyncio.gather(*[
+                replay_session(uri, session, capture.start, start, args.speed, latencies)
+                for session in capture.sessions.values()
+            ])
+            duration = time.monotonic() - start
+
+    latencies.sort()
+    return {
+        "sessions": len(capture.sessions),
+        "turns": len(latencies),
+        "duration_seconds": duration,
+        "turns_per_sec": len(latencies) / duration if duration else 0,
+        "p50_ms": statistics.median(latencies) * 1000 if latencies else None,
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+        if latencies else None,
+        "errors": sum(errors),
+        "completion_misses": backend.misses,
+        "plugin_misses": router.misses
+    }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='[%(asctime)s] %(levelname)s: %(message)s',
+                        encoding='utf-8', level=logging.WARNING)
+
+    parser = argparse.ArgumentParser(
+        description="Replay sessions recorded with main.py --record")
+    parser.add_argument('captures', nargs='+', help='recorded JSONL files')
+    parser.add_argument('--speed', type=float, default=1,
+                        help='speed-up factor for the recorded timing')
+    parser.add_argument('--config',
+                        help='server config to replay with, e.g. app/config.yaml')
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    args = parser.parse_args()
+
+    capture = Capture(args.captures)
+    config = parse_config(args.config) if args.config else {}
+    # Plugins are taken from the capture rather than discovered
+    (config.get("router") or {}).pop("plugins", None)
+    output = args.output and os.path.abspath(args.output)
+
+    # The router keeps its plugin files in the working directory
+    with tempfile.TemporaryDirectory() as plugin_files_dir:
+        os.chdir(plugin_files_dir)
+        result = asyncio.run(run(args, capture, config))
+
+    for key, value in result.items():
+        print(f"{key}: {round(value, 1) if isinstance(value, float) else value}")
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(result, f, indent=2)
@@ -0,0 +1,187 @@
+import os
+import sys
+import json
+import asyncio
+import argparse
+import tempfile
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from mocks.plugin_server import MockPluginServer
+from typing import Any, Dict, List, Tuple
+
+
+# Measures how long main.py and horace-cli.py take to start: the time to
+# import them, and for main.py the time to load the plugin registry from a
+# local mock plugin, with and without the plugin cache. Each is measured in a
+# fresh interpreter with -X importtime, so that the import time can be broken
+# down by package, including packages imported lazily during the registry load.
+# The results are compared against a baseline, so that regressions stand out.
+
+APP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "app"))
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "startup_baseline.json")
+PHASE_MARKER = "startup_profile phase: "
+
+MAIN_SCRIPT = """
+import sys, time, json, asyncio
+timings = {}
+
+sys.stderr.write(%(marker)r + "import\\n")
+start = time.perf_counter()
+import main
+from router import Router
+timings["import"] = time.perf_counter() - start
+
+sys.stderr.write(%(marker)r + "load\\n")
+start = time.perf_counter()
+asyncio.run(Router(plugins=[%(netloc)r]).load(interactive=False))
+timings["load"] = time.perf_counter() - start
+
+print(json.dumps(timings))
+"""
+
+CLI_SCRIPT = """
+import sys, time, json, importlib.util
+timings = {}
+
+sys.stderr.write(%(marker)r + "import\\n")
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location("horace_cli", %(path)r)
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+timings["import"] = time.perf_counter() - start
+
+# Loaded by the client once connected
+sys.stderr.write(%(marker)r + "console\\n")
+start = time.perf_counter()
+import aioconsole, colorama
+timings["console"] = time.perf_counter() - start
+
+print(json.dumps(timings))
+"""
+
+
+async def run_script(script: str, cwd: str) -> Tuple[Dict[str, float], Dict[str, Dict[str, float]]]:
+    # Returns the duration of each phase, and the import time in each phase
+    # by package, all in milliseconds
+    env = {**os.environ, "PYTHONPATH": APP_DIR}
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-X", "importtime", "-c", script, cwd=cwd, env=env,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await process.communicate()
+    if process.returncode:
+        raise RuntimeError(stderr.decode("utf-8", errors="replace"))
+
+    timings = {phase: seconds * 1000 for phase, seconds in json.loads(stdout).items()}
+
+    # Each module's own import time, excluding its imports, adds up by
+    # top-level package
+    modules = defaultdict(lambda: defaultdict(float))
+    phase = None
+    for line in stderr.decode("utf-8").splitlines():
+        if line.startswith(PHASE_MARKER):
+            phase = line[len(PHASE_MARKER):]
+        elif phase and line.startswith("import time:") and "|" in line:
+            own, _, name = line[len("import time:"):].split("|")
+            if own.strip().isdigit():
+                modules[phase][name.strip().split(".")[0]] += int(own) / 1000
+
+    return timings, {phase: dict(phase_modules) for phase, phase_modules in modules.items()}
+
+
+async def profile(repeat: int) -> Dict[str, Any]:
+    runs = defaultdict(list)
+    async with MockPluginServer() as plugin_server:
+        for _ in range(repeat):
+            # The first start discovers the plugin, the second one loads it
+            # from the plugin cache in the working directory
+            with tempfile.TemporaryDirectory() as cwd:
+                script = MAIN_SCRIPT % {"marker": PHASE_MARKER, "netloc": plugin_server.netloc}
+                runs["main.py (cold plugin cache)"].append(await run_script(script, cwd))
+                runs["main.py (warm plugin cache)"].append(await run_script(script, cwd))
+
+                script = CLI_SCRIPT % {"marker": PHASE_MARKER,
+                                       "path": os.path.join(APP_DIR, "horace-cli.py")}
+                runs["horace-cli.py"].append(await run_script(script, cwd))
+
+    # The fastest run of each is the least disturbed by anything else going on
+    results = {}
+    for target, target_runs in runs.items():
+        timings = {phase: min(run[0][phase] for run in target_runs) for phase in target_runs[0][0]}
+        modules = {}
+        for phase in timings:
+            names = set().union(*(run[1].get(phase, {}) for run in target_runs))
+            modules[phase] = {name: min(run[1].get(phase, {}).get(name, 0) for run in target_runs)
+                              for name in names}
+        results[target] = {"timings": timings, "modules": modules}
+
+    return results
+
+
+def report(results: Dict[str, Any], baseline: Dict[str, Any], top: int, tolerance: float, min_ms: float) -> List[str]:
+    # Prints the results next to the baseline and returns the regressions
+    regressions = []
+
+    def format_row(label: str, value: float, base_value: float, indent: str, path: str) -> str:
+        row = f"{indent}{label:<28} {value:8.1f} ms"
+        if base_value is not None:
+            row += f"  (baseline {base_value:.1f} ms, {value - base_value:+.1f} ms)"
+            if value > base_value * (1 + tolerance) and value - base_value > min_ms:
+                row += "  REGRESSION"
+                regressions.append(f"{path}: {base_value:.1f} -> {value:.1f} ms")
+        return row
+
+    for target, result in results.items():
+        base = baseline.get(target)
+        print(target)
+        for phase, value in result["timings"].items():
+            print(format_row(phase, value, base and base["timings"].get(phase), "  ", f"{target} {phase}"))
+
+            # Packages that weren't imported in the phase before count as
+            # taking no time then
+            modules = sorted(result["modules"].get(phase, {}).items(), key=lambda m: -m[1])
+            base_modules = base and base["modules"].get(phase) or {}
+            for name, value in modules[:top]:
+                print(format_row(name, value, base_modules.get(name, 0) if base else None, "    ",
+                                 f"{target} {phase} {name}"))
+        print()
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Profile the startup time of main.py and horace-cli.py")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs of each, of which the fastest is reported')
+    parser.add_argument('--top', type=int, default=8,
+                        help='modules to list per phase')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='baseline to compare against')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='save the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative slowdown over the baseline that counts as a regression')
+    parser.add_argument('--min-ms', type=float, default=10,
+                        help='absolute slowdown in ms below which nothing counts as a regression')
+    parser.add_argument('--check', action='store_true',
+                        help='exit with an error if there are regressions')
+    args = parser.parse_args()
+
+    results = asyncio.run(profile(args.repeat))
+
+    baseline = {}
+    if os.path.isfile(args.baseline) and not args.update_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    regressions = report(results, baseline, args.top, args.tolerance, args.min_ms)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Saved the baseline to {args.baseline}")
+    elif regressions:
+        print("Regressions: " + "; ".join(regressions))
+        if args.check:
+            sys.exit(1)
@@ -0,0 +1,75 @@
+import asyncio
+from backends.cached_backend import CompletionCache
+from mocks.scripted_backend import ScriptedBackend
+
+
+def messages(*user_messages):
+    result = [{"role": "system", "content": "You are helpful."}]
+    for i, content in enumerate(user_messages):
+        if i:
+            result.append({"role": "assistant", "content": "Hello!"})
+        result.append({"role": "user", "content": content})
+    return result
+
+
+def run(cache, *requests, backend=None):
+    # Sends the (messages, temperature) requests one after another, and
+    # returns the number that reached the backend
+    backend = backend or ScriptedBackend(["Hello!"])
+
+    async def session():
+        cached_backend = cache.wrap(backend)
+        for request_messages, temperature in requests:
+            await cached_backend.complete(request_messages, max_tokens=16, temperature=temperature)
+
+    asyncio.run(session())
+    return backend.request_count
+
+
+def test_identical_requests_in_flight_are_sent_once():
+    backend = ScriptedBackend(["Hello there, how are you?"], token_latency=0.01)
+
+    async def session():
+        cached_backend = CompletionCache().wrap(backend)
+        completions = await asyncio.gather(*[
+            cached_backend.complete(messages("Hi"), max_tokens=16, temperature=0) for _ in range(3)])
+        streamed = [delta async for delta in cached_backend.stream(messages("Hi"), max_tokens=16, temperature=0)]
+        return completions, "".join(streamed)
+
+    completions, streamed = asyncio.run(session())
+    assert completions == ["Hello there, how are you?"] * 3
+    assert streamed == "Hello there, how are you?"
+    assert backend.request_count == 1
+
+
+def test_only_deterministic_requests_are_cached():
+    cache = CompletionCache(max_temperature=0.2)
+    assert run(cache, (messages("Hi"), 0), (messages("Hi"), 0.2)) == 2
+    assert run(cache, (messages("Hi"), 0), (messages("Hi"), 0)) == 0
+    assert run(cache, (messages("Hi"), 0.9), (messages("Hi"), 0.9)) == 2
+
+
+def test_openers_are_cached_at_any_temperature():
+    cache = CompletionCache(openers=["Hi there"])
+    assert run(cache, (messages("Hi there"), 0.9), (messages("Hi there"), 0.9)) == 1
+    # Matched regardless of case and punctuation
+    assert cache.is_opener(messages("hi, there!"))
+
+    # Only as the conversation's first user message
+    assert not cache.is_opener(messages("Hello", "Hi there"))
+    assert run(cache, (messages("Hello", "Hi there"), 0.9), (messages("Hello", "Hi there"), 0.9)) == 2
+
+
+def test_entries_expire():
+    cache = CompletionCache(ttl=0.05)
+    assert run(cache, (messages("Hi"), 0)) == 1
+
+    asyncio.run(asyncio.sleep(0.1))
+    assert run(cache, (messages("Hi"), 0)) == 1
+
+
+def test_entries_are_evicted_by_size():
+    # Room for a single entry: a 64 character key and the completion
+    cache = CompletionCache(max_bytes=100)
+    assert run(cache, (messages("Hi"), 0), (messages("Hello"), 0), (messages("Hello"), 0)) == 2
+    assert run(cache, (messages("Hi"), 0)) == 1
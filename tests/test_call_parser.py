@@ -0,0 +1,58 @@
+from call_parser import CallParser
+
+
+def feed(deltas):
+    # Returns the calls completed after each delta
+    parser = CallParser("<call>", "</call>")
+    return [parser.feed(delta) for delta in deltas], parser
+
+
+def test_call_ends_at_its_closing_brace():
+    completed, parser = feed(['Sure. <call>{"a": {"b": 1}}</call> more text'])
+
+    assert completed == [['{"a": {"b": 1}}']]
+    assert parser.calls == [(12, 27)]
+
+
+def test_tags_and_json_split_across_deltas():
+    completed, parser = feed(["Let me check. <ca", "ll> {", '"a": ', "1", "}", "</call>"])
+
+    assert completed == [[], [], [], [], [' {"a": 1}'], []]
+
+
+def test_braces_and_tags_in_strings_are_ignored():
+    text = '<call>{"q": "} </call> <call> {", "r": "\\"}"}</call>'
+    completed, parser = feed([text[:14], text[14:30], text[30:]])
+
+    assert completed == [[], [], ['{"q": "} </call> <call> {", "r": "\\"}"}']]
+
+
+def test_calls_following_a_call_are_found():
+    completed, parser = feed(['<call>{"a": 1}</call>\n<call>', '{"b": 2}', '<call>{"c": 3}'])
+
+    assert completed == [['{"a": 1}'], ['{"b": 2}'], ['{"c": 3}']]
+    assert not parser.done
+
+
+def test_calls_after_other_text_are_ignored():
+    completed, parser = feed(['<call>{"a": 1}</call> and also <call>{"b": 2}</call>'])
+
+    assert completed == [['{"a": 1}']]
+    assert parser.done
+
+
+def test_split_tag_after_a_call_is_awaited():
+    completed, parser = feed(['<call>{"a": 1}</ca', 'll> <ca', 'll>{"b": 2}'])
+
+    assert completed == [['{"a": 1}'], [], ['{"b": 2}']]
+
+
+def test_malformed_calls_end_the_scan():
+    completed, parser = feed(['<call>not json</call> <call>{"a": 1}</call>'])
+    assert completed == [[]]
+    assert parser.done
+
+    # An unclosed call is never complete
+    completed, parser = feed(['<call>{"a": [1, 2', ", 3]"])
+    assert completed == [[], []]
+    assert not parser.done
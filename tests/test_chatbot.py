@@ -1,129 +1,254 @@
-import os
-import yaml
-# import mocks.openai as openai
-import openai
-from openai_chatbot import OpenAIChatbot
+import json
+import asyncio
+from router import Router
 from horace_chatbot import HoraceChatbot
-from datetime import datetime
-from dotenv import load_dotenv
-import pytest
+from mocks.scripted_backend import ScriptedBackend
+from mocks.plugin_server import MockPluginServer
 
-load_dotenv()
 
-# Suppress the tokenizers parallelism warning
-os.environ["TOKENIZERS_PARALLELISM"] = "false"
+def call(method: str, path: str, **params) -> str:
+    request = {"method": method, "url": f"{{url}}{path}", **params}
+    return "<call>" + json.dumps({"plugin_system_name": MockPluginServer.NAME, "request_object_params": request}) + "</call>"
+
 
-openai.api_key = os.environ["OPENAI_API_KEY"]
+def run_session(script, user_utterances, **chatbot_kwargs):
+    async def session():
+        async with MockPluginServer() as plugin_server:
+            router = Router(plugins=[plugin_server.netloc])
+            await router.load(interactive=False)
 
-with open("config.yaml", "r") as stream:
-    config = yaml.safe_load(stream)
-with open("domain.yaml", "r") as stream:
-    domain = yaml.safe_load(stream)
+            backend = ScriptedBackend(script if callable(script) else
+                                      [completion.replace("{url}", plugin_server.url) for completion in script],
+                                      record_requests=True)
+            utterances = []
+            deltas = []
 
+            async def utterance_coroutine(utterance, is_system=False):
+                utterances.append(utterance)
+
+            async def utterance_delta_coroutine(delta):
+                deltas.append(delta)
+
+            chatbot = HoraceChatbot(
+                backend=backend,
+                router=router,
+                utterance_coroutine=utterance_coroutine,
+                utterance_delta_coroutine=utterance_delta_coroutine,
+                **chatbot_kwargs
+            )
 
-@pytest.fixture
-def customer_prompt_template() -> str:
-    return """You are a customer of {business_name}, {business_description}. You are chatting to the restaurant's AI assistant. {{task_description}}
+            async with router:
+                for user_utterance in user_utterances:
+                    await chatbot.send_responses([user_utterance])
+                    # Give background work between turns a chance to finish,
+                    # as the user would while typing
+                    await asyncio.sleep(0.01)
 
-A transcript of your chat session with the AI assistant follows.
-""".format(**domain)
+            return chatbot, plugin_server, utterances, deltas
 
+    return asyncio.run(session())
 
-def test_book_table(customer_prompt_template):
-    backend.bookings = {}
 
-    task_description = f"You are looking to book a table on the name of Jeremiah Biggs, for 3 people at 8 pm on June 23, 2023. You don't provide all of this information at once but rather respond to the AI assistant's prompts."
-    customer_prompt = customer_prompt_template.format(
-        task_description=task_description)
+def test_reply_without_calls():
+    chatbot, plugin_server, utterances, deltas = run_session(
+        ["Hello! How can I help you?"], ["Hi"])
+
+    assert utterances == ["Hello! How can I help you?"]
+    assert "".join(deltas) == "Hello! How can I help you?"
+    assert plugin_server.requests == 0
+    assert [turn.speaker for turn in chatbot.transcript] == ["User", "AI"]
 
-    _run_session(customer_prompt)
 
-    assert list(backend.bookings.values()) == [{
-        "full_name": "Jeremiah Biggs",
-        "num_people": 3,
-        "time": datetime(2023, 6, 23, 20, 0, 0)
-    }]
+def test_add_and_search_items():
+    chatbot, plugin_server, utterances, deltas = run_session([
+        "Sure. " + call("POST", "/items", json={"name": "Apples"}),
+        "Added apples to your list.",
+        "Let me look. " + call("GET", "/items", params={"q": "apple"}),
+        "You have apples on your list."
+    ], ["Add apples", "Do I have apples?"])
+
+    assert utterances == ["Sure.", "Added apples to your list.",
+                          "Let me look.", "You have apples on your list."]
+    assert plugin_server.items == {1: {"id": 1, "name": "Apples"}}
+
+    system_turns = [turn.text for turn in chatbot.transcript if turn.speaker == "System"]
+    assert system_turns == [
+        'API responded with HTTP status code 200, response body: {"id":1,"name":"Apples"}',
+        'API responded with HTTP status code 200, response body: [{"id":1,"name":"Apples"}]'
+    ]
+
+
+def test_invalid_call_is_not_sent():
+    chatbot, plugin_server, utterances, deltas = run_session([
+        call("GET", "/items/first"),
+        "Sorry, I couldn't find it."
+    ], ["Show me the first item"])
 
-
-def test_change_booking(customer_prompt_template):
-    reference = "S8W308"
-
-    backend.bookings = {
-        reference: {
-            "full_name": "Ann Hicks",
-            "num_people": 4,
-            "time": datetime(2023, 7, 14, 18, 0, 0)
-        }
-    }
-
-    task_description = f"You'd like to change a table booking with reference {reference} that you made earlier. You're looking to change it from 4 people to 3 people and from 6 PM to 5:30 PM. You don't provide all of this information at once but rather respond to the AI assistant's prompts."
-    customer_prompt = customer_prompt_template.format(
-        task_description=task_description)
-
-    _run_session(customer_prompt)
-
-    assert list(backend.bookings.values()) == [{
-        "full_name": "Ann Hicks",
-        "num_people": 3,
-        "time": datetime(2023, 7, 14, 17, 30, 0)
-    }]
-
-
-def test_cancel_booking(customer_prompt_template):
-    reference = "ZBA4HB"
-
-    backend.bookings = {
-        reference: {
-            "full_name": "Mary Ashcroft",
-            "num_people": 5,
-            "time": datetime(2023, 6, 2, 18, 15, 0)
-        }
-    }
-
-    task_description = f"You are looking to cancel your booking with reference {reference}. The reference is all information you have about the booking."
-    customer_prompt = customer_prompt_template.format(
-        task_description=task_description)
-
-    _run_session(customer_prompt)
-
-    assert reference not in backend.bookings
-
-
-def _run_session(customer_prompt: str):
-    ai_utterances = []
-    customer_utterances = []
-
-    ai_chatbot = HoraceChatbot(
-        openai=openai,
-        backend=backend.backend,
-        domain=domain,
-        utterance_coroutine=lambda u: ai_utterances.append(u),
-        openai_model=config["openai"]["model"],
-        openai_endpoint=config["openai"]["endpoint"]
-    )
-
-    ai_chatbot.start_session()
-
-    customer_prompt += "".join(["\nAI: " + u for u in ai_utterances])
-    print(ai_utterances)
-    ai_utterances = []
-
-    customer_chatbot = OpenAIChatbot(
-        openai=openai,
-        initial_prompt=customer_prompt,
-        utterance_coroutine=lambda u: customer_utterances.append(u),
-        names=("Customer", "AI"),
-        openai_model=config["openai"]["model"],
-        openai_endpoint=config["openai"]["endpoint"]
-    )
-
-    customer_chatbot.start_session()
-
-    while not ai_chatbot.session_ended():
-        ai_chatbot.send_responses(customer_utterances)
-        print(customer_utterances)
-        customer_utterances = []
-
-        customer_chatbot.send_responses(ai_utterances)
-        print(ai_utterances)
-        ai_utterances = []
+    assert utterances == ["Sorry, I couldn't find it."]
+    assert plugin_server.requests == 0
+
+    system_turns = [turn.text for turn in chatbot.transcript if turn.speaker == "System"]
+    assert len(system_turns) == 1
+    assert "Error validating the request" in system_turns[0]
+
+
+def test_malformed_call_is_repaired_locally():
+    # A relative URL and a trailing comma, cut off before the closing braces
+    chatbot, plugin_server, utterances, deltas = run_session([
+        'Sure. <call>{"plugin_system_name": "items", "request_object_params": '
+        '{"method": "POST", "url": "/items", "json": {"name": "Apples",}',
+        "Added apples to your list."
+    ], ["Add apples"], max_validation_retries=1)
+
+    assert utterances == ["Sure.", "Added apples to your list."]
+    assert plugin_server.items == {1: {"id": 1, "name": "Apples"}}
+    assert len(chatbot.backend.requests) == 2
+
+    # The transcript has the call as it was sent
+    ai_turn = [turn.text for turn in chatbot.transcript if turn.speaker == "AI"][0]
+    call_json = ai_turn.split("<call>")[1].split("</call>")[0]
+    assert json.loads(call_json)["request_object_params"] == {
+        "method": "POST", "url": f"{plugin_server.url}/items", "json": {"name": "Apples"}}
+    assert chatbot.backend.requests[1][-2]["content"] == ai_turn
+
+
+def test_invalid_call_gets_a_follow_up():
+    chatbot, plugin_server, utterances, deltas = run_session([
+        "Let me look. " + call("GET", "/items/first"),
+        "Let me look. " + call("GET", "/items", params={"q": "first"}),
+        "You have no items yet."
+    ], ["Show me the first item"], max_validation_retries=1)
+
+    assert utterances == ["Let me look.", "You have no items yet."]
+    assert plugin_server.requests == 1
+
+    # The error is shown to the model in the retry only
+    follow_up = chatbot.backend.requests[1][-1]["content"]
+    assert follow_up.startswith("System: Your API calls could not be made")
+    assert "Invalid path parameter id" in follow_up
+    system_turns = [turn.text for turn in chatbot.transcript if turn.speaker == "System"]
+    assert len(system_turns) == 1
+    assert system_turns[0].startswith("API responded with HTTP status code 200")
+
+
+def test_parallel_calls():
+    chatbot, plugin_server, utterances, deltas = run_session([
+        call("POST", "/items", json={"name": "Apples"}) + call("POST", "/items", json={"name": "Pears"}),
+        "Both added."
+    ], ["Add apples and pears"], parallel_calls=True)
+
+    assert utterances == ["Both added."]
+    assert sorted(item["name"] for item in plugin_server.items.values()) == ["Apples", "Pears"]
+
+    system_turns = [turn.text for turn in chatbot.transcript if turn.speaker == "System"]
+    assert system_turns[0].startswith("Call 1: API responded with HTTP status code 200")
+    assert "Call 2: API responded with HTTP status code 200" in system_turns[0]
+
+
+def test_calls_after_text_are_not_sent():
+    chatbot, plugin_server, utterances, deltas = run_session([
+        call("POST", "/items", json={"name": "Apples"}) + " and also " + call("POST", "/items", json={"name": "Pears"}),
+        "Added apples."
+    ], ["Add apples and pears"], parallel_calls=True)
+
+    # Only the first call counts, so the second is neither sent nor shown
+    assert [item["name"] for item in plugin_server.items.values()] == ["Apples"]
+    assert plugin_server.requests == 1
+    assert "Pears" not in "".join(turn.text for turn in chatbot.transcript)
+    system_turns = [turn.text for turn in chatbot.transcript if turn.speaker == "System"]
+    assert system_turns == ['API responded with HTTP status code 200, response body: {"id":1,"name":"Apples"}']
+
+
+def test_old_turns_are_summarized():
+    def script(messages):
+        if messages[0]["content"] == HoraceChatbot.SUMMARY_INSTRUCTIONS:
+            return "The user's order number is 12345."
+        return "Noted. " * 20
+
+    chatbot, plugin_server, utterances, deltas = run_session(
+        script, ["My order number is 12345.", "I'd like to return it.", "Is it eligible?", "When will I get my refund?"],
+        summary_threshold=80, summary_keep_tokens=60)
+
+    assert chatbot.transcript.summary.text == "The user's order number is 12345."
+    assert chatbot.transcript.turns[0].text == "When will I get my refund?"
+
+    # The summarized turns are left out of later completions, and go into the
+    # next summary by way of the previous one
+    summary_requests = [messages for messages in chatbot.backend.requests
+                        if messages[0]["content"] == HoraceChatbot.SUMMARY_INSTRUCTIONS]
+    assert summary_requests[-1][1]["content"].startswith("Summary: The user's order number is 12345.")
+
+    messages = [messages for messages in chatbot.backend.requests if messages not in summary_requests][-1]
+    assert messages[1]["content"] == "Summary of the earlier conversation: The user's order number is 12345."
+    assert "My order number is 12345." not in [message["content"] for message in messages]
+
+
+def test_failing_plugin_is_marked_unavailable():
+    async def session():
+        async with MockPluginServer() as plugin_server:
+            router = Router(plugins=[plugin_server.netloc], plugin_defaults={
+                "circuit_min_requests": 2, "circuit_open_seconds": 0.1})
+            await router.load(interactive=False)
+            backend = ScriptedBackend(
+                [call("GET", "/items", params={"q": "apple"}).replace("{url}", plugin_server.url), "Sorry."],
+                record_requests=True)
+
+            async def utterance_coroutine(utterance, is_system=False):
+                pass
+
+            chatbot = HoraceChatbot(backend=backend, router=router, utterance_coroutine=utterance_coroutine)
+
+            async with router:
+                plugin_server.failing = True
+                for _ in range(3):
+                    await chatbot.send_responses(["Do I have apples?"])
+
+                # The third call fails without reaching the plugin, and the
+                # model is told not to use it
+                assert plugin_server.requests == 2
+                assert router.unavailable_plugins == {MockPluginServer.NAME}
+                assert HoraceChatbot.PLUGIN_UNAVAILABLE_NOTE in backend.requests[-1][0]["content"]
+
+                # Once the plugin recovers, a probe closes the circuit
+                plugin_server.failing = False
+                await asyncio.sleep(0.3)
+                assert router.unavailable_plugins == set()
+                await chatbot.send_responses(["Do I have apples?"])
+                assert plugin_server.requests == 3
+                assert HoraceChatbot.PLUGIN_UNAVAILABLE_NOTE not in backend.requests[-1][0]["content"]
+
+    asyncio.run(session())
+
+
+def get_operation_details(prompt: str):
+    if HoraceChatbot.OPERATION_DETAILS_HEADING not in prompt:
+        return []
+    details = prompt.split(HoraceChatbot.OPERATION_DETAILS_HEADING)[1]
+    return [json.loads(line.split(": ", 1)[1])["operationId"] for line in details.strip().splitlines()]
+
+
+def test_catalog_mode_adds_the_specs_of_referenced_operations():
+    chatbot, plugin_server, utterances, deltas = run_session([
+        # Not a mention of getItem, nor is the call's URL
+        "Let me check getItems. " + call("GET", "/items", params={"q": "apple", "getItem": "1"}),
+        "You have no apples.",
+        "I can look it up with getItem.",
+        "Sure."
+    ], ["Do I have apples?", "What about item 3?", "Please do"], spec_mode="catalog")
+
+    prompts = [messages[0]["content"] for messages in chatbot.backend.requests]
+    assert "- addItem: POST /items - Add an item" in prompts[0]
+    assert get_operation_details(prompts[0]) == []
+    assert get_operation_details(prompts[1]) == ["searchItems"]
+    assert get_operation_details(prompts[2]) == ["searchItems"]
+    assert get_operation_details(prompts[3]) == ["searchItems", "getItem"]
+    # The catalog stays the same as specs are added after it
+    assert prompts[1].startswith(prompts[0])
+
+
+def test_top_k_mode_adds_the_specs_of_matching_operations():
+    chatbot, plugin_server, utterances, deltas = run_session(
+        ["Sure, what's the item called?"], ["Add something to my list"], spec_mode="top_k", spec_top_k=1)
+
+    prompt = chatbot.backend.requests[0][0]["content"]
+    assert get_operation_details(prompt) == ["addItem"]
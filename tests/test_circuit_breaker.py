@@ -0,0 +1,29 @@
+import time
+from circuit_breaker import CircuitBreaker
+
+
+def test_opens_once_error_rate_is_reached():
+    circuit = CircuitBreaker(min_requests=4, error_rate=0.5)
+    assert not circuit.record(False, 0.1)
+    assert not circuit.record(True, 0.1)
+    assert not circuit.record(False, 0.1)
+    assert circuit.record(True, 0.1)
+    assert not circuit.available
+
+
+def test_slow_calls_count_as_failed():
+    circuit = CircuitBreaker(min_requests=2, error_rate=1, slow_call_seconds=1)
+    circuit.record(False, 2)
+    assert circuit.record(False, 2)
+
+
+def test_expired_requests_do_not_count():
+    circuit = CircuitBreaker(window_seconds=0.1, min_requests=5)
+    for _ in range(4):
+        circuit.record(False, 0.01)
+    time.sleep(0.2)
+
+    # A single failure after a quiet period is one request out of one
+    assert not circuit.record(True, 0.01)
+    assert circuit.available
+    assert circuit.error_rate == 1
@@ -0,0 +1,110 @@
+import json
+import asyncio
+from event_writer import EventWriter
+
+
+class SlowWebSocket():
+    # Takes delay seconds to send each frame, as a client on a slow link would
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.frames = []
+        self.closed = False
+        self.close_code = None
+
+    async def send(self, message: str):
+        await asyncio.sleep(self.delay)
+        self.frames.append(json.loads(message))
+
+    async def close(self, code: int = 1000, reason: str = ""):
+        self.closed = True
+        self.close_code = code
+
+
+def delta(text):
+    return {"type": "utterance_delta", "source": "ai", "text": text}
+
+
+def state(value):
+    return {"type": "state", "state": value}
+
+
+def test_events_sent_together_are_batched():
+    async def session():
+        websocket = SlowWebSocket()
+        writer = EventWriter(websocket, batch=True)
+        writer.send(state("replying"))
+        writer.send(delta("Hel"))
+        writer.send(delta("lo"))
+        await asyncio.sleep(0.01)
+        writer.send({"type": "utterance", "source": "ai", "text": "Hello"})
+        await writer.close()
+
+        assert websocket.frames == [
+            [state("replying"), delta("Hello")],
+            {"type": "utterance", "source": "ai", "text": "Hello"}
+        ]
+        assert websocket.closed
+
+    asyncio.run(session())
+
+
+def test_deltas_are_merged_while_the_client_is_behind():
+    async def session():
+        websocket = SlowWebSocket(delay=0.05)
+        writer = EventWriter(websocket)
+        writer.send(state("replying"))
+        await asyncio.sleep(0.01)
+        for text in ["One", " two", " three"]:
+            writer.send(delta(text))
+        await writer.close()
+
+        # Without batching, each event still gets a frame of its own
+        assert websocket.frames == [state("replying"), delta("One two three")]
+
+    asyncio.run(session())
+
+
+def test_slow_client_deltas_are_dropped():
+    async def session():
+        websocket = SlowWebSocket(delay=0.05)
+        writer = EventWriter(websocket, max_queued_events=3)
+        writer.send(state("replying"))
+        await asyncio.sleep(0.01)
+        writer.send(delta("Hello"))
+        writer.send(state("calling"))
+        writer.send(delta("More"))
+        writer.send(state("replying"))
+        await writer.close()
+
+        assert websocket.frames == [state("replying"), state("calling"), state("replying")]
+        assert websocket.close_code == 1000
+
+    asyncio.run(session())
+
+
+def test_slow_client_is_disconnected():
+    async def session():
+        websocket = SlowWebSocket(delay=10)
+        writer = EventWriter(websocket, max_queued_events=3,
+                             slow_client_policy=EventWriter.POLICY_DISCONNECT)
+        for i in range(5):
+            writer.send(state(str(i)))
+        await writer.close()
+
+        assert websocket.frames == []
+        assert websocket.close_code == EventWriter.SLOW_CLIENT_CLOSE_CODE
+
+    asyncio.run(session())
+
+
+def test_drop_deltas_disconnects_if_not_enough():
+    async def session():
+        websocket = SlowWebSocket(delay=10)
+        writer = EventWriter(websocket, max_queued_events=3)
+        for i in range(5):
+            writer.send(state(str(i)))
+        await writer.close()
+
+        assert websocket.close_code == EventWriter.SLOW_CLIENT_CLOSE_CODE
+
+    asyncio.run(session())
@@ -0,0 +1,80 @@
+from metrics import MetricsRegistry
+
+
+def make_registry() -> MetricsRegistry:
+    registry = MetricsRegistry()
+    registry.enabled = True
+    return registry
+
+
+def test_counters_and_gauges():
+    registry = make_registry()
+    requests = registry.counter("requests_total", "Requests", ("plugin", "status"))
+    active = registry.gauge("sessions_active", "Sessions")
+    sampled = registry.gauge("queue_depth", "Queue depth", function=lambda: 3)
+
+    requests.inc("items", "200")
+    requests.inc("items", "200", amount=2)
+    requests.inc("items", "error")
+    active.inc()
+    active.inc()
+    active.dec()
+
+    assert registry.render() == "\n".join([
+        "# HELP requests_total Requests",
+        "# TYPE requests_total counter",
+        'requests_total{plugin="items",status="200"} 3',
+        'requests_total{plugin="items",status="error"} 1',
+        "# HELP sessions_active Sessions",
+        "# TYPE sessions_active gauge",
+        "sessions_active 1",
+        "# HELP queue_depth Queue depth",
+        "# TYPE queue_depth gauge",
+        "queue_depth 3"
+    ]) + "\n"
+
+
+def test_unlabeled_metrics_start_at_zero():
+    registry = make_registry()
+    registry.counter("errors_total", "Errors")
+    registry.counter("failures_total", "Failures", ("plugin",))
+
+    assert registry.render().splitlines()[2:] == [
+        "errors_total 0", "# HELP failures_total Failures", "# TYPE failures_total counter"]
+
+
+def test_label_values_are_escaped():
+    registry = make_registry()
+    errors = registry.counter("errors_total", "Errors", ("message",))
+    errors.inc('a "quoted"\\path\nnext')
+
+    assert 'errors_total{message="a \\"quoted\\"\\\\path\\nnext"} 1' in registry.render().splitlines()
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = make_registry()
+    seconds = registry.histogram("request_seconds", "Request time", ("plugin",), buckets=(0.1, 1))
+    for value in [0.05, 0.1, 0.5, 2]:
+        seconds.observe(value, "items")
+
+    assert registry.render().splitlines() == [
+        "# HELP request_seconds Request time",
+        "# TYPE request_seconds histogram",
+        'request_seconds_bucket{plugin="items",le="0.1"} 2',
+        'request_seconds_bucket{plugin="items",le="1"} 3',
+        'request_seconds_bucket{plugin="items",le="+Inf"} 4',
+        'request_seconds_sum{plugin="items"} 2.65',
+        'request_seconds_count{plugin="items"} 4'
+    ]
+
+
+def test_nothing_is_recorded_until_enabled():
+    registry = MetricsRegistry()
+    requests = registry.counter("requests_total", "Requests")
+    seconds = registry.histogram("request_seconds", "Request time")
+    requests.inc()
+    seconds.observe(1)
+
+    assert registry.render().splitlines() == [
+        "# HELP requests_total Requests", "# TYPE requests_total counter", "requests_total 0",
+        "# HELP request_seconds Request time", "# TYPE request_seconds histogram"]
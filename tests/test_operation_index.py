@@ -0,0 +1,36 @@
+from operation_index import OperationIndex, tokenize
+from mocks.plugin_server import MockPluginServer
+
+
+def get_index() -> OperationIndex:
+    return OperationIndex(OperationIndex.get_operations(MockPluginServer.NAME, MockPluginServer().get_spec()))
+
+
+def test_tokenize_splits_identifiers_and_stems():
+    assert tokenize("searchItems") == ["search", "item"]
+    assert tokenize("get_item_categories") == ["get", "item", "category"]
+    assert tokenize("a class of boxes") == ["class", "of", "boxe"]
+
+
+def test_search_ranks_the_matching_operation_first():
+    index = get_index()
+
+    assert [o.operation_id for o in index.search("Add apples to my list", 3)] == ["addItem"]
+    assert [o.operation_id for o in index.search("Search for bananas", 3)] == ["searchItems"]
+    # All operations are about items, but only one is looked up by ID
+    assert [o.operation_id for o in index.search("Look up the item with ID 3", 3)][0] == "getItem"
+
+
+def test_search_returns_at_most_k_matches():
+    index = get_index()
+
+    assert len(index.search("Look up the item with ID 3", 2)) == 2
+    assert index.search("What is the weather like?", 3) == []
+
+
+def test_snippets_inline_schemas():
+    operation = get_index().get(MockPluginServer.NAME, "addItem")
+
+    assert operation.method == "POST" and operation.path == "/items"
+    assert "$ref" not in operation.snippet
+    assert '"properties":{"id":{"type":"integer"},"name":{"type":"string"}}' in operation.snippet
@@ -0,0 +1,48 @@
+import json
+import asyncio
+from router import Router
+from reloader import Reloader
+from mocks.plugin_server import MockPluginServer
+
+
+def write_config(netlocs, extra_instructions):
+    # JSON is valid YAML
+    with open("config.yaml", "w") as f:
+        json.dump({"router": {"plugins": netlocs},
+                   "horace": {"extra_instructions": extra_instructions}}, f)
+
+
+def test_sessions_keep_their_router_across_reloads():
+    async def session():
+        async with MockPluginServer() as plugin_server, MockPluginServer() as new_plugin_server:
+            write_config([plugin_server.netloc], "Be brief.")
+            router = Router(plugins=[plugin_server.netloc])
+            await router.load(interactive=False)
+
+            async with Reloader("config.yaml", router, {"extra_instructions": "Be brief."}) as reloader:
+                old_router, old_config = reloader.acquire()
+
+                write_config([plugin_server.netloc, new_plugin_server.netloc], "Be polite.")
+                spec_requests = plugin_server.spec_requests
+                await reloader.reload()
+                # The cached plugin is revalidated and the new one discovered,
+                # each with a single fetch
+                assert plugin_server.spec_requests == spec_requests + 1
+                assert new_plugin_server.spec_requests == 1
+
+                new_router, new_config = reloader.acquire()
+                assert new_router is not old_router
+                assert MockPluginServer.NAME in new_router.registry
+                assert old_config == {"extra_instructions": "Be brief."}
+                assert new_config == {"extra_instructions": "Be polite."}
+
+                # The old router is closed once its last session has ended
+                assert old_router.sessions
+                reloader.release(old_router)
+                await asyncio.sleep(0.01)
+                assert not old_router.sessions
+                assert new_router.sessions
+
+                reloader.release(new_router)
+
+    asyncio.run(session())
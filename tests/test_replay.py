@@ -0,0 +1,77 @@
+import json
+import asyncio
+import argparse
+import websockets
+from router import Router
+from main import get_handler
+from recorder import Recorder
+from backends.scheduler import BackendScheduler
+from mocks.scripted_backend import ScriptedBackend
+from mocks.plugin_server import MockPluginServer
+from benchmark import get_completion
+from replay import Capture, run
+
+
+async def run_client(uri: str, utterances):
+    async with websockets.connect(uri) as websocket:
+        for utterance in utterances:
+            await websocket.send(json.dumps({"type": "utterance", "text": utterance}))
+
+            replying = False
+            while True:
+                event = json.loads(await websocket.recv())
+                assert event["type"] != "error", event["message"]
+                if event["type"] == "state":
+                    if event["state"] == "replying":
+                        replying = True
+                    elif replying:
+                        break
+
+
+def record(path: str, sessions):
+    async def session():
+        async with MockPluginServer() as plugin_server:
+            router = Router(plugins=[plugin_server.netloc])
+            await router.load(interactive=False)
+            recorder = Recorder(path, router)
+
+            backend = ScriptedBackend(
+                lambda messages: get_completion(messages, plugin_server.url), token_latency=0.001)
+            handler = get_handler(
+                scheduler=BackendScheduler(backend),
+                horace_config={},
+                router=router,
+                recorder=recorder
+            )
+
+            async with router:
+                async with websockets.serve(handler, "127.0.0.1", 0) as server:
+                    uri = f"ws://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+                    await asyncio.gather(*[run_client(uri, utterances) for utterances in sessions])
+                    # Let the handlers finish recording the sessions
+                    await asyncio.sleep(0.1)
+
+            recorder.close()
+            return plugin_server.requests
+
+    return asyncio.run(session())
+
+
+def test_recorded_sessions_replay_without_misses(tmp_path):
+    path = str(tmp_path / "capture.jsonl")
+    sessions = [["apples", "pears"], ["bread"]]
+    plugin_requests = record(path, sessions)
+
+    capture = Capture([path])
+    assert len(capture.sessions) == 2
+    assert len(capture.plugin_requests) == plugin_requests == 3
+    assert len(capture.completions) == 6
+
+    # The plugin server is gone by now, so every response comes from the capture
+    result = asyncio.run(run(argparse.Namespace(speed=100), capture, {}))
+
+    assert result["sessions"] == 2
+    assert result["turns"] == 3
+    assert result["errors"] == 0
+    assert result["completion_misses"] == 0
+    assert result["plugin_misses"] == 0
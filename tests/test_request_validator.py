@@ -0,0 +1,34 @@
+import pytest
+from request_validator import RequestValidator, RequestValidationError
+from mocks.plugin_server import MockPluginServer
+
+
+def get_validator() -> RequestValidator:
+    spec = MockPluginServer().get_spec()
+    # A literal path overlapping the templated one, with another method
+    spec["paths"]["/items/search"] = {
+        "post": {"operationId": "searchItemsByBody", "responses": {"200": {"description": "Matching items"}}}
+    }
+    return RequestValidator(spec)
+
+
+def test_literal_paths_take_precedence():
+    operation, path_params = get_validator().find_operation("POST", "http://127.0.0.1:0/items/search")
+
+    assert operation.operation_dict["operationId"] == "searchItemsByBody"
+    assert path_params == {}
+
+
+def test_templated_path_matches_methods_the_literal_one_lacks():
+    operation, path_params = get_validator().find_operation("GET", "http://127.0.0.1:0/items/search")
+
+    assert operation.operation_dict["operationId"] == "getItem"
+    assert path_params == {"id": "search"}
+
+
+def test_method_not_found_on_any_matching_path():
+    with pytest.raises(RequestValidationError, match="Operation DELETE not found for /items/search"):
+        get_validator().find_operation("DELETE", "http://127.0.0.1:0/items/search")
+
+    with pytest.raises(RequestValidationError, match="Path not found"):
+        get_validator().find_operation("GET", "http://127.0.0.1:0/stores")
@@ -0,0 +1,33 @@
+from response_filter import compact
+
+
+def test_include_keeps_top_level_keys_whole():
+    value = {"id": 1, "name": "Apples", "details": {"id": 7, "color": "red"}, "tags": ["fruit"]}
+
+    assert compact(value, include=["name", "details"]) == {
+        "name": "Apples", "details": {"id": 7, "color": "red"}}
+
+
+def test_include_applies_to_the_objects_of_a_top_level_array():
+    value = [{"id": 1, "name": "Apples", "store": {"name": "Corner shop", "id": 3}}]
+
+    assert compact(value, include=["name", "store"]) == [
+        {"name": "Apples", "store": {"name": "Corner shop", "id": 3}}]
+
+
+def test_exclude_applies_at_any_depth():
+    value = {"id": 1, "items": [{"id": 2, "name": "Apples"}], "meta": {"id": 3}}
+
+    assert compact(value, exclude=["id"]) == {"items": [{"name": "Apples"}], "meta": {}}
+
+
+def test_long_arrays_are_cut_down():
+    assert compact({"items": [1, 2, 3, 4]}, max_array_items=2) == {
+        "items": [1, 2, "(2 more items omitted)"]}
+
+
+def test_keys_not_in_the_schema_are_pruned():
+    schema = {"type": "array", "items": {"type": "object", "properties": {"name": {"type": "string"}}}}
+
+    assert compact([{"id": 1, "name": "Apples"}], schema=schema, prune_to_schema=True) == [
+        {"name": "Apples"}]
@@ -0,0 +1,193 @@
+import json
+import asyncio
+import pytest
+from router import Router
+from mocks.plugin_server import MockPluginServer
+
+
+def read_cache(netloc):
+    with open(Router.PLUGIN_CACHE_FILENAME) as f:
+        return json.load(f)[netloc]
+
+
+def test_spec_check_is_cached_across_refreshes():
+    async def session():
+        async with MockPluginServer() as plugin_server:
+            router = Router(plugins=[plugin_server.netloc])
+            await router.load(interactive=False)
+            assert read_cache(plugin_server.netloc)["spec_valid"] is True
+
+            # The spec is unchanged, so it needn't be checked again
+            await router.refresh(router.plugins)
+            assert read_cache(plugin_server.netloc)["spec_valid"] is True
+
+            router = Router(plugins=[plugin_server.netloc])
+            await router.load(interactive=False)
+            assert read_cache(plugin_server.netloc)["spec_valid"] is True
+            assert "validator" in router.registry[MockPluginServer.NAME]
+
+    asyncio.run(session())
+
+
+class BrokenPluginServer(MockPluginServer):
+    def get_manifest(self):
+        manifest = super().get_manifest()
+        del manifest["api"]
+        return manifest
+
+
+def test_plugins_with_a_broken_manifest_are_skipped():
+    async def session():
+        async with MockPluginServer() as plugin_server, BrokenPluginServer() as broken_server:
+            router = Router(plugins=[broken_server.netloc, plugin_server.netloc])
+            await router.load(interactive=False)
+
+            assert list(router.registry) == [MockPluginServer.NAME]
+            assert router.registry[MockPluginServer.NAME]["netloc"] == plugin_server.netloc
+            assert broken_server.spec_requests == 0
+
+    asyncio.run(session())
+
+
+def search(plugin_server, max_response_bytes):
+    async def session():
+        router = Router(plugins=[plugin_server.netloc],
+                        plugin_defaults={"max_response_bytes": max_response_bytes})
+        await router.load(interactive=False)
+        async with router:
+            request = router.prepare(MockPluginServer.NAME, {
+                "method": "GET", "url": f"{plugin_server.url}/items", "params": {"q": "apple", "limit": 20}})
+            return await router.send(MockPluginServer.NAME, request)
+
+    return session()
+
+
+def test_json_responses_are_compacted_before_they_are_cut_off():
+    async def session():
+        async with MockPluginServer() as plugin_server:
+            plugin_server.items = {i: {"id": i, "name": f"Apple {i}"} for i in range(1, 21)}
+            compacted = json.dumps(list(plugin_server.items.values()), separators=(",", ":"))
+
+            # The response as sent, with spaces, is over the limit
+            status, text = await search(plugin_server, len(compacted))
+            assert status == 200
+            assert text == compacted
+
+            status, text = await search(plugin_server, 100)
+            assert text == compacted[:100] + " ... (response truncated)"
+
+    asyncio.run(session())
+
+
+def test_query_parameters_set_to_none_are_left_out():
+    async def session():
+        async with MockPluginServer() as plugin_server:
+            router = Router(plugins=[plugin_server.netloc])
+            await router.load(interactive=False)
+            async with router:
+                request = router.prepare(MockPluginServer.NAME, {
+                    "method": "GET", "url": f"{plugin_server.url}/items", "params": {"q": "apple", "limit": None}})
+                assert request["params"] == {"q": "apple"}
+
+                status, text = await router.send(MockPluginServer.NAME, request)
+                assert (status, text) == (200, "[]")
+
+    asyncio.run(session())
+
+
+@pytest.mark.parametrize("key,value", [("headers", "Accept: text/plain"), ("params", [["q", "apple"]])])
+def test_request_params_of_the_wrong_type_are_invalid(key, value):
+    async def session():
+        async with MockPluginServer() as plugin_server:
+            router = Router(plugins=[plugin_server.netloc])
+            await router.load(interactive=False)
+            with pytest.raises(ValueError, match=f"Request {key} must be an object"):
+                router.prepare(MockPluginServer.NAME, {
+                    "method": "GET", "url": f"{plugin_server.url}/items?q=apple", key: value})
+
+    asyncio.run(session())
+
+
+def send_requests(plugin_server, requests, gather=False, **settings):
+    # Sends the requests, one after another or all at once, and returns the
+    # number that reached the plugin
+    async def session():
+        router = Router(plugins=[plugin_server.netloc], plugin_defaults=settings)
+        await router.load(interactive=False)
+        async with router:
+            prepared = [router.prepare(MockPluginServer.NAME, {"method": "GET", **request})
+                        for request in requests]
+            if gather:
+                responses = await asyncio.gather(*[router.send(MockPluginServer.NAME, p) for p in prepared])
+            else:
+                responses = [await router.send(MockPluginServer.NAME, p) for p in prepared]
+
+        assert all(status == 200 for status, _ in responses)
+        return plugin_server.requests
+
+    return session()
+
+
+def test_equivalent_requests_share_a_cache_entry():
+    async def session():
+        async with MockPluginServer() as plugin_server:
+            plugin_server.cache_control = "max-age=60"
+            url = f"{plugin_server.url}/items"
+            requests = [
+                {"url": f"{url}?q=apple&limit=2"},
+                {"url": url.upper().replace("/ITEMS", "/items"), "params": {"limit": 2, "q": "apple"}},
+                {"url": f"{url}?limit=2", "params": {"q": "apple"}}
+            ]
+            assert await send_requests(plugin_server, requests) == 1
+
+            # Other parameters are another entry
+            assert await send_requests(plugin_server, [{"url": url, "params": {"q": "pear"}}]) == 2
+
+    asyncio.run(session())
+
+
+def test_responses_are_not_shared_between_credentials():
+    async def session():
+        async with MockPluginServer() as plugin_server:
+            plugin_server.cache_control = "max-age=60"
+            url = f"{plugin_server.url}/items?q=apple"
+            requests = [{"url": url, "headers": {"Authorization": f"Bearer {token}"}}
+                        for token in ["a", "b", "a"]]
+            assert await send_requests(plugin_server, requests) == 2
+
+    asyncio.run(session())
+
+
+@pytest.mark.parametrize("cache_control,settings,requests", [
+    (None, {}, 2),
+    ("max-age=60", {}, 1),
+    ("no-store", {}, 2),
+    ("private, max-age=60", {}, 2),
+    # The configured TTL overrides max-age, but not no-store
+    ("max-age=60", {"response_cache_ttl": 0}, 2),
+    (None, {"response_cache_ttl": 60}, 1),
+    ("no-store", {"response_cache_ttl": 60}, 2)
+])
+def test_cache_control_is_honored(cache_control, settings, requests):
+    async def session():
+        async with MockPluginServer() as plugin_server:
+            plugin_server.cache_control = cache_control
+            url = f"{plugin_server.url}/items?q=apple"
+            return await send_requests(plugin_server, [{"url": url}] * 2, **settings)
+
+    assert asyncio.run(session()) == requests
+
+
+def test_identical_requests_in_flight_are_sent_once():
+    async def session():
+        async with MockPluginServer(latency=0.05) as plugin_server:
+            # Even responses that may not be cached
+            plugin_server.cache_control = "no-store"
+            url = f"{plugin_server.url}/items?q=apple"
+            assert await send_requests(plugin_server, [{"url": url}] * 3, gather=True) == 1
+
+            # Requests with a body are never merged
+            requests = [{"method": "POST", "url": f"{plugin_server.url}/items", "json": {"name": "Apples"}}] * 2
+            assert await send_requests(plugin_server, requests, gather=True) == 3
+
+    asyncio.run(session())
@@ -0,0 +1,172 @@
+import time
+import asyncio
+import pytest
+from backends import scheduler as scheduler_module
+from backends.backend import Backend
+from backends.scheduler import BackendScheduler
+
+
+class FakeClock():
+    # Stands in for the time module in the scheduler, so that the token
+    # bucket refills when the test says so
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def perf_counter(self) -> float:
+        return time.perf_counter()
+
+
+class RetryableError(Exception):
+    pass
+
+
+class FlakyBackend(Backend):
+    # Fails with the given errors, in turn, before completing
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.attempts = 0
+
+    async def complete(self, messages, max_tokens=16, stop=None, temperature=1.0):
+        self.attempts += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "Hello!"
+
+    def is_retryable(self, e):
+        return isinstance(e, RetryableError)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(scheduler_module, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def retry_delays(monkeypatch):
+    # Retries wait the full backoff, without actually sleeping
+    delays = []
+    sleep = asyncio.sleep
+
+    async def fake_sleep(delay):
+        delays.append(delay)
+        await sleep(0)
+
+    monkeypatch.setattr(scheduler_module.random, "uniform", lambda low, high: high)
+    monkeypatch.setattr(asyncio, "sleep", fake_sleep)
+    return delays
+
+
+def test_sessions_are_served_round_robin():
+    async def session():
+        scheduler = BackendScheduler(FlakyBackend(), max_in_flight=1)
+        order = []
+
+        async def request(session_id, label):
+            await scheduler.acquire(session_id, 1)
+            order.append(label)
+            await asyncio.sleep(0)
+            scheduler.release()
+
+        await asyncio.gather(*[request(session_id, label) for session_id, label in [
+            (0, "a1"), (0, "a2"), (0, "a3"), (0, "a4"), (1, "b1")]])
+        return order, scheduler
+
+    order, scheduler = asyncio.run(session())
+    # The second session waits for one request of the first, not all of them
+    assert order == ["a1", "a2", "b1", "a3", "a4"]
+    assert scheduler.requests == 5
+    assert scheduler.in_flight == 0
+
+
+def test_token_bucket_limits_throughput(clock):
+    async def session():
+        scheduler = BackendScheduler(FlakyBackend(), tokens_per_minute=600)
+        loop = asyncio.get_running_loop()
+
+        # The bucket starts full
+        await scheduler.acquire(0, 600)
+        waiter = asyncio.create_task(scheduler.acquire(1, 300))
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        # At 10 tokens a second, 300 tokens take 30 seconds
+        assert scheduler._dispatch_handle.when() - loop.time() == pytest.approx(30, abs=1)
+
+        clock.now += 20
+        scheduler._on_tokens_refilled()
+        await asyncio.sleep(0)
+        assert not waiter.done()
+
+        clock.now += 10
+        scheduler._on_tokens_refilled()
+        await asyncio.sleep(0)
+        assert waiter.done()
+        assert scheduler.in_flight == 2
+
+    asyncio.run(session())
+
+
+def test_retryable_errors_are_retried_with_backoff(retry_delays):
+    async def session():
+        backend = FlakyBackend([RetryableError("rate limited")] * 3)
+        scheduler = BackendScheduler(backend, retry_base_delay=1, retry_max_delay=3)
+        completion = await scheduler.session().complete([{"role": "user", "content": "Hi"}])
+        return completion, backend, scheduler
+
+    completion, backend, scheduler = asyncio.run(session())
+    assert completion == "Hello!"
+    assert backend.attempts == 4
+    assert retry_delays == [1, 2, 3]
+    assert scheduler.retries == 3
+    assert scheduler.in_flight == 0
+
+
+def test_other_errors_are_not_retried(retry_delays):
+    backend = FlakyBackend([ValueError("bad request")])
+
+    async def session():
+        scheduler = BackendScheduler(backend)
+        await scheduler.session().complete([{"role": "user", "content": "Hi"}])
+
+    with pytest.raises(ValueError):
+        asyncio.run(session())
+    assert backend.attempts == 1
+    assert retry_delays == []
+
+
+def test_retries_give_up_after_max_retries(retry_delays):
+    backend = FlakyBackend([RetryableError("overloaded")] * 3)
+
+    async def session():
+        scheduler = BackendScheduler(backend, max_retries=2)
+        await scheduler.session().complete([{"role": "user", "content": "Hi"}])
+
+    with pytest.raises(RetryableError):
+        asyncio.run(session())
+    assert backend.attempts == 3
+
+
+def test_cancelled_requests_leave_the_queue():
+    async def session():
+        scheduler = BackendScheduler(FlakyBackend(), max_in_flight=1)
+        await scheduler.acquire(0, 1)
+
+        waiter = asyncio.create_task(scheduler.acquire(1, 1))
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth == 1
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+
+        # The cancelled request doesn't take the slot when it frees up
+        scheduler.release()
+        assert scheduler.in_flight == 0
+        assert scheduler.queue_depth == 0
+        await asyncio.wait_for(scheduler.acquire(2, 1), 1)
+        assert scheduler.in_flight == 1
+        assert scheduler.requests == 2
+
+    asyncio.run(session())
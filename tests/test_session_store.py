@@ -0,0 +1,123 @@
+import asyncio
+import pytest
+from transcript import Turn
+from session_store import SessionManager, SQLiteSessionStore, FileSessionStore
+
+
+@pytest.fixture(params=["sqlite", "file"])
+def store(request, tmp_path):
+    if request.param == "sqlite":
+        return SQLiteSessionStore(str(tmp_path / "sessions.db"))
+    return FileSessionStore(str(tmp_path / "sessions"))
+
+
+def make_turns(*texts):
+    return [Turn("user", "User", text, len(text)) for text in texts]
+
+
+def test_store_round_trip(store):
+    async def session():
+        await store.append("a" * 32, 0, make_turns("one", "two"))
+        await store.append("a" * 32, 2, make_turns("three"))
+        await store.save_summary("a" * 32, 2, Turn("system", "Summary", "One and two.", 5))
+
+        assert await store.load("a" * 32) == make_turns("one", "two", "three")
+        assert await store.load("a" * 32, 2) == make_turns("three")
+        assert await store.load_summary("a" * 32) == (2, Turn("system", "Summary", "One and two.", 5))
+        assert await store.load("b" * 32) == []
+        assert await store.load_summary("b" * 32) == (0, None)
+        await store.close()
+
+    asyncio.run(session())
+
+
+async def open_session(manager, session_id=None):
+    async def close():
+        pass
+
+    return await manager.open(session_id, len, close)
+
+
+async def add_turns(manager, session_id, transcript, *texts):
+    start = transcript.end
+    turns = [transcript.append("user", "User", text) for text in texts]
+    await manager.append(session_id, start, turns)
+
+
+def test_resume_from_store(store):
+    async def session():
+        manager = SessionManager(store)
+        session_id, transcript, resumed = await open_session(manager)
+        assert not resumed
+        await add_turns(manager, session_id, transcript, "Hi", "Add apples")
+        manager.release(session_id, transcript)
+
+        # A restarted server has nothing in memory
+        manager = SessionManager(store)
+        resumed_id, transcript, resumed = await open_session(manager, session_id)
+        assert (resumed_id, resumed) == (session_id, True)
+        assert [turn.text for turn in transcript] == ["Hi", "Add apples"]
+
+        # Unknown and malformed IDs get a new session
+        new_id, _, resumed = await open_session(manager, "f" * 32)
+        assert new_id != "f" * 32 and not resumed
+        new_id, _, resumed = await open_session(manager, "../etc/passwd")
+        assert not resumed
+        await manager.close()
+
+    asyncio.run(session())
+
+
+def test_reconnect_takes_over_session():
+    async def session():
+        manager = SessionManager()
+        closed = []
+
+        async def close():
+            # The old connection's handler releases the session once closed
+            closed.append(True)
+            asyncio.get_running_loop().call_soon(manager.release, session_id, transcript)
+
+        session_id, transcript, _ = await manager.open(None, len, close)
+        await add_turns(manager, session_id, transcript, "Hi")
+
+        resumed_id, resumed_transcript, resumed = await open_session(manager, session_id)
+        assert closed == [True]
+        assert (resumed_id, resumed) == (session_id, True)
+        assert resumed_transcript is transcript
+
+    asyncio.run(session())
+
+
+def test_idle_sessions_are_evicted():
+    async def session():
+        manager = SessionManager(max_idle_sessions=1, idle_ttl=0.05)
+        session_ids = []
+        for text in ["Hi", "Hello"]:
+            session_id, transcript, _ = await open_session(manager)
+            await add_turns(manager, session_id, transcript, text)
+            manager.release(session_id, transcript)
+            session_ids.append(session_id)
+
+        # The least recently used session makes room for the other one
+        _, _, resumed = await open_session(manager, session_ids[0])
+        assert not resumed
+
+        await asyncio.sleep(0.1)
+        _, _, resumed = await open_session(manager, session_ids[1])
+        assert not resumed
+
+    asyncio.run(session())
+
+
+def test_idle_session_is_resumed_from_memory():
+    async def session():
+        manager = SessionManager(idle_ttl=60)
+        session_id, transcript, _ = await open_session(manager)
+        await add_turns(manager, session_id, transcript, "Hi")
+        manager.release(session_id, transcript)
+
+        _, resumed_transcript, resumed = await open_session(manager, session_id)
+        assert resumed and resumed_transcript is transcript
+
+    asyncio.run(session())
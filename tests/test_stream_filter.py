@@ -0,0 +1,38 @@
+from chatbot import StreamFilter
+
+
+def feed(deltas, markers=("<call>", "<|endoftext|>")):
+    stream_filter = StreamFilter(list(markers))
+    return [stream_filter.feed(delta) for delta in deltas]
+
+
+def test_text_without_markers_passes_through():
+    assert feed(["Hello", " there", "!"]) == ["Hello", " there", "!"]
+
+
+def test_split_tag_is_held_back_and_never_streamed():
+    visible = feed(["Let me look. <ca", "ll>", '{"plugin_system_name": "items"}', "</call>"])
+
+    assert visible == ["Let me look. ", "", "", ""]
+    assert "".join(visible) == "Let me look. "
+
+
+def test_tag_split_one_character_at_a_time():
+    visible = feed(["Sure.", " ", "<", "c", "a", "l", "l", ">", "{"])
+
+    assert "".join(visible) == "Sure. "
+    assert all("<" not in delta for delta in visible)
+
+
+def test_held_back_text_is_released_when_it_is_not_a_tag():
+    assert feed(["Use <ca", "t> tags"]) == ["Use ", "<cat> tags"]
+    assert feed(["1 <", " 2"]) == ["1 ", "< 2"]
+
+
+def test_any_marker_stops_the_stream():
+    assert feed(["Bye!<|endof", "text|> ignored"]) == ["Bye!", ""]
+    assert feed(["Hi <call>", "{}", " more"]) == ["Hi ", "", ""]
+
+
+def test_leading_whitespace_is_dropped():
+    assert feed(["  ", "\n", " Hello"]) == ["", "", "Hello"]
@@ -0,0 +1,79 @@
+import asyncio
+from chatbot import Chatbot
+from transcript import Transcript
+from mocks.scripted_backend import ScriptedBackend
+
+
+def count_words(text: str) -> int:
+    return len(text.split())
+
+
+def make_transcript(*texts) -> Transcript:
+    transcript = Transcript(count_words)
+    for i, text in enumerate(texts):
+        transcript.append("user" if i % 2 == 0 else "assistant", "Human" if i % 2 == 0 else "AI", text)
+    return transcript
+
+
+def test_oldest_turns_are_evicted_first():
+    # Each turn is one word plus the per-turn overhead
+    transcript = make_transcript("one", "two", "three", "four")
+    turn_tokens = 1 + Transcript.TOKENS_PER_TURN
+
+    evicted = transcript.evict(2 * turn_tokens)
+
+    assert [turn.text for turn in evicted] == ["one", "two"]
+    assert [turn.text for turn in transcript] == ["three", "four"]
+    assert transcript.tokens == 2 * turn_tokens
+    assert transcript.evicted == 2
+    assert transcript.end == 4
+
+
+def test_nothing_is_evicted_within_the_budget():
+    transcript = make_transcript("one", "two")
+
+    assert transcript.evict(transcript.tokens) == []
+    assert len(transcript) == 2
+
+
+def test_latest_turn_is_kept_over_budget():
+    transcript = make_transcript("one", "a rather long latest turn")
+
+    evicted = transcript.evict(1)
+
+    assert [turn.text for turn in evicted] == ["one"]
+    assert [turn.text for turn in transcript] == ["a rather long latest turn"]
+    assert transcript.tokens == 5 + Transcript.TOKENS_PER_TURN
+
+
+def test_prompt_stays_within_the_token_budget():
+    initial_prompt = "You are a helpful assistant."
+    budget = 60
+
+    async def session():
+        backend = ScriptedBackend(["Sure, here is a reply of several words."], record_requests=True)
+
+        async def utterance_coroutine(utterance, is_system=False):
+            pass
+
+        chatbot = Chatbot(backend, initial_prompt, utterance_coroutine, context_token_budget=budget)
+        for i in range(10):
+            await chatbot.send_responses([f"Message number {i} from the user."])
+
+        return chatbot, backend
+
+    chatbot, backend = asyncio.run(session())
+
+    for messages in backend.requests:
+        # The system prompt and the latest user message are always there
+        assert messages[0] == {"role": "system", "content": initial_prompt}
+        assert messages[-1]["role"] == "user"
+
+        turns = [message for message in messages if message["role"] != "system"]
+        tokens = chatbot.initial_prompt_tokens + sum(
+            chatbot.backend.count_tokens(message["content"]) + Transcript.TOKENS_PER_TURN for message in turns)
+        assert tokens <= budget
+
+    assert backend.requests[-1][-1]["content"] == "Message number 9 from the user."
+    assert chatbot.transcript.evicted > 0
+    assert backend.requests[-1][1]["content"].endswith("earlier messages of the conversation are omitted)")
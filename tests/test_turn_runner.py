@@ -0,0 +1,98 @@
+import asyncio
+from turn_runner import TurnRunner
+
+
+class SlowChatbot():
+    # Takes a while over each turn and notes how it went
+    STATE_LISTENING = "listening"
+    STATE_ENDED = "ended"
+
+    def __init__(self, turn_duration: float = 0.05):
+        self.turn_duration = turn_duration
+        self.state = self.STATE_LISTENING
+        self.events = []
+
+    async def send_responses(self, responses):
+        self.events.append(("started", responses))
+        try:
+            await asyncio.sleep(self.turn_duration)
+        except asyncio.CancelledError:
+            self.events.append(("cancelled", responses))
+            raise
+        self.events.append(("done", responses))
+
+
+def run_turns(busy_policy, submit_delay=0.01):
+    async def session():
+        chatbot = SlowChatbot()
+        errors = []
+
+        async def error_coroutine(e):
+            errors.append(e)
+
+        async def interrupted_coroutine():
+            chatbot.events.append(("interrupted",))
+
+        runner = TurnRunner(chatbot, error_coroutine, busy_policy=busy_policy,
+                            interrupted_coroutine=interrupted_coroutine)
+        for response in ["a", "b", "c"]:
+            runner.submit(response)
+            await asyncio.sleep(submit_delay)
+        await runner.join()
+
+        assert errors == []
+        return chatbot.events
+
+    return asyncio.run(session())
+
+
+def test_queue_gives_each_message_a_turn():
+    assert run_turns(TurnRunner.POLICY_QUEUE) == [
+        ("started", ["a"]), ("done", ["a"]),
+        ("started", ["b"]), ("done", ["b"]),
+        ("started", ["c"]), ("done", ["c"])
+    ]
+
+
+def test_coalesce_answers_waiting_messages_together():
+    assert run_turns(TurnRunner.POLICY_COALESCE) == [
+        ("started", ["a"]), ("done", ["a"]),
+        ("started", ["b", "c"]), ("done", ["b", "c"])
+    ]
+
+
+def test_interrupt_restarts_the_turn_with_all_messages():
+    # Each restart is announced once the cancelled turn has rolled back
+    assert run_turns(TurnRunner.POLICY_INTERRUPT) == [
+        ("started", ["a"]), ("cancelled", ["a"]),
+        ("interrupted",), ("started", ["a", "b"]), ("cancelled", ["a", "b"]),
+        ("interrupted",), ("started", ["a", "b", "c"]), ("done", ["a", "b", "c"])
+    ]
+
+
+def test_messages_between_turns_are_not_interrupts():
+    events = run_turns(TurnRunner.POLICY_INTERRUPT, submit_delay=0.1)
+
+    assert ("interrupted",) not in events
+    assert [event for event in events if event[0] == "done"] == [
+        ("done", ["a"]), ("done", ["b"]), ("done", ["c"])]
+
+
+def test_close_cancels_the_turn_and_drops_waiting_messages():
+    async def session():
+        chatbot = SlowChatbot()
+
+        async def error_coroutine(e):
+            pass
+
+        runner = TurnRunner(chatbot, error_coroutine, busy_policy=TurnRunner.POLICY_QUEUE)
+        runner.submit("a")
+        await asyncio.sleep(0.01)
+        runner.submit("b")
+        await runner.close()
+        await asyncio.sleep(0.1)
+
+        assert not runner.busy
+        assert chatbot.events == [("started", ["a"]), ("cancelled", ["a"])]
+
+    asyncio.run(session())